@@ -0,0 +1,58 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Microbenchmark for VCL rendering.
+
+It compares the old rendering strategy, that read and escaped
+misc/default.vcl on every call, against the cached template used by
+BaseManager.render_vcl.
+
+Usage: python benchmarks/vcl_template.py [-n NUMBER]
+"""
+
+import argparse
+import codecs
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from feaas import managers  # noqa
+
+
+def uncached_render(params):
+    with codecs.open(managers.VCL_TEMPLATE_FILE, encoding="utf-8") as f:
+        content = f.read()
+        content = content.replace("\n", " ")
+        content = content.replace('"', r'\"')
+        content = content.replace("\t", "")
+        escaped = {}
+        for key, value in params.items():
+            if isinstance(value, basestring):
+                value = value.replace("\n", " ").replace('"', r'\"').replace("\t", "")
+            escaped[key] = value
+        return ('"%s"' % content.strip()) % escaped
+
+
+def cached_render(params):
+    return managers.default_template.render(**params)
+
+
+def run():
+    parser = argparse.ArgumentParser("VCL template benchmark")
+    parser.add_argument("-n", "--number", help="Number of renders per strategy",
+                        default=100000, type=int)
+    args = parser.parse_args()
+    params = managers.BaseManager(None).vcl_params(["app1.host", "app2.host"])
+    assert uncached_render(params) == cached_render(params)
+    for name, fn in (("before (uncached)", uncached_render),
+                     ("after (cached)", cached_render)):
+        elapsed = timeit.timeit(lambda: fn(params), number=args.number)
+        per_render = elapsed / args.number * 1e6
+        sys.stdout.write("{0:<20} {1:8.2f} us/render\n".format(name, per_render))
+
+if __name__ == "__main__":
+    run()
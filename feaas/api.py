@@ -8,7 +8,7 @@ import os
 
 from flask import Flask, Response, request
 
-from . import auth, plugin, storage
+from . import auth, plans, plugin, storage
 from .managers import cloudstack, ec2
 
 api = Flask(__name__)
@@ -27,10 +27,22 @@ def add_instance():
     if not name:
         return "name is required", 400
     manager = get_manager()
-    manager.new_instance(name)
+    try:
+        manager.new_instance(name, plan=request.form.get("plan"))
+    except ValueError as e:
+        return " ".join(e.args), 400
     return "", 201
 
 
+@api.route("/resources/plans", methods=["GET"])
+@auth.required
+def list_plans():
+    result = [{"name": p["name"], "description": p.get("description", "")}
+              for p in plans.load()]
+    return Response(response=json.dumps(result), status=200,
+                    mimetype="application/json")
+
+
 @api.route("/resources/<name>", methods=["DELETE"])
 @auth.required
 def remove_instance(name):
@@ -126,6 +138,247 @@ def scale_instance(name):
     return "", 201
 
 
+@api.route("/resources/<name>/purge", methods=["POST"])
+@auth.required
+def purge(name):
+    pattern = request.form.get("pattern")
+    expression = request.form.get("expression")
+    if not pattern and not expression:
+        return "pattern or expression is required", 400
+    manager = get_manager()
+    try:
+        result = manager.purge(name, pattern=pattern, expression=expression)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    status = 200
+    if not all([u["ok"] for u in result["units"]]):
+        status = 500
+    return Response(response=json.dumps(result), status=status,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/params", methods=["POST"])
+@auth.required
+def set_params(name):
+    manager = get_manager()
+    try:
+        params = manager.set_params(name, request.form.to_dict())
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(params), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/warm-urls", methods=["GET"])
+@auth.required
+def get_warm_urls(name):
+    manager = get_manager()
+    try:
+        result = manager.get_warm_urls(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(result, default=str), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/warm-urls", methods=["PUT"])
+@auth.required
+def set_warm_urls(name):
+    try:
+        urls = json.loads(request.data)
+    except ValueError:
+        return "urls must be valid JSON", 400
+    manager = get_manager()
+    try:
+        urls = manager.set_warm_urls(name, urls)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(urls), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/vcl-retries", methods=["GET"])
+@auth.required
+def get_vcl_retries(name):
+    manager = get_manager()
+    try:
+        retries = manager.get_vcl_retries(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(retries, default=str), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/vcl-retries/requeue", methods=["POST"])
+@auth.required
+def requeue_vcl_retries(name):
+    manager = get_manager()
+    try:
+        requeued = manager.requeue_vcl_retries(name, request.form.get("unit"))
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps({"requeued": requeued}), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/metrics", methods=["GET"])
+@auth.required
+def get_metrics(name):
+    try:
+        minutes = int(request.args.get("minutes", 60))
+        step = request.args.get("step")
+        if step is not None:
+            step = int(step)
+    except ValueError:
+        return "minutes and step must be integers", 400
+    manager = get_manager()
+    try:
+        points = manager.get_metrics(name, minutes, step)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(points, default=str), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/autoscale", methods=["GET"])
+@auth.required
+def get_autoscale(name):
+    manager = get_manager()
+    try:
+        config = manager.get_autoscale(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(config, default=str), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/autoscale", methods=["PUT"])
+@auth.required
+def set_autoscale(name):
+    try:
+        config = json.loads(request.data)
+    except ValueError:
+        return "autoscale configuration must be valid JSON", 400
+    manager = get_manager()
+    try:
+        config = manager.set_autoscale(name, config)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(config), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/autoscale", methods=["DELETE"])
+@auth.required
+def disable_autoscale(name):
+    manager = get_manager()
+    try:
+        manager.disable_autoscale(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return "", 200
+
+
+@api.route("/resources/<name>/schedule", methods=["GET"])
+@auth.required
+def get_schedule(name):
+    manager = get_manager()
+    try:
+        scaling_schedule = manager.get_schedule(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(scaling_schedule, default=str), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/schedule", methods=["PUT"])
+@auth.required
+def set_schedule(name):
+    try:
+        scaling_schedule = json.loads(request.data)
+    except ValueError:
+        return "schedule must be valid JSON", 400
+    manager = get_manager()
+    try:
+        scaling_schedule = manager.set_schedule(name, scaling_schedule)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(scaling_schedule), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/schedule", methods=["DELETE"])
+@auth.required
+def remove_schedule(name):
+    manager = get_manager()
+    try:
+        manager.remove_schedule(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return "", 200
+
+
+@api.route("/resources/<name>/cache-policy", methods=["GET"])
+@auth.required
+def get_cache_policy(name):
+    manager = get_manager()
+    try:
+        policy = manager.get_cache_policy(name)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(policy), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/cache-policy", methods=["PUT"])
+@auth.required
+def set_cache_policy(name):
+    try:
+        policy = json.loads(request.data)
+    except ValueError:
+        return "cache policy must be valid JSON", 400
+    manager = get_manager()
+    try:
+        policy = manager.set_cache_policy(name, policy)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=json.dumps(policy), status=200,
+                    mimetype="application/json")
+
+
+@api.route("/resources/<name>/cache-policy/preview", methods=["POST"])
+@auth.required
+def preview_cache_policy(name):
+    policy = None
+    if request.data:
+        try:
+            policy = json.loads(request.data)
+        except ValueError:
+            return "cache policy must be valid JSON", 400
+    manager = get_manager()
+    try:
+        vcl = manager.preview_vcl(name, policy)
+    except ValueError as e:
+        return " ".join(e.args), 400
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    return Response(response=vcl, status=200, mimetype="text/plain")
+
+
 @api.route("/plugin", methods=["GET"])
 def get_plugin():
     return inspect.getsource(plugin)
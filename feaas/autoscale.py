@@ -0,0 +1,135 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+
+DEFAULTS = {"target_utilization": 0.7, "tolerance": 0.1, "scale_up_cooldown": 120,
+            "scale_down_cooldown": 600}
+
+FIELDS = ("signal", "capacity", "min_units", "max_units") + tuple(DEFAULTS.keys())
+
+SIGNAL_WINDOW = 600
+
+
+class MetricsSignal(object):
+    """
+    MetricsSignal reads the load of an instance from the points stored by the
+    metrics collector: the rate of the given field, per second and per unit,
+    between the last two points.
+    """
+    field = None
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def load(self, instance):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=SIGNAL_WINDOW)
+        points = self.storage.retrieve_metrics(instance.name, since=since)
+        if len(points) < 2:
+            return None
+        previous, last = points[-2:]
+        seconds = (last["timestamp"] - previous["timestamp"]).total_seconds()
+        if seconds <= 0 or not last["units"]:
+            return None
+        return last[self.field] / seconds / last["units"]
+
+
+class RequestRate(MetricsSignal):
+    field = "requests"
+
+
+class BackendFetchRate(MetricsSignal):
+    field = "backend_fetches"
+
+
+signals = {
+    "requests": RequestRate,
+    "backend_fetches": BackendFetchRate,
+}
+
+
+def register_signal(name, obj, override=False):
+    """
+    Registers a source of load signals. Sources are built with the storage
+    and provide a load(instance) method, returning the average load of the
+    units of the instance, or None when there's no data.
+    """
+    if not override and name in signals:
+        raise ValueError("Signal already registered")
+    signals[name] = obj
+
+
+def validate(config):
+    """
+    Validates the autoscaling configuration of an instance, raising
+    ValueError when it's invalid, and returns a copy with the defaults
+    applied. A configuration looks like:
+
+        {"signal": "requests", "capacity": 500, "min_units": 2, "max_units": 10,
+         "target_utilization": 0.7, "tolerance": 0.1,
+         "scale_up_cooldown": 120, "scale_down_cooldown": 600}
+
+    Capacity is the load a unit handles at full utilization, in the unit of
+    the signal (e.g. requests per second). The instance is resized so units
+    run at target_utilization, but only when utilization is more than
+    tolerance (relative to the target) away from it. Cooldowns are the
+    minimum time after the last scale, in seconds, before scaling up or down.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("autoscale configuration must be an object")
+    for field in config:
+        if field not in FIELDS:
+            raise ValueError("unknown autoscale field: {0}".format(field))
+    for field in ("signal", "capacity", "min_units", "max_units"):
+        if field not in config:
+            raise ValueError("{0} is required".format(field))
+    validated = dict(DEFAULTS)
+    validated.update(config)
+    if validated["signal"] not in signals:
+        raise ValueError("invalid signal: {0}".format(validated["signal"]))
+    _check_number(validated["capacity"], "capacity")
+    for field in ("min_units", "max_units"):
+        if not _is_integer(validated[field]) or validated[field] < 1:
+            raise ValueError("{0} must be a positive integer".format(field))
+    if validated["min_units"] > validated["max_units"]:
+        raise ValueError("min_units must not be greater than max_units")
+    _check_number(validated["target_utilization"], "target_utilization")
+    if validated["target_utilization"] > 1:
+        raise ValueError("target_utilization must be at most 1")
+    tolerance = validated["tolerance"]
+    if not _is_number(tolerance) or tolerance < 0 or tolerance >= 1:
+        raise ValueError("tolerance must be at least 0 and less than 1")
+    for field in ("scale_up_cooldown", "scale_down_cooldown"):
+        if not _is_integer(validated[field]) or validated[field] < 0:
+            raise ValueError("{0} must be a non-negative integer".format(field))
+    return validated
+
+
+def _is_number(value):
+    return not isinstance(value, bool) and isinstance(value, (int, long, float))
+
+
+def _is_integer(value):
+    return not isinstance(value, bool) and isinstance(value, (int, long))
+
+
+def _check_number(value, field):
+    if not _is_number(value) or value <= 0:
+        raise ValueError("{0} must be a positive number".format(field))
+
+
+def desired_units(current, load, config):
+    """
+    Returns the number of units an instance with current units and the given
+    average load per unit should have, within min_units and max_units.
+    """
+    desired = current
+    if load is not None and current > 0:
+        utilization = load / float(config["capacity"])
+        target = config["target_utilization"]
+        tolerance = config["tolerance"]
+        if abs(utilization - target) > target * tolerance:
+            desired = int(math.ceil(round(current * utilization / target, 6)))
+    return max(config["min_units"], min(config["max_units"], desired))
@@ -0,0 +1,73 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker keeps one circuit per key (for example, per unit). After
+    threshold consecutive failures, the circuit opens and calls fail fast with
+    CircuitOpenError for cooldown seconds. Then the circuit is half-open: a
+    single trial call goes through, closing the circuit when it succeeds and
+    opening it again when it fails.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        if threshold < 1:
+            raise ValueError("threshold must be a positive integer")
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def state(self, key):
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if not circuit or circuit["opened_at"] is None:
+                return "closed"
+            if circuit["trial"] or time.time() - circuit["opened_at"] >= self.cooldown:
+                return "half-open"
+            return "open"
+
+    def call(self, key, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) through the circuit of the given key,
+        raising CircuitOpenError instead when the circuit is open.
+        """
+        self._acquire(key)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._failure(key)
+            raise
+        self._success(key)
+        return result
+
+    def _acquire(self, key):
+        with self.lock:
+            circuit = self.circuits.setdefault(key, {"failures": 0, "opened_at": None,
+                                                     "trial": False})
+            if circuit["opened_at"] is None:
+                return
+            if circuit["trial"] or time.time() - circuit["opened_at"] < self.cooldown:
+                raise CircuitOpenError("circuit of {0} is open".format(key))
+            circuit["trial"] = True
+
+    def _failure(self, key):
+        with self.lock:
+            circuit = self.circuits[key]
+            circuit["failures"] += 1
+            if circuit["trial"] or circuit["failures"] >= self.threshold:
+                circuit["opened_at"] = time.time()
+                circuit["trial"] = False
+
+    def _success(self, key):
+        with self.lock:
+            self.circuits.pop(key, None)
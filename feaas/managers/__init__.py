@@ -3,11 +3,20 @@
 # license that can be found in the LICENSE file.
 
 import codecs
+import datetime
+import hashlib
 import httplib2
+import json
 import os
+import sys
+import telnetlib
+import threading
+import time
+import urlparse
 
 import varnish
-from feaas import storage
+from feaas import autoscale, breaker, metrics, plans, pool, schedule, storage, victims
+from feaas import policy as cache_policy
 
 VCL_TEMPLATE_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
                                                  "misc", "default.vcl"))
@@ -15,18 +24,136 @@ VCL_TEMPLATE_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."
 DUMP_VCL_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
                                              "misc", "dump_vcls.bash"))
 
+STATS_SERVER_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
+                                                 "misc", "varnish_stats.py"))
+
+VCL_DIRECTORS = ("round-robin", "hash")
+
+VCL_NAME_PREFIX = "feaas"
+
+PURGE_WORKERS = 10
+
+WARM_URLS_LIMIT = 1000
+
+DRAIN_PERIOD = 30
+
+WARM_TIMEOUT = 5
+
+BREAKER_THRESHOLD = 5
+
+BREAKER_COOLDOWN = 30
+
+STATS_COUNTERS = ("client_req", "cache_hit", "cache_miss", "backend_req", "n_object")
+
+VARNISH_PARAMS = ("thread_pool_min", "thread_pool_max", "thread_pools",
+                  "thread_pool_add_delay", "workspace_backend", "workspace_client",
+                  "sess_workspace", "http_req_size", "http_resp_size")
+
+VCL_BACKEND_TEMPLATE = """backend app%(index)d {
+\t.host = "%(host)s";
+\t.port = "80";
+\t.host_header = "%(host)s";%(options)s
+}"""
+
+
+class VCLTemplate(object):
+    """
+    VCLTemplate keeps a VCL template file compiled in memory, in the quoted
+    format expected by vcl.inline. The file is read and escaped only once, and
+    reloaded whenever its modification time changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.content = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.content = self.compile()
+                    self.mtime = mtime
+        return self.content
+
+    def compile(self):
+        with codecs.open(self.path, encoding="utf-8") as f:
+            content = f.read()
+        return '"%s"' % self.escape(content).strip()
+
+    def escape(self, content):
+        content = content.replace("\\", "\\\\")
+        content = content.replace("\n", " ")
+        content = content.replace('"', r'\"')
+        return content.replace("\t", "")
+
+    def render(self, **params):
+        escaped = {}
+        for key, value in params.items():
+            if isinstance(value, basestring):
+                value = self.escape(value)
+            escaped[key] = value
+        return self.get() % escaped
+
+    def preview(self, **params):
+        """
+        Renders the template without compiling it, for display.
+        """
+        with codecs.open(self.path, encoding="utf-8") as f:
+            return f.read() % params
+
+
+default_template = VCLTemplate(VCL_TEMPLATE_FILE)
+
 
 class BaseManager(object):
 
     def __init__(self, storage):
         self.storage = storage
+        self.breaker = breaker.CircuitBreaker(
+            int(os.environ.get("BREAKER_THRESHOLD", BREAKER_THRESHOLD)),
+            int(os.environ.get("BREAKER_COOLDOWN", BREAKER_COOLDOWN)))
+        default = plans.default_name()
+        if default:
+            try:
+                plans.get(default)
+            except ValueError:
+                raise ValueError("default plan {0} is not in API_PLANS".format(default))
 
-    def new_instance(self, name):
+    def new_instance(self, name, plan=None):
+        if plan:
+            plans.get(plan)
+        else:
+            plan = plans.default_name()
         self._check_duplicate(name)
-        instance = storage.Instance(name)
+        instance = storage.Instance(name, plan=plan)
         self.storage.store_instance(instance)
         return instance
 
+    def instance_plan(self, instance):
+        """
+        Returns the plan of the instance. When the plan has been removed from
+        API_PLANS since the instance was created, new units use the default
+        plan instead (or no plan, when there isn't a valid one).
+        """
+        if not instance.plan:
+            return None
+        try:
+            return plans.get(instance.plan)
+        except ValueError:
+            default = plans.default_name()
+            sys.stderr.write("[ERROR] plan {0} of {1} not found, using the default "
+                             "plan ({2})\n".format(instance.plan, instance.name, default))
+        if not default:
+            return None
+        try:
+            return plans.get(default)
+        except ValueError:
+            sys.stderr.write("[ERROR] default plan {0} not found, using no plan\n".format(
+                default))
+
     def _check_duplicate(self, name):
         try:
             self.storage.retrieve_instance(name=name)
@@ -40,39 +167,373 @@ class BaseManager(object):
         self.storage.store_bind(bind)
 
     def unbind(self, name, app_host):
+        """
+        Marks the bind as being removed. The VCL is removed from the units by
+        the VCL writer, asynchronously.
+        """
+        self.storage.retrieve_instance(name=name)
+        binds = self.storage.retrieve_binds(instance_name=name, app_host=app_host)
+        for bind in binds:
+            self.storage.update_bind(bind, state="removing")
+
+    def write_vcl(self, unit, app_hosts, force=False, policy=None):
+        """
+        Pushes the VCL balancing between app_hosts, with the given caching
+        policy, to the given unit, unless the unit already runs it (according
+        to the hash of the last VCL applied to it). Returns True when the VCL
+        is sent and False when the push is skipped.
+
+        The VCL is loaded under a name derived from its content and activated
+        with vcl.use, so the switch is atomic. Only the last VCL_KEEP_LOADED
+        (default: 3) VCLs loaded by the API are kept in the unit.
+        """
+        vcl = self.instance_vcl(app_hosts, policy)
+        vcl_hash = hashlib.sha1(vcl.encode("utf-8")).hexdigest()
+        if not force and unit.vcl_hash == vcl_hash:
+            return False
+        name = "{0}_{1}".format(VCL_NAME_PREFIX, vcl_hash[:16])
+        handler = self._admin(unit)
+        try:
+            try:
+                handler.vcl_inline(name, vcl.encode("iso-8859-1", "ignore"))
+            except AssertionError as e:
+                if len(e.args) == 0 or "106 Already a VCL program named" not in e.args[0]:
+                    raise e
+            handler.vcl_use(name)
+            keep = int(os.environ.get("VCL_KEEP_LOADED", 3))
+            self._discard_vcls(handler, keep - 1)
+        finally:
+            handler.quit()
+        unit.vcl_hash = vcl_hash
+        self.storage.update_units([unit], vcl_hash=vcl_hash)
+        return True
+
+    def remove_vcl(self, unit):
+        handler = self._admin(unit)
+        try:
+            handler.vcl_use("boot")
+            self._discard_vcls(handler, 0)
+        finally:
+            handler.quit()
+        unit.vcl_hash = None
+        self.storage.update_units([unit], vcl_hash=None)
+
+    def is_unit_up(self, unit):
+        """
+        Returns whether the admin port of the unit accepts connections. The
+        probe goes through the circuit breaker of the unit, shared with the
+        varnishadm calls, so units that keep failing are reported as down
+        without being probed until the cooldown is over.
+        """
+        try:
+            self.breaker.call(unit.dns_name, self._connect_admin, unit)
+        except Exception:
+            return False
+        return True
+
+    def _connect_admin(self, unit):
+        client = telnetlib.Telnet(unit.dns_name, "6082", timeout=3)
+        client.close()
+
+    def _admin(self, unit):
+        """
+        Connects to the admin port of the unit through the circuit breaker of
+        the unit, so unreachable units fail fast instead of waiting for the
+        connection timeout on every call.
+        """
+        return self.breaker.call(unit.dns_name, varnish.VarnishHandler,
+                                 "{0}:6082".format(unit.dns_name), secret=unit.secret)
+
+    def purge(self, name, pattern=None, expression=None):
+        """
+        Bans cached objects in all started units of the instance, either by a
+        URL pattern or by a full ban expression. Returns the result of each
+        unit and the overall latency, in seconds.
+        """
+        if not expression:
+            if not pattern:
+                raise ValueError("pattern or expression is required")
+            expression = 'req.url ~ "{0}"'.format(pattern.replace('"', r'\"'))
+        if "\n" in expression or "\r" in expression:
+            raise ValueError("invalid ban expression")
         instance = self.storage.retrieve_instance(name=name)
-        for unit in instance.units:
-            self.remove_vcl(unit.dns_name, unit.secret)
-        bind = storage.Bind(app_host, instance)
-        self.storage.remove_bind(bind)
+        units = [u for u in instance.units if u.state == "started"]
+        start = time.time()
+        results = pool.BoundedPool(PURGE_WORKERS).map(
+            lambda unit: self._ban_unit(unit, expression), units)
+        units_result = []
+        for result in results:
+            if result.error:
+                error_msg = " ".join([str(arg) for arg in result.error.args])
+                units_result.append({"unit": result.item.dns_name, "ok": False,
+                                     "error": error_msg})
+            else:
+                units_result.append({"unit": result.item.dns_name, "ok": True,
+                                     "latency": result.value})
+        return {"expression": expression, "units": units_result,
+                "latency": time.time() - start}
 
-    def write_vcl(self, instance_addr, secret, app_addr):
-        vcl = self.vcl_template() % {"app_host": app_addr}
+    def _ban_unit(self, unit, expression):
+        start = time.time()
+        handler = self._admin(unit)
         try:
-            handler = varnish.VarnishHandler("{0}:6082".format(instance_addr),
-                                             secret=secret)
-            handler.vcl_inline("feaas", vcl.encode("iso-8859-1", "ignore"))
-            handler.vcl_use("feaas")
+            handler.ban(expression)
+        finally:
             handler.quit()
-        except AssertionError as e:
-            if len(e.args) > 0 and "106 Already a VCL program named" in e.args[0]:
-                return
-            raise e
-
-    def remove_vcl(self, instance_addr, secret):
-        handler = varnish.VarnishHandler("{0}:6082".format(instance_addr),
-                                         secret=secret)
-        handler.vcl_use("boot")
-        handler.vcl_discard("feaas")
-        handler.quit()
+        return time.time() - start
+
+    def set_params(self, name, params):
+        """
+        Validates and stores the values of Varnish parameters for the
+        instance. Values are merged with the ones stored before, and the
+        parameter writer sets them in all units with param.set.
+        """
+        if not params:
+            raise ValueError("at least one parameter is required")
+        validated = {}
+        for param, value in params.items():
+            if param not in VARNISH_PARAMS:
+                raise ValueError("{0} is not a tunable parameter".format(param))
+            try:
+                validated[param] = int(value)
+            except ValueError:
+                validated[param] = -1
+            if validated[param] < 0:
+                raise ValueError("invalid value for {0}: {1}".format(param, value))
+        self.storage.retrieve_instance(name=name)
+        self.storage.store_varnish_params(name, validated)
+        return validated
+
+    def apply_params(self, unit, params):
+        """
+        Reads the given parameters from the unit with param.show and sets the
+        ones that differ from the desired value. Returns the names of the
+        parameters that had to be set.
+        """
+        handler = self._admin(unit)
+        changed = []
+        try:
+            for param, value in sorted(params.items()):
+                _, content = handler.param_show(param)
+                lines = content.splitlines()
+                parts = lines[0].split() if lines else []
+                if len(parts) < 2 or parts[1] != str(value):
+                    handler.param_set(param, value)
+                    changed.append(param)
+        finally:
+            handler.quit()
+        return changed
+
+    def get_warm_urls(self, name):
+        """
+        Returns the hot URLs of the instance and the results of the last
+        warm-up of each unit.
+        """
+        self.storage.retrieve_instance(name=name)
+        stored = self.storage.retrieve_warm_urls(instance_name=name)
+        urls = stored[0]["urls"] if stored else []
+        return {"urls": urls, "warmups": self.storage.retrieve_warmups(instance_name=name)}
+
+    def get_vcl_retries(self, name):
+        """
+        Returns the units of the instance waiting for a VCL retry, including
+        the dead-lettered ones, with the number of attempts and last error.
+        """
+        self.storage.retrieve_instance(name=name)
+        return self.storage.retrieve_vcl_retries(instance_name=name)
+
+    def requeue_vcl_retries(self, name, unit_id=None):
+        self.storage.retrieve_instance(name=name)
+        return self.storage.requeue_vcl_retries(name, unit_id)
+
+    def set_warm_urls(self, name, urls):
+        """
+        Stores the list of hot URLs of the instance, replayed against new
+        units before they start serving. URLs must be absolute, so requests
+        carry the Host header used by clients.
+        """
+        if not isinstance(urls, list):
+            raise ValueError("urls must be a list")
+        if len(urls) > WARM_URLS_LIMIT:
+            raise ValueError("at most {0} urls are allowed".format(WARM_URLS_LIMIT))
+        for url in urls:
+            parsed = urlparse.urlparse(url) if isinstance(url, basestring) else None
+            if not parsed or parsed.scheme not in ("http", "https") or not parsed.netloc:
+                raise ValueError("invalid url: {0}".format(url))
+        self.storage.retrieve_instance(name=name)
+        self.storage.store_warm_urls(name, urls)
+        return urls
+
+    def warm_unit(self, unit, urls, max_workers=10, timeout=WARM_TIMEOUT, deadline=None):
+        """
+        Requests the given URLs from the unit, with at most max_workers
+        requests at a time, so they get cached. Returns the number of URLs,
+        how many of them were successfully fetched, the coverage (the
+        fraction fetched) and the duration of the warm-up, in seconds.
+
+        When a deadline (a timestamp) is given, URLs that aren't requested by
+        then are skipped, and count as not fetched.
+        """
+        start = time.time()
+
+        def warm(url):
+            url_timeout = timeout
+            if deadline is not None:
+                url_timeout = min(timeout, deadline - time.time())
+                if url_timeout <= 0:
+                    return None
+            return self._warm_url(unit, url, url_timeout)
+
+        results = pool.BoundedPool(max_workers).map(warm, urls)
+        warmed = len([r for r in results
+                      if not r.error and r.value is not None and r.value < 400])
+        coverage = 1.0
+        if urls:
+            coverage = float(warmed) / len(urls)
+        return {"urls": len(urls), "warmed": warmed, "coverage": coverage,
+                "duration": time.time() - start}
+
+    def _warm_url(self, unit, url, timeout):
+        parsed = urlparse.urlparse(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        h = httplib2.Http(timeout=timeout)
+        resp, _ = h.request("http://{0}:8080{1}".format(unit.dns_name, path),
+                            headers={"Host": parsed.netloc})
+        return resp.status
+
+    def unit_stats(self, unit):
+        """
+        Returns the Varnish counters of the unit (see STATS_COUNTERS), read from
+        the stats endpoint of the unit, which serves the output of varnishstat
+        -j in the port STATS_PORT (default: 8081) to clients that know the
+        secret of the unit.
+        """
+        url = "http://{0}:{1}/stats".format(unit.dns_name,
+                                            os.environ.get("STATS_PORT", "8081"))
+        h = httplib2.Http(timeout=WARM_TIMEOUT)
+        resp, content = h.request(url, headers={"X-Varnish-Secret": unit.secret})
+        if resp.status != 200:
+            raise ValueError("stats endpoint returned {0}".format(resp.status))
+        stats = json.loads(content)
+        counters = {}
+        for name, counter in stats.items():
+            name = name.split(".")[-1]
+            if name in STATS_COUNTERS:
+                counters[name] = int(counter["value"])
+        return counters
+
+    def get_metrics(self, name, minutes=60, step=None):
+        """
+        Returns the metrics of the instance in the last minutes. When step is
+        given (in seconds), points are merged into buckets of step seconds.
+        Steps that are a multiple of metrics.ROLLUP_STEP are served from the
+        hourly rollups, which are kept for longer than the raw points.
+        """
+        if minutes < 1:
+            raise ValueError("minutes must be a positive integer")
+        if step is not None and step < 1:
+            raise ValueError("step must be a positive integer")
+        self.storage.retrieve_instance(name=name)
+        since = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes)
+        if step and step % metrics.ROLLUP_STEP == 0:
+            buckets = self.storage.retrieve_metric_rollups(
+                name, since=metrics.bucket_start(since, metrics.ROLLUP_STEP))
+            points = [metrics.from_rollup(bucket) for bucket in buckets]
+            if step > metrics.ROLLUP_STEP:
+                points = metrics.downsample(points, step)
+            return points
+        points = self.storage.retrieve_metrics(name, since=since)
+        if step:
+            points = metrics.downsample(points, step)
+        return points
+
+    def _discard_vcls(self, handler, keep):
+        """
+        Discards the inactive VCLs loaded by the API, except for the last keep
+        ones. vcl.list lists configurations in the order they were loaded.
+        """
+        _, content = handler.fetch("vcl.list")
+        loaded = []
+        for line in content.splitlines():
+            parts = line.split()
+            if len(parts) < 3 or parts[0] != "available":
+                continue
+            if parts[-1].startswith(VCL_NAME_PREFIX):
+                loaded.append(parts[-1])
+        for name in loaded[:max(len(loaded) - keep, 0)]:
+            try:
+                handler.vcl_discard(name)
+            except AssertionError:
+                pass
 
     def vcl_template(self):
-        with codecs.open(VCL_TEMPLATE_FILE, encoding="utf-8") as f:
-            content = f.read()
-            content = content.replace("\n", " ")
-            content = content.replace('"', r'\"')
-            content = content.replace("\t", "")
-            return '"%s"' % content.strip()
+        return default_template.get()
+
+    def render_vcl(self, **params):
+        return default_template.render(**params)
+
+    def instance_vcl(self, app_hosts, policy=None):
+        return self.render_vcl(**self.vcl_params(app_hosts, policy))
+
+    def vcl_params(self, app_hosts, policy=None):
+        """
+        Returns the template parameters for the VCL of an instance: one
+        backend for each application host, all of them behind the director
+        defined by the VCL_DIRECTOR environment variable (round-robin or hash),
+        and the code compiled from the caching policy of the instance,
+        including backend health probes and grace and saint modes.
+        """
+        director = os.environ.get("VCL_DIRECTOR", "round-robin")
+        if director not in VCL_DIRECTORS:
+            raise ValueError("{0} is not a valid director".format(director))
+        backends = []
+        members = []
+        for i, host in enumerate(app_hosts):
+            options = cache_policy.backend_options(policy, host)
+            backends.append(VCL_BACKEND_TEMPLATE % {"index": i, "host": host,
+                                                    "options": options})
+            member = "\t{ .backend = app%d; " % i
+            if director == "hash":
+                member += ".weight = 1; "
+            members.append(member + "}")
+        params = {"backends": "\n\n".join(backends), "director": director,
+                  "director_members": "\n".join(members)}
+        params.update(cache_policy.vcl_params(policy))
+        return params
+
+    def get_cache_policy(self, name):
+        self.storage.retrieve_instance(name=name)
+        stored = self.storage.retrieve_cache_policy(name)
+        if not stored:
+            return {}
+        return stored["policy"]
+
+    def set_cache_policy(self, name, policy):
+        """
+        Validates and stores the caching policy of the instance. The VCL
+        writer pushes the new VCL to the units of the instance, asynchronously.
+        """
+        policy = cache_policy.validate(policy)
+        self.storage.retrieve_instance(name=name)
+        self.storage.store_cache_policy(name, policy)
+        return policy
+
+    def preview_vcl(self, name, policy=None):
+        """
+        Returns the VCL of the instance, as it would be written to the units
+        with the given caching policy (or the stored one).
+        """
+        if policy is None:
+            policy = self.get_cache_policy(name)
+        else:
+            policy = cache_policy.validate(policy)
+            self.storage.retrieve_instance(name=name)
+        binds = self.storage.retrieve_binds(instance_name=name,
+                                            state={"$in": ["creating", "created"]})
+        app_hosts = sorted(set([b.app_host for b in binds]))
+        return default_template.preview(**self.vcl_params(app_hosts, policy))
 
     def remove_instance(self, name):
         instance = self.storage.retrieve_instance(name=name)
@@ -81,43 +542,152 @@ class BaseManager(object):
 
     def info(self, name):
         instance = self.storage.retrieve_instance(name=name)
+        units = [u for u in instance.units
+                 if u.state not in ("draining", "dead")] or instance.units
         return [{"label": "Address",
-                 "value": instance.units[0].dns_name}]
+                 "value": units[0].dns_name}]
 
     def status(self, name):
         instance = self.storage.retrieve_instance(name=name)
         return instance.state
 
     def scale_instance(self, name, quantity):
+        """
+        Requests the instance to be scaled to the given quantity of units.
+        Requests made while the instance is scaling, or before the previous
+        request is processed, replace the desired quantity of the pending
+        scale job.
+        """
         if quantity < 1:
             raise ValueError("quantity must be a positive integer")
         instance = self.storage.retrieve_instance(name=name)
-        if instance.state == "scaling":
-            raise ValueError("instance is already scaling")
-        if quantity == len(instance.units):
+        jobs = self.storage.retrieve_scale_jobs(instance=name,
+                                                state={"$in": ["pending", "processing"]})
+        if not jobs and quantity == len(instance.units):
             raise ValueError("instance already have %d units" % quantity)
         self.storage.store_scale_job({"instance": name, "quantity": quantity,
                                       "state": "pending"})
 
-    def get_user_data(self, secret):
+    def get_autoscale(self, name):
+        """
+        Returns the autoscaling configuration of the instance, along with the
+        last decision of the autoscaler, or an empty dict when autoscaling is
+        disabled.
+        """
+        self.storage.retrieve_instance(name=name)
+        stored = self.storage.retrieve_autoscale(instance_name=name)
+        if not stored:
+            return {}
+        return stored[0]
+
+    def set_autoscale(self, name, config):
+        config = autoscale.validate(config)
+        self.storage.retrieve_instance(name=name)
+        self.storage.store_autoscale(name, config)
+        return config
+
+    def disable_autoscale(self, name):
+        self.storage.retrieve_instance(name=name)
+        self.storage.remove_autoscale(name)
+
+    def get_schedule(self, name):
+        """
+        Returns the scaling schedule of the instance, or an empty dict when
+        it has none.
+        """
+        self.storage.retrieve_instance(name=name)
+        stored = self.storage.retrieve_schedules(instance_name=name)
+        if not stored:
+            return {}
+        return stored[0]
+
+    def set_schedule(self, name, scaling_schedule):
+        scaling_schedule = schedule.validate(scaling_schedule)
+        self.storage.retrieve_instance(name=name)
+        self.storage.store_schedule(name, scaling_schedule)
+        return scaling_schedule
+
+    def remove_schedule(self, name):
+        self.storage.retrieve_instance(name=name)
+        self.storage.remove_schedule(name)
+
+    def select_victims(self, instance, quantity):
+        """
+        Returns the units of the instance that should be removed when scaling
+        it down by quantity units (see feaas.victims).
+        """
+        return victims.select(self, instance.units, quantity)
+
+    def drain_units(self, units):
+        """
+        Marks the units as draining, removes them from routing (see
+        unroute_units) and waits for the drain period (DRAIN_PERIOD, in
+        seconds, default: 30), so in-flight requests finish before they're
+        destroyed.
+        """
+        if not units:
+            return
+        for unit in units:
+            unit.state = "draining"
+        self.storage.update_units(units, state="draining")
+        self.unroute_units(units)
+        time.sleep(float(os.environ.get("DRAIN_PERIOD", DRAIN_PERIOD)))
+
+    def unroute_units(self, units):
+        """
+        Stops sending new traffic to the units. Units are reached through the
+        address returned by info, which skips draining units, so there's
+        nothing else to do here. Managers that put units behind a load
+        balancer deregister them from it.
+        """
+        pass
+
+    def get_user_data(self, secret, plan=None):
+        """
+        Returns the user data of new units. When a plan is given, the cache
+        storage of Varnish is sized according to it (replacing VARNISH_STORAGE
+        in custom user data).
+
+        The default user data also installs the stats endpoint read by
+        unit_stats (misc/varnish_stats.py), started on boot. Custom user data
+        must set it up too, for metrics and autoscaling to work.
+        """
+        varnish_storage = None
+        if plan:
+            varnish_storage = plans.storage(plan)
         if "USER_DATA_URL" in os.environ:
             url = os.environ.get("USER_DATA_URL")
             h = httplib2.Http()
             _, user_data = h.request(url)
-            return user_data.replace("VARNISH_SECRET_KEY", secret)
+            user_data = user_data.replace("VARNISH_SECRET_KEY", secret)
+            if varnish_storage:
+                user_data = user_data.replace("VARNISH_STORAGE", varnish_storage)
+            return user_data
         user_data_lines = None
         packages = os.environ.get("API_PACKAGES")
         if packages:
             user_data_lines = ["apt-get update",
                                "apt-get install -y {0}".format(packages),
                                "sed -i -e 's/-T localhost:6082/-T :6082/' /etc/default/varnish",
-                               "sed -i -e 's/-a :6081/-a :8080/' /etc/default/varnish",
-                               "echo {0} > /etc/varnish/secret".format(secret),
-                               "service varnish restart",
-                               "cat > /etc/cron.hourly/dump_vcls <<'END'",
-                               open(DUMP_VCL_FILE).read(),
-                               "END",
-                               "chmod +x /etc/cron.hourly/dump_vcls"]
+                               "sed -i -e 's/-a :6081/-a :8080/' /etc/default/varnish"]
+            if varnish_storage:
+                user_data_lines.append("sed -i -e 's|-s [^ \"]*|-s {0}|' "
+                                       "/etc/default/varnish".format(varnish_storage))
+            user_data_lines += ["echo {0} > /etc/varnish/secret".format(secret),
+                                "service varnish restart",
+                                "cat > /etc/cron.hourly/dump_vcls <<'END'",
+                                open(DUMP_VCL_FILE).read(),
+                                "END",
+                                "chmod +x /etc/cron.hourly/dump_vcls",
+                                "cat > /usr/local/bin/varnish_stats <<'END'",
+                                open(STATS_SERVER_FILE).read(),
+                                "END",
+                                "chmod +x /usr/local/bin/varnish_stats"]
+            stats_command = "/usr/local/bin/varnish_stats {0}".format(
+                os.environ.get("STATS_PORT", "8081"))
+            user_data_lines += ["echo '@reboot root {0}' > /etc/cron.d/varnish_stats".format(
+                                    stats_command),
+                                "nohup {0} > /dev/null 2>&1 &".format(stats_command)]
         if user_data_lines:
             return "\n".join(user_data_lines) + "\n"
 
@@ -129,3 +699,22 @@ class BaseManager(object):
 
     def physical_scale(self, instance, quantity):
         raise NotImplementedError()
+
+    def replace_unit(self, instance):
+        """
+        Provisions a new unit for the instance, to replace a dead one, and
+        returns it. The VCL writer binds it once it's up.
+        """
+        return self._add_units(instance, 1)[0]
+
+    def remove_unit(self, instance, unit):
+        raise NotImplementedError()
+
+    def _add_units(self, instance, quantity):
+        raise NotImplementedError()
+
+    def _forget_unit(self, instance, unit):
+        for u in list(instance.units):
+            if u.id == unit.id:
+                instance.remove_unit(u)
+        self.storage.remove_unit(unit)
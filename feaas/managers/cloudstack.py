@@ -49,19 +49,24 @@ class CloudStackManager(managers.BaseManager):
         for i in xrange(quantity):
             unit = self._deploy_vm(instance)
             instance.add_unit(unit)
+            self.storage.store_unit(unit)
             units.append(unit)
-        self.storage.store_instance(instance)
         return units
 
     def _deploy_vm(self, instance):
         secret = unicode(uuid.uuid4())
         group = os.environ.get("CLOUDSTACK_GROUP", "feaas")
+        plan = self.instance_plan(instance)
+        if plan and plan.get("offering"):
+            offering = plan["offering"]
+        else:
+            offering = self.get_env("CLOUDSTACK_SERVICE_OFFERING_ID")
         data = {
             "group": group,
             "templateid": self.get_env("CLOUDSTACK_TEMPLATE_ID"),
             "zoneid": self.get_env("CLOUDSTACK_ZONE_ID"),
-            "serviceofferingid": self.get_env("CLOUDSTACK_SERVICE_OFFERING_ID"),
-            "userdata": self.client.encode_user_data(self.get_user_data(secret)),
+            "serviceofferingid": offering,
+            "userdata": self.client.encode_user_data(self.get_user_data(secret, plan)),
         }
         project_id = os.environ.get("CLOUDSTACK_PROJECT_ID")
         if project_id:
@@ -107,15 +112,19 @@ class CloudStackManager(managers.BaseManager):
         return vms["virtualmachine"][0]
 
     def _remove_units(self, instance, quantity):
-        units = []
-        for i in xrange(quantity):
-            self._destroy_vm(instance.units[i])
-            units.append(instance.units[i])
+        units = self.select_victims(instance, quantity)
+        self.drain_units(units)
+        for unit in units:
+            self._destroy_vm(unit)
         for unit in units:
             instance.remove_unit(unit)
-        self.storage.store_instance(instance)
+            self.storage.remove_unit(unit)
         return units
 
+    def remove_unit(self, instance, unit):
+        self._destroy_vm(unit)
+        self._forget_unit(instance, unit)
+
     def _destroy_vm(self, unit):
         try:
             self.client.destroyVirtualMachine({"id": unit.id})
@@ -48,19 +48,24 @@ class EC2Manager(managers.BaseManager):
         self._add_units(instance, 1)
         return instance
 
-    def _run_unit(self):
+    def _run_unit(self, instance):
         ami_id = os.environ.get("AMI_ID")
         subnet_id = os.environ.get("SUBNET_ID")
         secret = unicode(uuid.uuid4())
+        plan = self.instance_plan(instance)
+        kwargs = {}
+        if plan and plan.get("instance_type"):
+            kwargs["instance_type"] = plan["instance_type"]
         reservation = self.connection.run_instances(image_id=ami_id,
                                                     subnet_id=subnet_id,
-                                                    user_data=self._user_data(secret))
+                                                    user_data=self._user_data(secret, plan),
+                                                    **kwargs)
         ec2_instance = reservation.instances[0]
         return storage.Unit(id=ec2_instance.id, dns_name=ec2_instance.dns_name,
                             secret=secret, state="creating")
 
-    def _user_data(self, secret):
-        return self.get_user_data(secret)
+    def _user_data(self, secret, plan=None):
+        return self.get_user_data(secret, plan)
 
     def terminate_instance(self, name):
         instance = self.storage.retrieve_instance(name=name)
@@ -68,6 +73,10 @@ class EC2Manager(managers.BaseManager):
             self._terminate_unit(unit)
         return instance
 
+    def remove_unit(self, instance, unit):
+        self._terminate_unit(unit)
+        self._forget_unit(instance, unit)
+
     def _terminate_unit(self, unit):
         try:
             self.connection.terminate_instances(instance_ids=[unit.id])
@@ -84,18 +93,18 @@ class EC2Manager(managers.BaseManager):
     def _add_units(self, instance, quantity):
         units = []
         for i in xrange(quantity):
-            unit = self._run_unit()
+            unit = self._run_unit(instance)
             instance.add_unit(unit)
+            self.storage.store_unit(unit)
             units.append(unit)
-        self.storage.store_instance(instance)
         return units
 
     def _remove_units(self, instance, quantity):
-        units = []
-        for i in xrange(quantity):
-            self._terminate_unit(instance.units[i])
-            units.append(instance.units[i])
+        units = self.select_victims(instance, quantity)
+        self.drain_units(units)
+        for unit in units:
+            self._terminate_unit(unit)
         for unit in units:
             instance.remove_unit(unit)
-        self.storage.store_instance(instance)
+            self.storage.remove_unit(unit)
         return units
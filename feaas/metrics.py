@@ -0,0 +1,93 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import calendar
+import datetime
+
+COUNTERS = (("requests", "client_req"), ("hits", "cache_hit"), ("misses", "cache_miss"),
+            ("backend_fetches", "backend_req"))
+
+SUMS = tuple([name for name, _ in COUNTERS])
+
+GAUGES = ("objects", "units")
+
+ROLLUP_STEP = 3600
+
+
+def new_point(**fields):
+    point = {"objects": 0, "units": 0}
+    point.update([(name, 0) for name in SUMS])
+    point.update(fields)
+    return point
+
+
+def add_sample(point, counters, previous=None):
+    """
+    Adds the counters of a unit to the point. Request counters are added as
+    the difference to the previous sample of the unit, so there must be a
+    previous sample; a counter lower than before means that Varnish was
+    restarted, and its whole value is added.
+    """
+    point["units"] += 1
+    point["objects"] += counters.get("n_object", 0)
+    if previous is None:
+        return
+    for name, counter in COUNTERS:
+        delta = counters.get(counter, 0) - previous.get(counter, 0)
+        if delta < 0:
+            delta = counters.get(counter, 0)
+        point[name] += delta
+
+
+def downsample(points, step):
+    """
+    Merges points in buckets of step seconds: request counters are summed,
+    gauges (objects and units) are averaged and the hit ratio is recomputed.
+    """
+    buckets = []
+    for point in points:
+        start = bucket_start(point["timestamp"], step)
+        if not buckets or buckets[-1]["timestamp"] != start:
+            buckets.append(new_point(timestamp=start, samples=0))
+        bucket = buckets[-1]
+        bucket["samples"] += 1
+        for name in SUMS + GAUGES:
+            bucket[name] += point.get(name, 0)
+    return [from_rollup(b) for b in buckets]
+
+
+def bucket_start(timestamp, step):
+    epoch = calendar.timegm(timestamp.timetuple())
+    return datetime.datetime.utcfromtimestamp(epoch - epoch % step)
+
+
+def rollup(point):
+    """
+    Returns the start of the bucket of ROLLUP_STEP seconds of the point, and
+    the increments that add the point to the bucket: request counters and
+    gauges are summed, along with the number of samples.
+    """
+    increments = dict([(name, point.get(name, 0)) for name in SUMS + GAUGES])
+    increments["samples"] = 1
+    return bucket_start(point["timestamp"], ROLLUP_STEP), increments
+
+
+def from_rollup(bucket):
+    """
+    Turns a bucket of summed points into a point: gauges are averaged over
+    the samples of the bucket and the hit ratio is recomputed.
+    """
+    point = dict(bucket)
+    samples = point.pop("samples")
+    for name in GAUGES:
+        point[name] = float(point[name]) / samples
+    point["hit_ratio"] = hit_ratio(point)
+    return point
+
+
+def hit_ratio(point):
+    lookups = point["hits"] + point["misses"]
+    if not lookups:
+        return None
+    return float(point["hits"]) / lookups
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+# Serves the output of varnishstat -j in /stats, for the metrics collector.
+# Requests must carry the secret of the admin port of Varnish in the
+# X-Varnish-Secret header.
+
+import BaseHTTPServer
+import subprocess
+import sys
+
+SECRET_FILE = "/etc/varnish/secret"
+
+
+def same_secret(given, expected):
+    if len(given) != len(expected):
+        return False
+    result = 0
+    for x, y in zip(given, expected):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    secret = None
+
+    def do_GET(self):
+        given = self.headers.get("X-Varnish-Secret", "")
+        if not self.secret or not same_secret(given, self.secret):
+            self.send_error(401)
+            return
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+        try:
+            content = subprocess.check_output(["varnishstat", "-j"])
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    port = 8081
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    secret_file = SECRET_FILE
+    if len(sys.argv) > 2:
+        secret_file = sys.argv[2]
+    with open(secret_file) as f:
+        StatsHandler.secret = f.read().strip()
+    if not StatsHandler.secret:
+        sys.stderr.write("[ERROR] {0} is empty\n".format(secret_file))
+        sys.exit(1)
+    BaseHTTPServer.HTTPServer(("", port), StatsHandler).serve_forever()
@@ -0,0 +1,68 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import re
+
+STORAGE_REGEXP = re.compile(r"^(malloc|file),[\w/.,-]+$")
+
+DEFAULT_MEMORY_RATIO = 0.75
+
+
+def load():
+    """
+    Returns the service plans, defined by the API_PLANS environment variable
+    as a JSON list. Each plan has a name, a description, the memory of the
+    VM (in MB), and the instance type (EC2) or service offering (CloudStack)
+    used for its units:
+
+        [{"name": "small", "description": "1.7GB of memory", "memory": 1740,
+          "instance_type": "m1.small", "offering": "a9d3c5c1"}]
+
+    A plan may also define the Varnish storage explicitly, in the format
+    expected by varnishd -s (e.g. "file,/var/lib/varnish/storage.bin,20G").
+    """
+    content = os.environ.get("API_PLANS")
+    if not content:
+        return []
+    plans = json.loads(content)
+    for plan in plans:
+        if "storage" in plan and not STORAGE_REGEXP.match(plan["storage"]):
+            raise ValueError("invalid storage for plan {0}: {1}".format(plan["name"],
+                                                                        plan["storage"]))
+    return plans
+
+
+def get(name):
+    for plan in load():
+        if plan["name"] == name:
+            return plan
+    raise ValueError("invalid plan: {0}".format(name))
+
+
+def default_name():
+    """
+    Returns the name of the plan used by instances created without a plan:
+    the one in the DEFAULT_PLAN environment variable, or the first plan.
+    """
+    if "DEFAULT_PLAN" in os.environ:
+        return os.environ["DEFAULT_PLAN"]
+    plans = load()
+    if plans:
+        return plans[0]["name"]
+
+
+def storage(plan):
+    """
+    Returns the Varnish storage of the plan: the explicit one, or a malloc
+    storage sized as a fraction (STORAGE_MEMORY_RATIO, default: 0.75) of the
+    memory of the plan, so bigger plans get proportionally bigger caches.
+    """
+    if plan.get("storage"):
+        return plan["storage"]
+    if not plan.get("memory"):
+        return None
+    ratio = float(os.environ.get("STORAGE_MEMORY_RATIO", DEFAULT_MEMORY_RATIO))
+    return "malloc,{0}M".format(int(plan["memory"] * ratio))
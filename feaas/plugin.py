@@ -5,7 +5,9 @@
 # license that can be found in the LICENSE file.
 
 import argparse
+import json
 import os
+import urllib
 import urllib2
 import sys
 
@@ -52,6 +54,46 @@ def get_scale_args(args):
     return parsed_args.instance, parsed_args.quantity
 
 
+def purge(args):
+    instance, data = get_purge_args(args)
+    try:
+        result = proxy_request(instance, "/resources/{}/purge".format(instance),
+                               body=urllib.urlencode(data))
+    except urllib2.HTTPError as e:
+        result = e
+    body = result.read()
+    if result.getcode() not in (200, 500):
+        sys.stderr.write("ERROR: " + body.rstrip("\n") + "\n")
+        sys.exit(1)
+    data = json.loads(body)
+    for unit in data["units"]:
+        if unit["ok"]:
+            msg = "{}: purged in {:.0f}ms\n"
+            sys.stdout.write(msg.format(unit["unit"], unit["latency"] * 1000))
+        else:
+            sys.stdout.write("{}: failed: {}\n".format(unit["unit"], unit["error"]))
+    msg = "Purged {} in {:.0f}ms\n"
+    sys.stdout.write(msg.format(data["expression"], data["latency"] * 1000))
+    if result.getcode() != 200:
+        sys.exit(1)
+
+
+def get_purge_args(args):
+    parser = argparse.ArgumentParser("purge")
+    parser.add_argument("-i", "--instance")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-p", "--pattern")
+    group.add_argument("-e", "--expression")
+    parsed_args = parser.parse_args(args)
+    if parsed_args.instance is None or (parsed_args.pattern is None and
+                                        parsed_args.expression is None):
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+    if parsed_args.pattern is not None:
+        return parsed_args.instance, {"pattern": parsed_args.pattern}
+    return parsed_args.instance, {"expression": parsed_args.expression}
+
+
 def get_env(name):
     env = os.environ.get(name)
     if not env:
@@ -75,6 +117,7 @@ def proxy_request(instance_name, path, body=None):
 def get_command(name):
     commands = {
         "scale": scale,
+        "purge": purge,
     }
     command = commands.get(name)
     if not command:
@@ -0,0 +1,196 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import re
+
+POLICY_FIELDS = ("ttls", "strip_cookies", "strip_query_params", "grace",
+                 "healthy_grace", "saint_mode", "probe", "max_connections")
+
+PROBE_DEFAULTS = {"url": "/", "interval": 5, "timeout": 2, "window": 8, "threshold": 3}
+
+MAX_RULES = 50
+
+MAX_PROBE_WINDOW = 64
+
+SAINT_MODE_RESTARTS = 2
+
+QUERY_PARAM_REGEXP = re.compile(r"^[A-Za-z0-9_.\-]+$")
+
+
+def validate(policy):
+    """
+    Validates a caching policy, raising ValueError when it's invalid, and
+    returns a copy containing only the known fields. A policy looks like:
+
+        {"ttls": [{"url": "^/static/", "ttl": 86400}],
+         "strip_cookies": ["^/static/", "\\.png$"],
+         "strip_query_params": ["utm_source", "utm_medium"],
+         "grace": 3600,
+         "healthy_grace": 30,
+         "saint_mode": 20,
+         "probe": {"url": "/healthcheck", "interval": 5, "timeout": 2,
+                   "window": 8, "threshold": 3},
+         "max_connections": 100}
+
+    TTLs and grace periods are integers, in seconds. URL patterns are regular
+    expressions matched against req.url. Stale objects are served for up to
+    healthy_grace seconds while the backends are healthy, and for up to grace
+    seconds when the probe marks them as sick. Backends that answer with a
+    5xx status are skipped for the object during saint_mode seconds, and
+    GET and HEAD requests are retried; other methods aren't, as they may not
+    be safe to repeat.
+    """
+    if not isinstance(policy, dict):
+        raise ValueError("cache policy must be an object")
+    for field in policy:
+        if field not in POLICY_FIELDS:
+            raise ValueError("unknown cache policy field: {0}".format(field))
+    validated = {}
+    if "ttls" in policy:
+        rules = _check_list(policy["ttls"], "ttls")
+        validated["ttls"] = []
+        for rule in rules:
+            if not isinstance(rule, dict) or set(rule.keys()) != set(["url", "ttl"]):
+                raise ValueError("each rule in ttls must have url and ttl")
+            validated["ttls"].append({"url": _check_url(rule["url"], "ttls"),
+                                      "ttl": _check_integer(rule["ttl"], "ttl")})
+    if "strip_cookies" in policy:
+        urls = _check_list(policy["strip_cookies"], "strip_cookies")
+        validated["strip_cookies"] = [_check_url(url, "strip_cookies") for url in urls]
+    if "strip_query_params" in policy:
+        params = _check_list(policy["strip_query_params"], "strip_query_params")
+        for param in params:
+            if not isinstance(param, basestring) or not QUERY_PARAM_REGEXP.match(param):
+                raise ValueError("invalid query parameter: {0}".format(param))
+        validated["strip_query_params"] = list(params)
+    if "grace" in policy:
+        validated["grace"] = _check_integer(policy["grace"], "grace")
+    if "healthy_grace" in policy:
+        validated["healthy_grace"] = _check_integer(policy["healthy_grace"], "healthy_grace")
+        if "probe" not in policy or "grace" not in policy:
+            raise ValueError("healthy_grace requires probe and grace")
+        if validated["healthy_grace"] > validated["grace"]:
+            raise ValueError("healthy_grace must not be greater than grace")
+    if "saint_mode" in policy:
+        validated["saint_mode"] = _check_integer(policy["saint_mode"], "saint_mode", 1)
+    if "probe" in policy:
+        validated["probe"] = _check_probe(policy["probe"])
+    if "max_connections" in policy:
+        validated["max_connections"] = _check_integer(policy["max_connections"],
+                                                      "max_connections", 1)
+    return validated
+
+
+def _check_list(value, field):
+    if not isinstance(value, list):
+        raise ValueError("{0} must be a list".format(field))
+    if len(value) > MAX_RULES:
+        raise ValueError("{0} must have at most {1} items".format(field, MAX_RULES))
+    return value
+
+
+def _check_url(url, field):
+    if not isinstance(url, basestring) or not url:
+        raise ValueError("invalid URL pattern in {0}".format(field))
+    if '"' in url or "\n" in url or "\r" in url:
+        raise ValueError("invalid URL pattern in {0}: {1}".format(field, url))
+    try:
+        re.compile(url)
+    except re.error:
+        raise ValueError("invalid URL pattern in {0}: {1}".format(field, url))
+    return url
+
+
+def _check_integer(value, field, minimum=0):
+    if isinstance(value, bool) or not isinstance(value, (int, long)) or value < minimum:
+        if minimum > 0:
+            raise ValueError("{0} must be a positive integer".format(field))
+        raise ValueError("{0} must be a non-negative integer".format(field))
+    return value
+
+
+def _check_probe(probe):
+    if not isinstance(probe, dict):
+        raise ValueError("probe must be an object")
+    for field in probe:
+        if field not in PROBE_DEFAULTS:
+            raise ValueError("unknown probe field: {0}".format(field))
+    validated = dict(PROBE_DEFAULTS)
+    validated.update(probe)
+    url = validated["url"]
+    if not isinstance(url, basestring) or not url.startswith("/") or \
+            re.search(r'[\s"]', url):
+        raise ValueError("invalid probe url: {0}".format(url))
+    for field in ("interval", "timeout", "window", "threshold"):
+        _check_integer(validated[field], "probe " + field, 1)
+    if validated["window"] > MAX_PROBE_WINDOW:
+        raise ValueError("probe window must be at most {0}".format(MAX_PROBE_WINDOW))
+    if validated["threshold"] > validated["window"]:
+        raise ValueError("probe threshold must not be greater than probe window")
+    return validated
+
+
+def vcl_params(policy):
+    """
+    Compiles a validated policy into the template parameters recv_policy and
+    fetch_policy, the VCL code that goes into vcl_recv and vcl_fetch.
+    """
+    policy = policy or {}
+    recv = []
+    fetch = []
+    if policy.get("saint_mode"):
+        fetch.append(("\tif (beresp.status >= 500 && req.restarts < %d &&\n"
+                      "\t\t\t(req.request == \"GET\" || req.request == \"HEAD\")) {\n"
+                      "\t\tset beresp.saintmode = %ds;\n"
+                      "\t\treturn (restart);\n\t}") %
+                     (SAINT_MODE_RESTARTS, policy["saint_mode"]))
+    if policy.get("strip_cookies"):
+        condition = _url_condition(policy["strip_cookies"])
+        recv.append("\tif (%s) {\n\t\tunset req.http.Cookie;\n\t}" % condition)
+        fetch.append("\tif (%s) {\n\t\tunset beresp.http.Set-Cookie;\n\t}" % condition)
+    if policy.get("strip_query_params"):
+        names = "|".join([n.replace(".", "\\.") for n in policy["strip_query_params"]])
+        recv.append('\tset req.url = regsuball(req.url, "(?<=[?&])(%s)=[^&]*(&|$)", "");' %
+                    names)
+        recv.append('\tset req.url = regsub(req.url, "[?&]+$", "");')
+    if policy.get("ttls"):
+        branches = []
+        for rule in policy["ttls"]:
+            branches.append('(req.url ~ "%s") {\n\t\tset beresp.ttl = %ds;\n\t}' %
+                            (rule["url"], rule["ttl"]))
+        fetch.append("\tif " + " elsif ".join(branches))
+    if "healthy_grace" in policy:
+        recv.append(("\tif (req.backend.healthy) {\n\t\tset req.grace = %ds;\n"
+                     "\t} else {\n\t\tset req.grace = %ds;\n\t}") %
+                    (policy["healthy_grace"], policy["grace"]))
+        fetch.append("\tset beresp.grace = %ds;" % policy["grace"])
+    elif "grace" in policy:
+        recv.append("\tset req.grace = %ds;" % policy["grace"])
+        fetch.append("\tset beresp.grace = %ds;" % policy["grace"])
+    return {"recv_policy": "\n".join(recv), "fetch_policy": "\n".join(fetch)}
+
+
+def backend_options(policy, host):
+    """
+    Returns the VCL of the health probe and connection limit of the backend
+    pointing to the given host. Probes send the Host header of the
+    application, so they go through the router.
+    """
+    policy = policy or {}
+    options = ""
+    if policy.get("probe"):
+        probe = policy["probe"]
+        options += ('\n\t.probe = {\n'
+                    '\t\t.request = "GET %s HTTP/1.1" "Host: %s" "Connection: close";\n'
+                    '\t\t.interval = %ds;\n\t\t.timeout = %ds;\n'
+                    '\t\t.window = %d;\n\t\t.threshold = %d;\n\t}') % (
+            probe["url"], host, probe["interval"], probe["timeout"],
+            probe["window"], probe["threshold"])
+    if policy.get("max_connections"):
+        options += "\n\t.max_connections = %d;" % policy["max_connections"]
+    return options
+
+
+def _url_condition(urls):
+    return " || ".join(['req.url ~ "%s"' % url for url in urls])
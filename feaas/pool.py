@@ -0,0 +1,78 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import Queue
+import threading
+
+Result = collections.namedtuple("Result", ["item", "value", "error"])
+
+
+class BoundedPool(object):
+    """
+    BoundedPool applies a function to a list of items using at most
+    max_workers threads. When max_per_key is given, at most max_per_key items
+    sharing the same key (for example, the same host) are processed at the
+    same time.
+
+    Exceptions raised by the function don't stop the other items: they're
+    returned in the error field of the corresponding Result.
+    """
+
+    def __init__(self, max_workers=10, max_per_key=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be a positive integer")
+        self.max_workers = max_workers
+        self.max_per_key = max_per_key
+
+    def map(self, fn, items, key=None, callback=None):
+        """
+        Calls fn(item) for every item, returning the list of results in the
+        same order as items. If callback is given, it's called with each
+        Result as soon as the corresponding item is processed.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        queue = Queue.Queue()
+        for i, item in enumerate(items):
+            queue.put((i, item))
+        semaphores = {}
+        semaphores_lock = threading.Lock()
+
+        def get_semaphore(item):
+            if key is None or not self.max_per_key:
+                return None
+            k = key(item)
+            with semaphores_lock:
+                if k not in semaphores:
+                    semaphores[k] = threading.BoundedSemaphore(self.max_per_key)
+                return semaphores[k]
+
+        def worker():
+            while True:
+                try:
+                    i, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                semaphore = get_semaphore(item)
+                if semaphore:
+                    semaphore.acquire()
+                try:
+                    result = Result(item, fn(item), None)
+                except Exception as e:
+                    result = Result(item, None, e)
+                finally:
+                    if semaphore:
+                        semaphore.release()
+                results[i] = result
+                if callback:
+                    callback(result)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in xrange(min(self.max_workers, len(items)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
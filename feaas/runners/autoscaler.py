@@ -0,0 +1,69 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import autoscale, runners, storage
+
+
+class Autoscaler(runners.Base):
+    """
+    Autoscaler resizes instances with autoscaling enabled according to their
+    load, creating scale jobs the same way users do. Instances that are not
+    started, or that already have a scale job waiting, are left alone, and
+    each instance is scaled at most once per cooldown.
+    """
+    lock_name = "autoscaler"
+
+    def __init__(self, manager, interval=60):
+        super(Autoscaler, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            for config in self.storage.retrieve_autoscale():
+                self.evaluate(config)
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def evaluate(self, config):
+        name = config["instance_name"]
+        try:
+            instance = self.storage.retrieve_instance(name=name, check_liveness=True)
+        except storage.InstanceNotFoundError:
+            return
+        if instance.state != "started":
+            return
+        if self.storage.retrieve_scale_jobs(instance=name,
+                                            state={"$in": ["pending", "processing"]}):
+            return
+        current = len(instance.units)
+        try:
+            load = autoscale.signals[config["signal"]](self.storage).load(instance)
+        except Exception as e:
+            error_msg = " ".join([str(arg) for arg in e.args])
+            sys.stderr.write("[ERROR] failed to read the load of {0}: {1}\n".format(
+                name, error_msg))
+            return
+        desired = autoscale.desired_units(current, load, config)
+        if desired == current:
+            return
+        cooldown = config["scale_down_cooldown"]
+        if desired > current:
+            cooldown = config["scale_up_cooldown"]
+        now = datetime.datetime.utcnow()
+        last_scaled_at = config.get("last_scaled_at")
+        if last_scaled_at and (now - last_scaled_at).total_seconds() < cooldown:
+            return
+        try:
+            self.manager.scale_instance(name, desired)
+        except ValueError as e:
+            error_msg = " ".join(e.args)
+            sys.stderr.write("[ERROR] failed to scale {0}: {1}\n".format(name, error_msg))
+            return
+        self.storage.update_autoscale(name, last_scaled_at=now,
+                                      last_decision={"from": current, "to": desired,
+                                                     "load": load})
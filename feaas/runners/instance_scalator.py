@@ -2,25 +2,69 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from feaas import runners, storage
+import datetime
+import sys
+
+from feaas import pool, runners, storage
 
 
 class InstanceScalator(runners.Base):
+    """
+    InstanceScalator processes scale jobs. Each run starts max_workers
+    workers, and each worker claims a new job as soon as its previous one
+    finishes, until there are no pending jobs left, so a slow scale doesn't
+    block the other instances. Scales of the same instance are serialized by
+    the instance_scalator/<name> lock.
+
+    Failed jobs are retried with exponential backoff, starting at retry_delay
+    seconds. After max_attempts attempts, they're moved to error.
+    """
     lock_name = "instance_scalator"
 
-    def __init__(self, *args, **kwargs):
-        super(InstanceScalator, self).__init__(*args, **kwargs)
+    def __init__(self, manager, interval=10, max_workers=5, max_attempts=5, retry_delay=30):
+        super(InstanceScalator, self).__init__(manager, interval)
         self.init_locker(self.lock_name)
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pool = pool.BoundedPool(max_workers)
 
     def run(self):
-        try:
-            instance, job = self.get_job()
+        for result in self.pool.map(self.work, xrange(self.max_workers)):
+            if result.error:
+                raise result.error
+
+    def work(self, worker):
+        while True:
+            try:
+                instance, job = self.get_job()
+            except storage.InstanceNotFoundError:
+                continue
             if not job:
                 return
-            self.scale_instance(instance, job["quantity"])
-            self.storage.finish_scale_job(job)
-        except storage.InstanceNotFoundError:
-            pass
+            try:
+                self.run_job((instance, job))
+            except Exception as e:
+                self.job_failed(instance, job, e)
+
+    def run_job(self, item):
+        instance, job = item
+        self.scale_instance(instance, job["quantity"])
+        self.storage.finish_scale_job(job)
+
+    def job_failed(self, instance, job, error):
+        error_msg = " ".join([str(arg) for arg in error.args])
+        sys.stderr.write("[ERROR] failed to scale {0}: {1}\n".format(instance.name,
+                                                                     error_msg))
+        attempts = job.get("attempts", 0) + 1
+        if attempts >= self.max_attempts:
+            sys.stderr.write("[ERROR] scale job of {0} failed {1} times, moved to "
+                             "error\n".format(instance.name, attempts))
+            self.storage.fail_scale_job(job, error_msg)
+            return
+        delay = self.retry_delay * 2 ** (attempts - 1)
+        retry_after = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        self.storage.reset_scale_job(job, retry_after=retry_after)
 
     def get_job(self):
         self.locker.lock(self.lock_name)
@@ -33,8 +77,11 @@ class InstanceScalator(runners.Base):
             if instance.state != "started":
                 self.storage.reset_scale_job(job)
                 return None, None
+            if job["quantity"] == len(instance.units):
+                self.storage.finish_scale_job(job)
+                return None, None
             instance.state = "scaling"
-            self.storage.store_instance(instance)
+            self.storage.store_instance(instance, save_units=False)
             return instance, job
         except storage.InstanceNotFoundError:
             self.storage.finish_scale_job(job)
@@ -43,10 +90,20 @@ class InstanceScalator(runners.Base):
             self.locker.unlock(self.lock_name)
 
     def scale_instance(self, instance, quantity):
+        """
+        Scales the instance to quantity units. The instance is read again
+        after taking its lock, so units replaced meanwhile by the unit healer
+        are taken into account.
+        """
         lock_name = "%s/%s" % (self.lock_name, instance.name)
         self.locker.init(lock_name)
         self.locker.lock(lock_name)
         try:
+            try:
+                instance = self.storage.retrieve_instance(name=instance.name,
+                                                          check_liveness=True)
+            except storage.InstanceNotFoundError:
+                return
             try:
                 self.manager.physical_scale(instance, quantity)
             finally:
@@ -0,0 +1,56 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import metrics, pool, runners
+
+
+class MetricsCollector(runners.Base):
+    """
+    MetricsCollector periodically reads the counters of all started units and
+    stores one point per instance with the requests, cache hits and misses,
+    backend fetches and number of objects of the instance since the previous
+    run. The interval of the collector is the resolution of the time series.
+
+    The last counters of each unit are kept in the storage, so points remain
+    consistent when the collector runs in more than one process.
+    """
+    lock_name = "metrics_collector"
+
+    def __init__(self, manager, interval=60, max_workers=10, max_per_host=1):
+        super(MetricsCollector, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.pool = pool.BoundedPool(max_workers, max_per_key=max_per_host)
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            self.collect(self.storage.retrieve_units(state="started"))
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def collect(self, units):
+        if not units:
+            return
+        stored = self.storage.retrieve_unit_counters(unit_id={"$in": [u.id for u in units]})
+        previous = dict([(item["unit_id"], item["counters"]) for item in stored])
+        results = self.pool.map(self.manager.unit_stats, units,
+                                key=lambda unit: unit.dns_name)
+        now = datetime.datetime.utcnow()
+        points = {}
+        for result in results:
+            unit = result.item
+            if result.error:
+                error_msg = " ".join([str(arg) for arg in result.error.args])
+                sys.stderr.write("[ERROR] failed to collect metrics from {0}: {1}\n".format(
+                    unit.dns_name, error_msg))
+                continue
+            point = points.setdefault(unit.instance.name, metrics.new_point(timestamp=now))
+            metrics.add_sample(point, result.value, previous.get(unit.id))
+            self.storage.store_unit_counters(unit, result.value)
+        for name, point in points.items():
+            point["hit_ratio"] = metrics.hit_ratio(point)
+            self.storage.store_metrics(name, point)
@@ -0,0 +1,65 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import pool, runners
+
+
+class ParamWriter(runners.Base):
+    """
+    ParamWriter keeps the Varnish parameters of each unit in sync with the
+    values stored for its instance. Every run reads the parameters from all
+    started units with param.show and sets the ones that differ.
+
+    Units that already had the current values applied and no longer match
+    them have drifted (for example, because varnish was restarted), and are
+    reported.
+    """
+    lock_name = "param_writer"
+
+    def __init__(self, manager, interval=60, max_workers=10, max_per_host=2):
+        super(ParamWriter, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.pool = pool.BoundedPool(max_workers, max_per_key=max_per_host)
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            self.write_params(self.storage.retrieve_varnish_params())
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def write_params(self, stored_params):
+        if not stored_params:
+            return
+        by_instance = dict([(item["instance_name"], item) for item in stored_params])
+        units = self.storage.retrieve_units(state="started",
+                                            instance_name={"$in": by_instance.keys()})
+        items = [(unit, by_instance[unit.instance.name]["params"]) for unit in units]
+        results = self.pool.map(lambda item: self.manager.apply_params(*item), items,
+                                key=lambda item: item[0].dns_name)
+        applied = dict([(name, []) for name in by_instance])
+        drift = dict([(name, {}) for name in by_instance])
+        for result in results:
+            unit, _ = result.item
+            name = unit.instance.name
+            previously_applied = unit.id in by_instance[name].get("applied", [])
+            if result.error:
+                error_msg = " ".join([str(arg) for arg in result.error.args])
+                sys.stderr.write("[ERROR] failed to set parameters in {0}: {1}\n".format(
+                    unit.dns_name, error_msg))
+                if previously_applied:
+                    applied[name].append(unit.id)
+                continue
+            applied[name].append(unit.id)
+            if result.value and previously_applied:
+                drift[name][unit.id] = result.value
+                sys.stderr.write("[ERROR] parameters drifted in {0}: {1}\n".format(
+                    unit.dns_name, ", ".join(result.value)))
+        now = datetime.datetime.utcnow()
+        for name, item in by_instance.items():
+            self.storage.update_varnish_params(item, applied=applied[name],
+                                               drift=drift[name], checked_at=now)
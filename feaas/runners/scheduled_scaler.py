@@ -0,0 +1,71 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import runners, schedule, storage
+
+BOOT_SAMPLES = 20
+
+
+class ScheduledScaler(runners.Base):
+    """
+    ScheduledScaler creates scale jobs for instances with scaling schedules.
+    Scaling up happens ahead of time, by the lead time: the 90th percentile
+    of the measured boot latency of recent units (from creation until they
+    are started, including warm-up), plus the interval of the runner, so new
+    units are serving when the rule begins. Scaling down happens on time.
+
+    Jobs are only created when the scheduled quantity changes, so manual and
+    automatic scales between transitions are kept.
+    """
+    lock_name = "scheduled_scaler"
+
+    def __init__(self, manager, interval=60, default_lead_time=300):
+        super(ScheduledScaler, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.default_lead_time = default_lead_time
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            schedules = self.storage.retrieve_schedules()
+            if schedules:
+                lead_time = self.lead_time()
+                for item in schedules:
+                    self.evaluate(item, lead_time)
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def lead_time(self):
+        latencies = sorted(self.storage.retrieve_boot_latencies(limit=BOOT_SAMPLES))
+        if not latencies:
+            return self.default_lead_time
+        return latencies[int(0.9 * (len(latencies) - 1))] + self.interval
+
+    def evaluate(self, item, lead_time):
+        name = item["instance_name"]
+        now = datetime.datetime.utcnow()
+        ahead = now + datetime.timedelta(seconds=lead_time)
+        desired = max(schedule.desired_units(item, now), schedule.desired_units(item, ahead))
+        if desired == item.get("last_target"):
+            return
+        try:
+            instance = self.storage.retrieve_instance(name=name, check_liveness=True)
+        except storage.InstanceNotFoundError:
+            return
+        if instance.state != "started":
+            return
+        if self.storage.retrieve_scale_jobs(instance=name,
+                                            state={"$in": ["pending", "processing"]}):
+            return
+        if desired != len(instance.units):
+            try:
+                self.manager.scale_instance(name, desired)
+            except ValueError as e:
+                error_msg = " ".join(e.args)
+                sys.stderr.write("[ERROR] failed to scale {0}: {1}\n".format(name, error_msg))
+                return
+        self.storage.update_schedule(name, last_target=desired, last_scaled_at=now)
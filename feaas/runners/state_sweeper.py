@@ -0,0 +1,74 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import runners
+
+DEADLINES = {"starting": 900, "scaling": 1800, "terminating": 900,
+             "processing": 1800, "lock": 3600}
+
+RETRY_STATES = {"starting": "creating", "scaling": "started", "terminating": "removed"}
+
+
+class StateSweeper(runners.Base):
+    """
+    StateSweeper recovers records left behind by runners that died halfway
+    through a transition. Instances that stay in starting, scaling or
+    terminating, and scale jobs that stay in processing, for longer than the
+    deadline of the state are moved back to the state their runner picks
+    them up from. After max_attempts sweeps, they're moved to error instead.
+    Locks held for longer than the lock deadline are released.
+
+    Sweeps are conditional on the record not having changed since it was
+    read, so the sweeper doesn't need a lock of its own and a sweeper that
+    dies doesn't block the next one.
+    """
+
+    def __init__(self, manager, interval=60, deadlines=None, max_attempts=3):
+        super(StateSweeper, self).__init__(manager, interval)
+        self.init_locker()
+        self.deadlines = dict(DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.max_attempts = max_attempts
+
+    def run(self):
+        now = datetime.datetime.utcnow()
+        self.release_locks(now)
+        self.sweep_instances(now)
+        self.sweep_scale_jobs(now)
+
+    def expired_before(self, state, now):
+        return now - datetime.timedelta(seconds=self.deadlines[state])
+
+    def release_locks(self, now):
+        for lock_name in self.locker.release_expired(self.expired_before("lock", now)):
+            sys.stderr.write("[ERROR] lock {0} held for more than {1} seconds, "
+                             "released\n".format(lock_name, self.deadlines["lock"]))
+
+    def sweep_instances(self, now):
+        for state in sorted(RETRY_STATES):
+            before = self.expired_before(state, now)
+            for instance in self.storage.retrieve_expired_instances(state, before):
+                reason = "stuck in {0} for more than {1} seconds".format(
+                    state, self.deadlines[state])
+                new_state = RETRY_STATES[state]
+                if instance.get("sweeps", 0) >= self.max_attempts:
+                    new_state = "error"
+                if self.storage.sweep_instance(instance, new_state, reason):
+                    sys.stderr.write("[ERROR] instance {0} {1}, moved to {2}\n".format(
+                        instance["name"], reason, new_state))
+
+    def sweep_scale_jobs(self, now):
+        before = self.expired_before("processing", now)
+        for job in self.storage.retrieve_expired_scale_jobs(before):
+            reason = "stuck in processing for more than {0} seconds".format(
+                self.deadlines["processing"])
+            new_state = "pending"
+            if job.get("attempts", 0) >= self.max_attempts:
+                new_state = "error"
+            if self.storage.sweep_scale_job(job, new_state, reason):
+                sys.stderr.write("[ERROR] scale job of {0} {1}, moved to {2}\n".format(
+                    job["instance"], reason, new_state))
@@ -0,0 +1,153 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import sys
+
+from feaas import pool, runners, storage
+from feaas.runners import instance_scalator
+
+
+class UnitHealer(runners.Base):
+    """
+    UnitHealer replaces dead units. Every run probes the admin port of all
+    started units, counting consecutive failures; units that fail
+    failure_threshold probes in a row, or that don't come up within
+    boot_deadline seconds, are marked as dead and replaced.
+
+    The replacement is provisioned first, and the dead unit is only
+    terminated once the replacement is started (bound by the VCL writer).
+    A replacement that dies or doesn't start within boot_deadline seconds
+    fails: the dead unit is terminated anyway, and the replacement unit is
+    replaced like any other dead unit.
+    Each instance gets at most max_replacements replacements per
+    replacement_window seconds, so a systemic failure doesn't turn into a
+    provisioning storm.
+
+    Replacements hold the instance_scalator/<name> lock of the instance, and
+    read the instance only after taking it, so they don't race with scales.
+    """
+    lock_name = "unit_healer"
+
+    def __init__(self, manager, interval=30, failure_threshold=3, boot_deadline=900,
+                 max_replacements=2, replacement_window=3600, max_workers=10):
+        super(UnitHealer, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.failure_threshold = failure_threshold
+        self.boot_deadline = boot_deadline
+        self.max_replacements = max_replacements
+        self.replacement_window = replacement_window
+        self.pool = pool.BoundedPool(max_workers)
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            self.finish_replacements()
+            for unit in self.find_dead_units():
+                self.replace(unit)
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def find_dead_units(self):
+        units = self.storage.retrieve_units(state="started")
+        results = self.pool.map(self.manager.is_unit_up, units)
+        dead = []
+        for result in results:
+            failures = self.storage.record_probe(result.item, bool(result.value))
+            if failures >= self.failure_threshold:
+                dead.append(result.item)
+        deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.boot_deadline)
+        dead.extend(self.storage.retrieve_units(state="creating",
+                                                created_at={"$lt": deadline}))
+        return dead
+
+    def instance_lock(self, name):
+        lock_name = "%s/%s" % (instance_scalator.InstanceScalator.lock_name, name)
+        self.locker.init(lock_name)
+        return lock_name
+
+    def replace(self, unit):
+        lock_name = self.instance_lock(unit.instance.name)
+        self.locker.lock(lock_name)
+        try:
+            self._replace(unit)
+        finally:
+            self.locker.unlock(lock_name)
+
+    def _replace(self, unit):
+        name = unit.instance.name
+        try:
+            instance = self.storage.retrieve_instance(name=name, check_liveness=True)
+        except storage.InstanceNotFoundError:
+            return
+        if instance.state != "started":
+            return
+        current = [u for u in instance.units if u.id == unit.id]
+        if not current:
+            return
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.replacement_window)
+        recent = self.storage.retrieve_unit_replacements(instance_name=name,
+                                                         created_at={"$gte": since})
+        if len(recent) >= self.max_replacements:
+            sys.stderr.write("[ERROR] replacement limit reached for {0}, not replacing "
+                             "{1}\n".format(name, unit.dns_name))
+            return
+        try:
+            current[0].state = "dead"
+            self.storage.update_units([unit], state="dead")
+            replacement = self.manager.replace_unit(instance)
+            self.storage.store_unit_replacement({"instance_name": name,
+                                                 "dead_unit_id": unit.id,
+                                                 "replacement_id": replacement.id})
+        except Exception as e:
+            error_msg = " ".join([str(arg) for arg in e.args])
+            sys.stderr.write("[ERROR] failed to replace {0}: {1}\n".format(
+                unit.dns_name, error_msg))
+
+    def finish_replacements(self):
+        """
+        Terminates the dead unit of each replacement whose new unit started,
+        or that failed. When the new unit is gone altogether, the dead unit
+        gets another replacement instead.
+        """
+        deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.boot_deadline)
+        for replacement in self.storage.retrieve_unit_replacements(state="provisioning"):
+            units = self.storage.retrieve_units(id=replacement["replacement_id"])
+            if units and units[0].state == "started":
+                state = "done"
+            elif not units or units[0].state == "dead" or replacement["created_at"] < deadline:
+                state = "failed"
+            else:
+                continue
+            lock_name = self.instance_lock(replacement["instance_name"])
+            self.locker.lock(lock_name)
+            try:
+                retry = self._finish_replacement(replacement, state, gone=not units)
+            finally:
+                self.locker.unlock(lock_name)
+            if retry:
+                self.replace(retry)
+
+    def _finish_replacement(self, replacement, state, gone):
+        """
+        Marks the replacement with the given state and terminates its dead
+        unit. Returns the dead unit instead when it should get another
+        replacement.
+        """
+        name = replacement["instance_name"]
+        try:
+            instance = self.storage.retrieve_instance(name=name)
+        except storage.InstanceNotFoundError:
+            self.storage.update_unit_replacement(replacement, state="failed")
+            return None
+        dead = [u for u in instance.units if u.id == replacement["dead_unit_id"]]
+        self.storage.update_unit_replacement(replacement, state=state)
+        if state == "failed":
+            sys.stderr.write("[ERROR] replacement {0} of {1} in {2} failed\n".format(
+                replacement["replacement_id"], replacement["dead_unit_id"], name))
+            if gone and dead:
+                return dead[0]
+        for unit in dead:
+            self.manager.remove_unit(instance, unit)
+        return None
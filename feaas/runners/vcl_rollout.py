@@ -0,0 +1,127 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import hashlib
+import math
+import sys
+
+from feaas import pool, runners
+from feaas.runners import vcl_writer
+
+
+class VCLRollout(runners.Base):
+    """
+    VCLRollout pushes the current VCL template to all started units, so
+    changes in the template reach units that were bound before the change.
+
+    Each run processes one wave of units: the first wave is a canary with
+    canary_percent of the units, and the following waves have wave_percent of
+    them. When the error rate of a wave exceeds max_error_rate, the rollout is
+    paused until an operator resumes it. Units that fail in a wave below the
+    error rate are skipped by the following waves, and when some of them are
+    left after the last wave, the rollout finishes in done_with_failures, so
+    an operator can resume it to retry them. Progress is stored, so the
+    rollout continues from where it stopped if the runner crashes.
+    """
+    lock_name = "vcl_rollout"
+
+    def __init__(self, manager, interval=60, canary_percent=5, wave_percent=20,
+                 max_error_rate=0.1, max_workers=10, max_per_host=2):
+        super(VCLRollout, self).__init__(manager, interval)
+        self.init_locker(self.lock_name)
+        self.canary_percent = canary_percent
+        self.wave_percent = wave_percent
+        self.max_error_rate = max_error_rate
+        self.pool = pool.BoundedPool(max_workers, max_per_key=max_per_host)
+
+    def run(self):
+        self.locker.lock(self.lock_name)
+        try:
+            rollout = self.get_rollout()
+            if rollout["state"] == "running":
+                self.run_wave(rollout)
+        finally:
+            self.locker.unlock(self.lock_name)
+
+    def get_rollout(self):
+        template = self.manager.vcl_template()
+        template_hash = hashlib.sha1(template.encode("utf-8")).hexdigest()
+        rollout = self.storage.retrieve_rollout(template_hash=template_hash)
+        if not rollout:
+            rollout = {"template_hash": template_hash, "state": "running", "wave": 0,
+                       "total": len(self.storage.retrieve_units(state="started")),
+                       "done": [], "failed": [],
+                       "created_at": datetime.datetime.utcnow()}
+            self.storage.store_rollout(rollout)
+        return rollout
+
+    def resume(self):
+        """
+        Resumes the rollout of the current template, paused or done with
+        failures, retrying the units that failed before.
+        """
+        rollout = self.get_rollout()
+        if rollout["state"] in ("paused", "done_with_failures"):
+            rollout["state"] = "running"
+            rollout["failed"] = []
+            rollout.pop("reason", None)
+            self.storage.store_rollout(rollout)
+        return rollout
+
+    def run_wave(self, rollout):
+        skip = set(rollout["done"] + rollout["failed"])
+        units = [u for u in self.storage.retrieve_units(state="started")
+                 if u.id not in skip]
+        units.sort(key=lambda u: u.id)
+        wave = units[:self.wave_size(rollout)]
+        hosts = {}
+        policies = {}
+        for unit in wave:
+            name = unit.instance.name
+            if name not in hosts:
+                binds = self.storage.retrieve_binds(instance_name=name,
+                                                    state={"$in": vcl_writer.LIVE_BIND_STATES})
+                hosts[name] = vcl_writer.app_hosts(binds)
+                stored_policy = self.storage.retrieve_cache_policy(name)
+                policies[name] = vcl_writer.cache_policy(stored_policy)
+        items = [(unit, hosts[unit.instance.name], policies[unit.instance.name])
+                 for unit in wave]
+        results = self.pool.map(self._write_unit, items, key=lambda item: item[0].dns_name)
+        errors = 0
+        for result in results:
+            unit, _, _ = result.item
+            if result.error:
+                errors += 1
+                rollout["failed"].append(unit.id)
+                error_msg = " ".join([str(arg) for arg in result.error.args])
+                sys.stderr.write("[ERROR] failed to roll VCL out to {0}: {1}\n".format(
+                    unit.dns_name, error_msg))
+            else:
+                rollout["done"].append(unit.id)
+        rollout["wave"] += 1
+        if wave and float(errors) / len(wave) > self.max_error_rate:
+            rollout["state"] = "paused"
+            rollout["reason"] = "{0} of {1} units failed in wave {2}".format(
+                errors, len(wave), rollout["wave"])
+        elif len(wave) == len(units) and rollout["failed"]:
+            rollout["state"] = "done_with_failures"
+            rollout["reason"] = "{0} units failed".format(len(rollout["failed"]))
+        elif len(wave) == len(units):
+            rollout["state"] = "done"
+        self.storage.store_rollout(rollout)
+        return rollout
+
+    def wave_size(self, rollout):
+        percent = self.wave_percent
+        if rollout["wave"] == 0:
+            percent = self.canary_percent
+        total = max(rollout["total"], 1)
+        return max(int(math.ceil(total * percent / 100.0)), 1)
+
+    def _write_unit(self, item):
+        unit, hosts, policy = item
+        if not hosts:
+            return False
+        return self.manager.write_vcl(unit, hosts, policy=policy)
@@ -2,31 +2,104 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import telnetlib
+import copy
+import datetime
+import os
+import signal
+import socket
+import sys
 import threading
+import time
 
-from feaas import runners
+from feaas import pool, runners, sharding
 
-UNITS_LOCKER = "units"
-BINDS_LOCKER = "binds"
+LIVE_BIND_STATES = ["creating", "created"]
 
 
 class VCLWriter(runners.Base):
     """
     VCLWriter provides a method that keeps it running forever doing two things:
 
-        - whenever a new unit is added to an instance, bind this unit to all
-          applications that are already bound to this unit
-        - whenever a new bind is made, connect all started units to the
-          application that is being created
+        - whenever a new unit is added to an instance, write the VCL of the
+          instance, balancing between all applications bound to it, and the
+          Varnish parameters of the instance to this unit, and warm its cache
+          up with the hot URLs of the instance before marking it as started
+        - whenever a bind is made or removed, or the caching policy of an
+          instance changes, write the new VCL of the instance to all started
+          units, once per instance
+
+    Units that fail are retried with exponential backoff, without holding
+    back the other units. After max_attempts failures, the unit is moved to
+    the dead-letter state and left alone until an operator requeues it, which
+    makes the writer rewrite the instance of the unit.
+
+    Many writers may run at the same time: instances are partitioned among
+    the live writers by a consistent hash of the instance name. Each writer
+    sends heartbeats from a background thread, and writers that miss
+    heartbeat_timeout seconds of heartbeats are dropped, so their instances
+    move to the remaining writers.
+
+    Since writers may briefly disagree on the live writers, a writer only
+    processes an instance after claiming its lease. The heartbeat renews the
+    leases of the writer, and leases of instances that moved to another
+    writer are released between runs, so two writers never process the same
+    instance.
     """
 
-    def __init__(self, manager, interval=10, max_items=None):
+    def __init__(self, manager, interval=10, max_items=None, force=False,
+                 max_workers=10, max_per_host=2, retry_delay=10, max_retry_delay=600,
+                 warm_workers=10, max_attempts=10, writer_id=None, heartbeat_timeout=None,
+                 warm_timeout=120):
         super(VCLWriter, self).__init__(manager, interval)
-        self.init_locker(UNITS_LOCKER, BINDS_LOCKER)
         self.max_items = max_items
+        self.force = force
+        self.pool = pool.BoundedPool(max_workers, max_per_key=max_per_host)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.warm_workers = warm_workers
+        self.warm_timeout = warm_timeout
+        self.max_attempts = max_attempts
+        self.writer_id = writer_id or "{0}:{1}".format(socket.gethostname(), os.getpid())
+        self.heartbeat_timeout = heartbeat_timeout or max(30, 3 * interval)
+        self.heartbeat_interval = self.heartbeat_timeout / 3.0
+        self.members = [self.writer_id]
+        self.leases = set()
+        self.leases_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def loop(self):
+        """
+        Runs the writer until it's stopped, sending heartbeats from another
+        thread. Once stopped, the writer waits for the heartbeat thread, and
+        then releases its leases and leaves the live writers.
+        """
+        self.running = True
+        self.stopped.clear()
+        self.heartbeat()
+        beater = threading.Thread(target=self.beat)
+        beater.daemon = True
+        beater.start()
+        try:
+            while not self.stopped.is_set():
+                self.run()
+                self.stopped.wait(self.interval)
+        finally:
+            self.stopped.set()
+            beater.join()
+            self.release_leases(all_leases=True)
+            self.storage.remove_writer(self.writer_id)
+
+    def beat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                error_msg = " ".join([str(arg) for arg in e.args])
+                sys.stderr.write("[ERROR] failed to send the heartbeat of {0}: {1}\n".format(
+                    self.writer_id, error_msg))
 
     def run(self):
+        self.release_leases()
         t1 = threading.Thread(target=self.run_units)
         t1.start()
         t2 = threading.Thread(target=self.run_binds)
@@ -34,49 +107,313 @@ class VCLWriter(runners.Base):
         t1.join()
         t2.join()
 
+    def stop(self):
+        """
+        Stops the loop after the current run. It doesn't touch the storage,
+        so it's safe to call from signal handlers.
+        """
+        super(VCLWriter, self).stop()
+        self.stopped.set()
+
+    def handle_signals(self):
+        """
+        Stops the writer on SIGTERM and SIGINT, so it leaves the live writers
+        and releases its leases right away instead of waiting for them to
+        expire.
+        """
+        def handler(signum, frame):
+            self.stop()
+
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGINT, handler)
+
+    def heartbeat(self):
+        """
+        Registers the heartbeat of this writer, renews its leases and reloads
+        the live writers, dropping the ones that missed their heartbeats.
+        """
+        now = datetime.datetime.utcnow()
+        self.storage.store_writer_heartbeat(self.writer_id, now)
+        with self.leases_lock:
+            leases = list(self.leases)
+        if leases:
+            self.storage.renew_instance_leases(self.writer_id, leases,
+                                               self.lease_expiration(now))
+        since = now - datetime.timedelta(seconds=self.heartbeat_timeout)
+        self.storage.remove_writers(heartbeat_at={"$lt": since})
+        members = self.storage.retrieve_writers()
+        if self.writer_id not in members:
+            members.append(self.writer_id)
+        self.members = sorted(members)
+
+    def lease_expiration(self, now):
+        return now + datetime.timedelta(seconds=self.heartbeat_timeout)
+
+    def owns(self, instance_name):
+        """
+        Returns whether the instance is assigned to this writer and this
+        writer holds its lease, claiming the lease when needed.
+        """
+        if sharding.owner(instance_name, self.members) != self.writer_id:
+            return False
+        with self.leases_lock:
+            if instance_name in self.leases:
+                return True
+        now = datetime.datetime.utcnow()
+        if not self.storage.claim_instance_lease(instance_name, self.writer_id,
+                                                 self.lease_expiration(now), now):
+            return False
+        with self.leases_lock:
+            self.leases.add(instance_name)
+        return True
+
+    def release_leases(self, all_leases=False):
+        """
+        Releases the leases of instances assigned to other writers (or all
+        leases, when all_leases is True). The remaining leases are claimed
+        again in the next run, so a lease lost meanwhile isn't trusted.
+        """
+        with self.leases_lock:
+            leases = list(self.leases)
+            self.leases = set()
+        if not all_leases:
+            leases = [name for name in leases
+                      if sharding.owner(name, self.members) != self.writer_id]
+        if leases:
+            self.storage.remove_instance_leases(self.writer_id, leases)
+
     def run_units(self):
-        self.locker.lock(UNITS_LOCKER)
-        try:
-            units = self.storage.retrieve_units(state="creating", limit=self.max_items)
-            up_units = []
-            for unit in units:
-                if self._is_unit_up(unit):
-                    up_units.append(unit)
-            if up_units:
-                self.bind_units(up_units)
-                self.storage.update_units(up_units, state="started")
-        finally:
-            self.locker.unlock(UNITS_LOCKER)
+        retries = self._retries()
+        now = datetime.datetime.utcnow()
+        query = {}
+        waiting = [item["unit_id"] for item in retries.values()
+                   if not self._is_due(item, now)]
+        if waiting:
+            query["id"] = {"$nin": waiting}
+        units = self.storage.retrieve_units(state="creating", **query)
+        units = [u for u in units if self.owns(u.instance.name)][:self.max_items]
+        up_units = []
+        for unit in units:
+            if self.manager.is_unit_up(unit):
+                up_units.append(unit)
+        if up_units:
+            up_units = self.bind_units(up_units, retries)
+        if up_units:
+            self.set_params(up_units)
+            self.warm_units(up_units)
+            self.storage.update_units(up_units, state="started")
+            now = datetime.datetime.utcnow()
+            for unit in up_units:
+                if unit.created_at is None:
+                    continue
+                self.storage.store_boot_latency(
+                    unit, (now - unit.created_at).total_seconds())
 
-    def bind_units(self, units):
-        binds_dict = {}
+    def bind_units(self, units, retries=None):
+        """
+        Writes the VCL of the instance to each unit, returning the units that
+        succeeded. Failed units go to the retry queue.
+        """
+        retries = retries or {}
+        hosts_dict = {}
+        policies = {}
+        bound = []
         for unit in units:
             iname = unit.instance.name
-            if iname not in binds_dict:
-                binds_dict[iname] = self.storage.retrieve_binds(instance_name=iname,
-                                                                state="created")
-            binds = binds_dict[iname]
-            for bind in binds:
-                self.manager.write_vcl(unit.dns_name, unit.secret, bind.app_host)
-
-    def _is_unit_up(self, unit):
-        try:
-            client = telnetlib.Telnet(unit.dns_name, "6082", timeout=3)
-            client.close()
-            return True
-        except:
-            return False
+            if iname not in hosts_dict:
+                binds = self.storage.retrieve_binds(instance_name=iname,
+                                                    state={"$in": LIVE_BIND_STATES})
+                hosts_dict[iname] = app_hosts(binds)
+                policies[iname] = cache_policy(self.storage.retrieve_cache_policy(iname))
+            retry = retries.get((iname, unit.id))
+            if hosts_dict[iname]:
+                try:
+                    self.manager.write_vcl(unit, hosts_dict[iname], force=self.force,
+                                           policy=policies[iname])
+                except Exception as e:
+                    attempts = retry.get("attempts", 0) if retry else 0
+                    self._fail_unit(unit, attempts + 1, e)
+                    continue
+            if retry:
+                self.storage.remove_vcl_retry(unit)
+            bound.append(unit)
+        return bound
+
+    def set_params(self, units):
+        """
+        Sets the Varnish parameters of the instance in each unit. Failures
+        don't prevent units from starting, the parameter writer retries them.
+        """
+        names = list(set([u.instance.name for u in units]))
+        stored = self.storage.retrieve_varnish_params(instance_name={"$in": names})
+        params = dict([(item["instance_name"], item["params"]) for item in stored])
+        for unit in units:
+            if not params.get(unit.instance.name):
+                continue
+            try:
+                self.manager.apply_params(unit, params[unit.instance.name])
+            except Exception as e:
+                error_msg = " ".join([str(arg) for arg in e.args])
+                sys.stderr.write("[ERROR] failed to set parameters in {0}: {1}\n".format(
+                    unit.dns_name, error_msg))
+
+    def warm_units(self, units):
+        """
+        Replays the hot URLs of the instance against each unit, so it doesn't
+        join with a cold cache. Units are warmed up in parallel, and the whole
+        warm-up is bounded by warm_timeout seconds: URLs left by then are
+        skipped. The coverage and duration of each warm-up are stored.
+        Failures don't prevent units from starting.
+        """
+        names = list(set([u.instance.name for u in units]))
+        stored = self.storage.retrieve_warm_urls(instance_name={"$in": names})
+        urls = dict([(item["instance_name"], item["urls"]) for item in stored])
+        units = [u for u in units if urls.get(u.instance.name)]
+        deadline = time.time() + self.warm_timeout
+
+        def warm(unit):
+            return self.manager.warm_unit(unit, urls[unit.instance.name],
+                                          self.warm_workers, deadline=deadline)
+
+        for result in self.pool.map(warm, units, key=lambda unit: unit.dns_name):
+            if result.error:
+                error_msg = " ".join([str(arg) for arg in result.error.args])
+                sys.stderr.write("[ERROR] failed to warm {0} up: {1}\n".format(
+                    result.item.dns_name, error_msg))
+                continue
+            self.storage.store_warmup(result.item, **result.value)
 
     def run_binds(self):
-        self.locker.lock(BINDS_LOCKER)
-        try:
-            binds = self.storage.retrieve_binds(state="creating", limit=self.max_items)
-            instance_names = [b.instance.name for b in binds]
-            units = self.storage.retrieve_units(state="started",
-                                                instance_name={"$in": instance_names})
-            for bind in binds:
-                for unit in units:
-                    self.manager.write_vcl(unit.dns_name, unit.secret, bind.app_host)
+        binds = self.storage.retrieve_binds(state={"$in": ["creating", "removing"]})
+        binds = [b for b in binds if self.owns(b.instance.name)][:self.max_items]
+        instance_names = []
+        for bind in binds:
+            if bind.instance.name not in instance_names:
+                instance_names.append(bind.instance.name)
+        pending = self.storage.retrieve_cache_policies(state="pending")
+        requeued = self.storage.retrieve_vcl_retries(state="requeued")
+        for item in pending + requeued:
+            name = item["instance_name"]
+            if name not in instance_names and self.owns(name):
+                instance_names.append(name)
+        self.write_instances(instance_names)
+
+    def write_instances(self, instance_names):
+        """
+        Writes the VCL of each instance, generated from all its binds, to the
+        started units of the instance, in parallel.
+
+        Units that already run the VCL are skipped by the manager, and failed
+        units are retried with exponential backoff. As soon as all units of an
+        instance are written, its new binds are marked as created, its removed
+        binds are deleted and its caching policy is marked as applied.
+        """
+        if not instance_names:
+            return
+        binds = {}
+        policies = {}
+        for name in instance_names:
+            binds[name] = self.storage.retrieve_binds(instance_name=name)
+            policies[name] = self.storage.retrieve_cache_policy(name)
+        units = self.storage.retrieve_units(state="started",
+                                            instance_name={"$in": instance_names})
+        retries = self._retries(instance_name={"$in": instance_names})
+        now = datetime.datetime.utcnow()
+        pending = dict([(name, 0) for name in instance_names])
+        items = []
+        for unit in units:
+            name = unit.instance.name
+            retry = retries.get((name, unit.id), {})
+            if retry.get("state") == "dead":
+                continue
+            pending[name] += 1
+            if not self._is_due(retry, now):
+                continue
+            hosts = app_hosts([b for b in binds[name] if b.state in LIVE_BIND_STATES])
+            items.append((unit, hosts, cache_policy(policies[name]), retry))
+        for name in instance_names:
+            if pending[name] == 0:
+                self._finish_instance(binds[name], policies[name])
+        lock = threading.Lock()
+
+        def done(result):
+            unit, _, _, retry = result.item
+            if result.error:
+                self._fail_unit(unit, retry.get("attempts", 0) + 1, result.error)
+                return
+            if retry:
+                self.storage.remove_vcl_retry(unit)
+            with lock:
+                unit.vcl_hash = result.value[1]
+                pending[unit.instance.name] -= 1
+                complete = pending[unit.instance.name] == 0
+            if complete:
+                name = unit.instance.name
+                self._finish_instance(binds[name], policies[name])
+
+        self.pool.map(self._write_unit, items, key=lambda item: item[0].dns_name,
+                      callback=done)
+
+    def _write_unit(self, item):
+        """
+        Writes the VCL to a copy of the unit, so workers never change a Unit
+        shared with other threads. Returns whether the VCL was sent and the
+        resulting hash, which the callback sets in the unit.
+        """
+        unit, hosts, policy, _ = item
+        unit = copy.copy(unit)
+        written = False
+        if hosts:
+            written = self.manager.write_vcl(unit, hosts, force=self.force, policy=policy)
+        elif unit.vcl_hash or self.force:
+            self.manager.remove_vcl(unit)
+            written = True
+        return written, unit.vcl_hash
+
+    def _finish_instance(self, binds, stored_policy):
+        for bind in binds:
+            if bind.state == "creating":
                 self.storage.update_bind(bind, state="created")
-        finally:
-            self.locker.unlock(BINDS_LOCKER)
+            elif bind.state == "removing":
+                self.storage.remove_bind(bind)
+        if stored_policy and stored_policy["state"] == "pending":
+            self.storage.update_cache_policy(stored_policy, state="applied")
+
+    def _retries(self, **query):
+        retries = {}
+        for item in self.storage.retrieve_vcl_retries(**query):
+            retries[(item["instance_name"], item["unit_id"])] = item
+        return retries
+
+    def _is_due(self, retry, now):
+        if retry.get("state") == "dead":
+            return False
+        return not retry.get("retry_at") or retry["retry_at"] <= now
+
+    def _fail_unit(self, unit, attempts, error):
+        error_msg = " ".join([str(arg) for arg in error.args])
+        sys.stderr.write("[ERROR] failed to write VCL for {0} in {1}: {2}\n".format(
+            unit.instance.name, unit.dns_name, error_msg))
+        now = datetime.datetime.utcnow()
+        if attempts >= self.max_attempts:
+            sys.stderr.write("[ERROR] giving up on {0} after {1} attempts\n".format(
+                unit.dns_name, attempts))
+            self.storage.store_vcl_retry(unit, attempts=attempts, retry_at=None,
+                                         error=error_msg, state="dead", dead_at=now)
+            return
+        retry_at = now + self.retry_backoff(attempts)
+        self.storage.store_vcl_retry(unit, attempts=attempts, retry_at=retry_at,
+                                     error=error_msg)
+
+    def retry_backoff(self, attempts):
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+        return datetime.timedelta(seconds=delay)
+
+
+def app_hosts(binds):
+    return sorted(set([b.app_host for b in binds]))
+
+
+def cache_policy(stored_policy):
+    if stored_policy:
+        return stored_policy["policy"]
@@ -0,0 +1,86 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import re
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+MAX_RULES = 20
+
+TIME_REGEXP = re.compile(r"^([01]\d|2[0-3]):([0-5]\d)$")
+
+
+def validate(schedule):
+    """
+    Validates a scaling schedule, raising ValueError when it's invalid. A
+    schedule looks like:
+
+        {"default_units": 2,
+         "rules": [{"start": "08:00", "end": "23:00", "units": 6},
+                   {"start": "20:00", "end": "02:00", "units": 10,
+                    "days": ["fri", "sat"]}]}
+
+    Times are in UTC, and a rule whose end is before its start goes past
+    midnight (its days are the days it starts). The first matching rule
+    wins, and default_units apply when no rule matches.
+    """
+    if not isinstance(schedule, dict):
+        raise ValueError("schedule must be an object")
+    for field in schedule:
+        if field not in ("default_units", "rules"):
+            raise ValueError("unknown schedule field: {0}".format(field))
+    if "default_units" not in schedule or "rules" not in schedule:
+        raise ValueError("default_units and rules are required")
+    _check_units(schedule["default_units"], "default_units")
+    rules = schedule["rules"]
+    if not isinstance(rules, list) or not rules:
+        raise ValueError("rules must be a non-empty list")
+    if len(rules) > MAX_RULES:
+        raise ValueError("rules must have at most {0} items".format(MAX_RULES))
+    validated = {"default_units": schedule["default_units"], "rules": []}
+    for rule in rules:
+        if not isinstance(rule, dict) or not set(["start", "end", "units"]) <= set(rule) or \
+                not set(rule) <= set(["start", "end", "units", "days"]):
+            raise ValueError("each rule must have start, end and units, and may have days")
+        for field in ("start", "end"):
+            if not isinstance(rule[field], basestring) or not TIME_REGEXP.match(rule[field]):
+                raise ValueError("invalid time: {0}".format(rule[field]))
+        if rule["start"] == rule["end"]:
+            raise ValueError("start and end of a rule must be different")
+        _check_units(rule["units"], "units")
+        days = rule.get("days", list(DAYS))
+        if not isinstance(days, list) or not days or \
+                not all([day in DAYS for day in days]):
+            raise ValueError("days must be a list of {0}".format(", ".join(DAYS)))
+        validated["rules"].append({"start": rule["start"], "end": rule["end"],
+                                   "units": rule["units"], "days": days})
+    return validated
+
+
+def _check_units(value, field):
+    if isinstance(value, bool) or not isinstance(value, (int, long)) or value < 1:
+        raise ValueError("{0} must be a positive integer".format(field))
+
+
+def desired_units(schedule, at):
+    """
+    Returns the number of units the schedule defines for the given time.
+    """
+    minutes = at.hour * 60 + at.minute
+    today = DAYS[at.weekday()]
+    yesterday = DAYS[at.weekday() - 1]
+    for rule in schedule["rules"]:
+        start, end = _minutes(rule["start"]), _minutes(rule["end"])
+        if start < end:
+            if today in rule["days"] and start <= minutes < end:
+                return rule["units"]
+        elif (today in rule["days"] and minutes >= start) or \
+                (yesterday in rule["days"] and minutes < end):
+            return rule["units"]
+    return schedule["default_units"]
+
+
+def _minutes(value):
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
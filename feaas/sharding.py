@@ -0,0 +1,21 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import hashlib
+
+
+def owner(key, members):
+    """
+    Returns the member that owns the given key, using rendezvous hashing:
+    each member scores the key and the highest score wins. When a member
+    joins or leaves, only the keys it owns (or starts to own) move, and every
+    process that sees the same members agrees on the owner of each key.
+    """
+    if not members:
+        return None
+    return max(members, key=lambda member: (_score(member, key), member))
+
+
+def _score(member, key):
+    return hashlib.md5(u"{0}/{1}".format(member, key).encode("utf-8")).hexdigest()
@@ -3,8 +3,14 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import uuid
 
 import pymongo
+import pymongo.errors
+
+from feaas import metrics
+
+METRICS_COLLECTION_SIZE = 64 * 1024 * 1024
 
 
 class InstanceNotFoundError(Exception):
@@ -21,15 +27,16 @@ class DoubleUnlockError(Exception):
 
 class Instance(object):
 
-    def __init__(self, name=None, state="creating", units=None):
+    def __init__(self, name=None, state="creating", units=None, plan=None):
         self.name = name
         self.state = state
         self.units = units or []
+        self.plan = plan
         for unit in self.units:
             unit.instance = self
 
     def to_dict(self):
-        return {"name": self.name, "state": self.state}
+        return {"name": self.name, "state": self.state, "plan": self.plan}
 
     def add_unit(self, unit):
         unit.instance = self
@@ -43,17 +50,20 @@ class Instance(object):
 class Unit(object):
 
     def __init__(self, id=None, dns_name=None, secret=None, state="creating",
-                 instance=None):
+                 instance=None, vcl_hash=None, created_at=None):
         self.id = id
         self.dns_name = dns_name
         self.secret = secret
         self.state = state
         self.instance = instance
+        self.vcl_hash = vcl_hash
+        self.created_at = created_at or datetime.datetime.utcnow()
 
     def to_dict(self):
         return {"id": self.id, "dns_name": self.dns_name,
                 "secret": self.secret, "state": self.state,
-                "instance_name": self.instance.name}
+                "instance_name": self.instance.name,
+                "vcl_hash": self.vcl_hash, "created_at": self.created_at}
 
 
 class Bind(object):
@@ -78,10 +88,15 @@ class MongoDBStorage(object):
         client = pymongo.MongoClient(self.mongo_uri)
         self.db = client[self.dbname]
         self.collection_name = "instances"
+        self.metrics_ready = False
+        self.scale_jobs_ready = False
 
     def store_instance(self, instance, save_units=True):
-        self.db[self.collection_name].update({"name": instance.name}, instance.to_dict(),
-                                             upsert=True)
+        doc = dict(instance.to_dict(), updated_at=datetime.datetime.utcnow())
+        update = {"$set": doc}
+        if instance.state == "started":
+            update["$unset"] = {"sweeps": ""}
+        self.db[self.collection_name].update({"name": instance.name}, update, upsert=True)
         if save_units:
             self.db.units.remove({"instance_name": instance.name})
             if instance.units:
@@ -93,7 +108,8 @@ class MongoDBStorage(object):
         instance = self.db[self.collection_name].find_one(query)
         if not instance:
             raise InstanceNotFoundError()
-        del instance["_id"]
+        for key in ("_id", "updated_at", "sweeps", "sweep_reason"):
+            instance.pop(key, None)
         instance["units"] = self.retrieve_units(instance_name=instance["name"])
         return Instance(**instance)
 
@@ -102,45 +118,180 @@ class MongoDBStorage(object):
         if limit:
             cursor = cursor.limit(limit)
         units = []
-        for unit in cursor:
-            unit["instance"] = Instance(name=unit["instance_name"])
-            del unit["instance_name"]
-            del unit["_id"]
-            units.append(Unit(**unit))
+        for item in cursor:
+            item["instance"] = Instance(name=item["instance_name"])
+            del item["instance_name"]
+            del item["_id"]
+            created_at = item.pop("created_at", None)
+            unit = Unit(**item)
+            # units stored before created_at was recorded keep it unknown
+            unit.created_at = created_at
+            units.append(unit)
         return units
 
+    def retrieve_expired_instances(self, state, before):
+        """
+        Returns the instances that are in the given state since before the
+        given time.
+        """
+        query = {"state": state, "updated_at": {"$lt": before}}
+        return list(self.db[self.collection_name].find(query, {"_id": 0}))
+
+    def sweep_instance(self, instance, state, reason):
+        """
+        Moves an expired instance (as returned by retrieve_expired_instances)
+        to the given state, recording the reason and counting the sweep. The
+        instance is only changed if no one touched it in the meantime.
+        Returns whether the instance was changed.
+        """
+        query = {"name": instance["name"], "state": instance["state"],
+                 "updated_at": instance["updated_at"]}
+        changes = {"state": state, "sweep_reason": reason,
+                   "updated_at": datetime.datetime.utcnow()}
+        r = self.db[self.collection_name].update(query, {"$set": changes,
+                                                         "$inc": {"sweeps": 1}})
+        return r["n"] > 0
+
     def remove_instance(self, name):
         self.db.binds.remove({"instance_name": name})
+        self.db.vcl_retries.remove({"instance_name": name})
+        self.db.cache_policies.remove({"instance_name": name})
+        self.db.varnish_params.remove({"instance_name": name})
+        self.db.warm_urls.remove({"instance_name": name})
+        self.db.warmups.remove({"instance_name": name})
+        self.db.unit_counters.remove({"instance_name": name})
+        self.db.autoscale.remove({"instance_name": name})
+        self.db.schedules.remove({"instance_name": name})
+        self.db.unit_health.remove({"instance_name": name})
+        self.db.unit_replacements.remove({"instance_name": name})
         self.db.units.remove({"instance_name": name})
         self.db[self.collection_name].remove({"name": name})
 
+    def _ensure_scale_jobs_index(self):
+        """
+        Pending jobs carry the name of their instance in pending_instance,
+        which has a unique sparse index, so there's at most one pending job
+        per instance even when many processes store jobs at the same time.
+        """
+        if not self.scale_jobs_ready:
+            self.db.scale_jobs.ensure_index("pending_instance", unique=True, sparse=True)
+            self.scale_jobs_ready = True
+
     def store_scale_job(self, job):
+        """
+        Stores a scale job. Pending jobs are coalesced: there's at most one
+        pending job per instance, and storing another one replaces its
+        quantity, so only the latest desired quantity is acted on.
+        """
         if "state" not in job:
             job["state"] = "pending"
-        self.db.scale_jobs.insert(job)
+        if job["state"] != "pending":
+            self.db.scale_jobs.insert(job)
+            return
+        self._ensure_scale_jobs_index()
+        job["pending_instance"] = job["instance"]
+        query = {"instance": job["instance"], "state": "pending"}
+        stored = None
+        while not stored:
+            try:
+                stored = self.db.scale_jobs.find_and_modify(query, {"$set": job},
+                                                            upsert=True, new=True)
+            except pymongo.errors.DuplicateKeyError:
+                # another process inserted the pending job of the instance
+                # meanwhile, and it may be claimed before it's updated here,
+                # in which case the upsert is tried again
+                stored = self.db.scale_jobs.find_and_modify(query, {"$set": job}, new=True)
+        job["_id"] = stored["_id"]
+
+    def retrieve_scale_jobs(self, **query):
+        return list(self.db.scale_jobs.find(query))
 
     def get_scale_job(self):
-        job = self.db.scale_jobs.find_one({"state": "pending"})
-        if not job:
-            return
-        job["state"] = "processing"
-        self.db.scale_jobs.update({"_id": job["_id"]},
-                                  {"$set": {"state": job["state"]}})
-        return job
+        """
+        Claims a pending scale job, skipping jobs whose retry_after is still in
+        the future.
+        """
+        now = datetime.datetime.utcnow()
+        query = {"state": "pending",
+                 "$or": [{"retry_after": None}, {"retry_after": {"$lte": now}}]}
+        changes = {"state": "processing", "claimed_at": now}
+        return self.db.scale_jobs.find_and_modify(query,
+                                                  {"$set": changes,
+                                                   "$unset": {"pending_instance": ""}},
+                                                  new=True)
+
+    def retrieve_expired_scale_jobs(self, before):
+        query = {"state": "processing", "claimed_at": {"$lt": before}}
+        return list(self.db.scale_jobs.find(query))
+
+    def sweep_scale_job(self, job, state, reason):
+        """
+        Moves an expired scale job out of processing, recording the reason and
+        counting the attempt. A job sent back to pending is marked as done
+        when a newer job for the instance is already pending. Returns whether
+        the job was changed.
+        """
+        query = {"_id": job["_id"], "state": "processing",
+                 "claimed_at": job["claimed_at"]}
+        update = {"$set": {"state": state, "sweep_reason": reason}, "$inc": {"attempts": 1}}
+        if state == "pending":
+            self._ensure_scale_jobs_index()
+            update["$set"]["pending_instance"] = job["instance"]
+        try:
+            r = self.db.scale_jobs.update(query, update)
+        except pymongo.errors.DuplicateKeyError:
+            update["$set"] = {"state": "done", "sweep_reason": reason}
+            r = self.db.scale_jobs.update(query, update)
+        return r["n"] > 0
+
+    def reset_scale_job(self, job, retry_after=None):
+        """
+        Moves the job back to pending, or to done when a newer job for the
+        instance is already pending. When retry_after is given, the job is
+        a failed attempt: it isn't claimed again before retry_after, and its
+        attempts are counted.
+        """
+        if "_id" not in job:
+            raise ValueError("job is not persisted")
+        self._ensure_scale_jobs_index()
+        query = {"_id": job["_id"]}
+        changes = {"state": "pending", "pending_instance": job["instance"]}
+        update = {"$set": changes}
+        if retry_after:
+            changes["retry_after"] = retry_after
+            update["$inc"] = {"attempts": 1}
+        try:
+            self.db.scale_jobs.update(query, update)
+            job.update(changes)
+            if retry_after:
+                job["attempts"] = job.get("attempts", 0) + 1
+        except pymongo.errors.DuplicateKeyError:
+            job["state"] = "done"
+            self.db.scale_jobs.update(query, {"$set": {"state": job["state"]}})
 
-    def reset_scale_job(self, job):
+    def fail_scale_job(self, job, reason):
+        """
+        Moves the job to error, counting the attempt, so it isn't retried.
+        """
         if "_id" not in job:
             raise ValueError("job is not persisted")
-        job["state"] = "pending"
+        job["state"] = "error"
+        job["error"] = reason
+        job["attempts"] = job.get("attempts", 0) + 1
+        job.pop("pending_instance", None)
         self.db.scale_jobs.update({"_id": job["_id"]},
-                                  {"$set": {"state": job["state"]}})
+                                  {"$set": {"state": job["state"], "error": reason},
+                                   "$inc": {"attempts": 1},
+                                   "$unset": {"pending_instance": ""}})
 
     def finish_scale_job(self, job):
         if "_id" not in job:
             raise ValueError("job is not persisted")
         job["state"] = "done"
+        job.pop("pending_instance", None)
         self.db.scale_jobs.update({"_id": job["_id"]},
-                                  {"$set": {"state": job["state"]}})
+                                  {"$set": {"state": job["state"]},
+                                   "$unset": {"pending_instance": ""}})
 
     def store_bind(self, bind):
         self.db.binds.insert(bind.to_dict())
@@ -159,8 +310,248 @@ class MongoDBStorage(object):
         return binds
 
     def remove_bind(self, bind):
+        """
+        Removes the bind, as long as it's being removed, so a bind of the same
+        app_host created meanwhile (an unbind followed by a rebind) is kept.
+        """
         self.db.binds.remove({"app_host": bind.app_host,
-                              "instance_name": bind.instance.name})
+                              "instance_name": bind.instance.name,
+                              "state": "removing"})
+
+    def retrieve_vcl_retries(self, **query):
+        return list(self.db.vcl_retries.find(query, {"_id": 0}))
+
+    def store_vcl_retry(self, unit, **changes):
+        self.db.vcl_retries.update({"instance_name": unit.instance.name,
+                                    "unit_id": unit.id},
+                                   {"$set": changes}, upsert=True)
+
+    def remove_vcl_retry(self, unit):
+        self.db.vcl_retries.remove({"instance_name": unit.instance.name,
+                                    "unit_id": unit.id})
+
+    def requeue_vcl_retries(self, instance_name, unit_id=None):
+        """
+        Moves the dead-lettered VCL retries of the instance (or of one of
+        its units) to the requeued state, due immediately and with their
+        attempts reset, so the units are retried from scratch. Returns the
+        number of requeued units.
+        """
+        query = {"instance_name": instance_name, "state": "dead"}
+        if unit_id:
+            query["unit_id"] = unit_id
+        changes = {"$set": {"state": "requeued", "attempts": 0, "retry_at": None},
+                   "$unset": {"dead_at": ""}}
+        return self.db.vcl_retries.update(query, changes, multi=True)["n"]
+
+    def store_writer_heartbeat(self, writer_id, heartbeat_at):
+        self.db.vcl_writers.update({"_id": writer_id},
+                                   {"$set": {"heartbeat_at": heartbeat_at}}, upsert=True)
+
+    def retrieve_writers(self):
+        return [item["_id"] for item in self.db.vcl_writers.find()]
+
+    def remove_writer(self, writer_id):
+        self.db.vcl_writers.remove({"_id": writer_id})
+
+    def remove_writers(self, **query):
+        self.db.vcl_writers.remove(query)
+
+    def claim_instance_lease(self, instance_name, owner, expires_at, now):
+        """
+        Takes the lease of the instance for owner until expires_at, unless
+        another owner holds an unexpired lease. Returns whether owner holds
+        the lease.
+        """
+        query = {"_id": instance_name,
+                 "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]}
+        try:
+            self.db.vcl_leases.update(query, {"$set": {"owner": owner,
+                                                       "expires_at": expires_at}},
+                                      upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # the lease exists and belongs to another owner
+            return False
+        return True
+
+    def renew_instance_leases(self, owner, instance_names, expires_at):
+        self.db.vcl_leases.update({"_id": {"$in": instance_names}, "owner": owner},
+                                  {"$set": {"expires_at": expires_at}}, multi=True)
+
+    def remove_instance_leases(self, owner, instance_names):
+        self.db.vcl_leases.remove({"_id": {"$in": instance_names}, "owner": owner})
+
+    def retrieve_rollout(self, **query):
+        return self.db.vcl_rollouts.find_one(query, {"_id": 0})
+
+    def store_rollout(self, rollout):
+        self.db.vcl_rollouts.update({"template_hash": rollout["template_hash"]},
+                                    rollout, upsert=True)
+
+    def retrieve_cache_policy(self, instance_name):
+        return self.db.cache_policies.find_one({"instance_name": instance_name},
+                                               {"_id": 0})
+
+    def retrieve_cache_policies(self, **query):
+        return list(self.db.cache_policies.find(query, {"_id": 0}))
+
+    def store_cache_policy(self, instance_name, policy):
+        self.db.cache_policies.update({"instance_name": instance_name},
+                                      {"instance_name": instance_name,
+                                       "policy": policy, "state": "pending",
+                                       "updated_at": datetime.datetime.utcnow()},
+                                      upsert=True)
+
+    def update_cache_policy(self, cache_policy, **changes):
+        self.db.cache_policies.update({"instance_name": cache_policy["instance_name"],
+                                       "updated_at": cache_policy["updated_at"]},
+                                      {"$set": changes})
+
+    def retrieve_varnish_params(self, **query):
+        return list(self.db.varnish_params.find(query, {"_id": 0}))
+
+    def store_varnish_params(self, instance_name, params):
+        changes = {"updated_at": datetime.datetime.utcnow(), "applied": []}
+        for param, value in params.items():
+            changes["params." + param] = value
+        self.db.varnish_params.update({"instance_name": instance_name},
+                                      {"$set": changes}, upsert=True)
+
+    def update_varnish_params(self, varnish_params, **changes):
+        self.db.varnish_params.update({"instance_name": varnish_params["instance_name"],
+                                       "updated_at": varnish_params["updated_at"]},
+                                      {"$set": changes})
+
+    def retrieve_warm_urls(self, **query):
+        return list(self.db.warm_urls.find(query, {"_id": 0}))
+
+    def store_warm_urls(self, instance_name, urls):
+        self.db.warm_urls.update({"instance_name": instance_name},
+                                 {"instance_name": instance_name, "urls": urls},
+                                 upsert=True)
+
+    def retrieve_warmups(self, **query):
+        return list(self.db.warmups.find(query, {"_id": 0}))
+
+    def store_warmup(self, unit, **result):
+        result["finished_at"] = datetime.datetime.utcnow()
+        self.db.warmups.update({"instance_name": unit.instance.name,
+                                "unit_id": unit.id},
+                               {"$set": result}, upsert=True)
+
+    def retrieve_autoscale(self, **query):
+        return list(self.db.autoscale.find(query, {"_id": 0}))
+
+    def store_autoscale(self, instance_name, config):
+        self.db.autoscale.update({"instance_name": instance_name}, {"$set": config},
+                                 upsert=True)
+
+    def update_autoscale(self, instance_name, **changes):
+        self.db.autoscale.update({"instance_name": instance_name}, {"$set": changes})
+
+    def remove_autoscale(self, instance_name):
+        self.db.autoscale.remove({"instance_name": instance_name})
+
+    def retrieve_schedules(self, **query):
+        return list(self.db.schedules.find(query, {"_id": 0}))
+
+    def store_schedule(self, instance_name, schedule):
+        self.db.schedules.update({"instance_name": instance_name},
+                                 {"$set": schedule, "$unset": {"last_target": ""}},
+                                 upsert=True)
+
+    def update_schedule(self, instance_name, **changes):
+        self.db.schedules.update({"instance_name": instance_name}, {"$set": changes})
+
+    def remove_schedule(self, instance_name):
+        self.db.schedules.remove({"instance_name": instance_name})
+
+    def retrieve_boot_latencies(self, limit=None):
+        cursor = self.db.boot_latencies.find().sort("measured_at", pymongo.DESCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [item["seconds"] for item in cursor]
+
+    def store_boot_latency(self, unit, seconds):
+        self.db.boot_latencies.insert({"instance_name": unit.instance.name,
+                                       "unit_id": unit.id, "seconds": seconds,
+                                       "measured_at": datetime.datetime.utcnow()})
+
+    def record_probe(self, unit, ok):
+        """
+        Records the result of a health probe of the unit, returning the
+        number of consecutive failed probes.
+        """
+        query = {"unit_id": unit.id, "instance_name": unit.instance.name}
+        if ok:
+            self.db.unit_health.update(query, {"$set": {"failures": 0}}, upsert=True)
+            return 0
+        health = self.db.unit_health.find_and_modify(query, {"$inc": {"failures": 1}},
+                                                     upsert=True, new=True)
+        return health["failures"]
+
+    def retrieve_unit_replacements(self, **query):
+        return list(self.db.unit_replacements.find(query))
+
+    def store_unit_replacement(self, replacement):
+        replacement.setdefault("state", "provisioning")
+        replacement.setdefault("created_at", datetime.datetime.utcnow())
+        self.db.unit_replacements.insert(replacement)
+
+    def update_unit_replacement(self, replacement, **changes):
+        replacement.update(changes)
+        self.db.unit_replacements.update({"_id": replacement["_id"]}, {"$set": changes})
+
+    def retrieve_unit_counters(self, **query):
+        return list(self.db.unit_counters.find(query, {"_id": 0}))
+
+    def store_unit_counters(self, unit, counters):
+        self.db.unit_counters.update({"unit_id": unit.id},
+                                     {"unit_id": unit.id, "instance_name": unit.instance.name,
+                                      "counters": counters,
+                                      "collected_at": datetime.datetime.utcnow()},
+                                     upsert=True)
+
+    def retrieve_metrics(self, instance_name, since=None):
+        query = {"instance_name": instance_name}
+        if since:
+            query["timestamp"] = {"$gte": since}
+        cursor = self.db.metrics.find(query, {"_id": 0}).sort("timestamp", pymongo.ASCENDING)
+        return list(cursor)
+
+    def retrieve_metric_rollups(self, instance_name, since=None):
+        query = {"instance_name": instance_name}
+        if since:
+            query["timestamp"] = {"$gte": since}
+        cursor = self.db.metric_rollups.find(query, {"_id": 0, "instance_name": 0})
+        return list(cursor.sort("timestamp", pymongo.ASCENDING))
+
+    def store_metrics(self, instance_name, point):
+        """
+        Stores a point in the time series of the instance. Points go to a
+        capped collection, so old points are discarded as new ones arrive.
+        The point is also added to its hourly rollup (see metrics.rollup),
+        which outlives the raw points and serves coarse queries.
+        """
+        if not self.metrics_ready:
+            try:
+                self.db.create_collection("metrics", capped=True,
+                                          size=METRICS_COLLECTION_SIZE)
+            except pymongo.errors.CollectionInvalid:
+                pass
+            self.metrics_ready = True
+        point = dict(point, instance_name=instance_name)
+        point.setdefault("timestamp", datetime.datetime.utcnow())
+        self.db.metrics.insert(point)
+        start, increments = metrics.rollup(point)
+        self.db.metric_rollups.update({"instance_name": instance_name, "timestamp": start},
+                                      {"$inc": increments}, upsert=True)
+
+    def store_unit(self, unit):
+        self.db.units.update({"id": unit.id}, unit.to_dict(), upsert=True)
+
+    def remove_unit(self, unit):
+        self.db.units.remove({"id": unit.id})
 
     def update_units(self, units, **changes):
         ids = [u.id for u in units]
@@ -172,9 +563,17 @@ class MongoDBStorage(object):
 
 
 class MultiLocker(object):
+    """
+    MultiLocker provides named locks shared by all processes using the same
+    database. Each lock taken records a random owner token, and unlocking
+    only releases the lock while it still holds that token, so a process
+    whose lock was released as expired (see release_expired) can't release
+    the lock after another process has taken it.
+    """
 
     def __init__(self, storage):
         self.db = storage.db
+        self.tokens = {}
 
     def init(self, lock_name):
         try:
@@ -186,14 +585,33 @@ class MultiLocker(object):
         self.db.multi_locker.remove({"_id": lock_name})
 
     def lock(self, lock_name):
+        token = uuid.uuid4().hex
         n = 0
         while n < 1:
             r = self.db.multi_locker.update({"_id": lock_name, "state": 0},
-                                            {"_id": lock_name, "state": 1})
+                                            {"_id": lock_name, "state": 1, "owner": token,
+                                             "locked_at": datetime.datetime.utcnow()})
             n = r["n"]
+        self.tokens[lock_name] = token
+
+    def release_expired(self, before):
+        """
+        Releases the locks held since before the given time, left behind by
+        processes that died while holding them. Returns the released names.
+        """
+        released = []
+        query = {"state": 1, "locked_at": {"$lt": before}}
+        for lock in self.db.multi_locker.find(query):
+            r = self.db.multi_locker.update({"_id": lock["_id"], "state": 1,
+                                             "locked_at": lock["locked_at"]},
+                                            {"_id": lock["_id"], "state": 0})
+            if r["n"] > 0:
+                released.append(lock["_id"])
+        return released
 
     def unlock(self, lock_name):
-        r = self.db.multi_locker.update({"_id": lock_name, "state": 1},
+        token = self.tokens.pop(lock_name, None)
+        r = self.db.multi_locker.update({"_id": lock_name, "state": 1, "owner": token},
                                         {"_id": lock_name, "state": 0})
         if r["n"] < 1:
             raise DoubleUnlockError(lock_name)
@@ -0,0 +1,91 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import sys
+
+from feaas import pool
+
+DEFAULT_POLICY = "unhealthy_first"
+
+STATS_WORKERS = 10
+
+
+def newest(manager, units):
+    """
+    Removes the newest units first, keeping the warmest caches. Units whose
+    creation time is unknown are taken as the oldest.
+    """
+    return sorted(units, key=lambda unit: unit.created_at or datetime.datetime.min,
+                  reverse=True)
+
+
+def unhealthy_first(manager, units):
+    """
+    Removes units that are not started (still booting or broken) first, and
+    then the newest ones.
+    """
+    return sorted(newest(manager, units), key=lambda unit: unit.state == "started")
+
+
+def least_loaded(manager, units):
+    """
+    Removes the units that served fewer requests since the last collection of
+    metrics first. Counters are read from all units in parallel. Units whose
+    counters can't be read are removed before all others. When the load of
+    no unit is known, falls back to unhealthy_first.
+    """
+    stored = manager.storage.retrieve_unit_counters(unit_id={"$in": [u.id for u in units]})
+    previous = dict([(item["unit_id"], item) for item in stored])
+    results = pool.BoundedPool(STATS_WORKERS).map(manager.unit_stats, units)
+    now = datetime.datetime.utcnow()
+    loads = {}
+    for result in results:
+        unit = result.item
+        item = previous.get(unit.id)
+        if result.error:
+            loads[unit.id] = -1
+        elif not item:
+            loads[unit.id] = 0
+        else:
+            seconds = max((now - item["collected_at"]).total_seconds(), 1)
+            requests = (result.value.get("client_req", 0) -
+                        item["counters"].get("client_req", 0))
+            loads[unit.id] = max(requests, 0) / seconds
+    if units and not [r for r in results if not r.error and r.item.id in previous]:
+        sys.stderr.write("[ERROR] no load available for the units, "
+                         "falling back to unhealthy_first\n")
+        return unhealthy_first(manager, units)
+    return sorted(units, key=lambda unit: loads[unit.id])
+
+
+policies = {
+    "newest": newest,
+    "unhealthy_first": unhealthy_first,
+    "least_loaded": least_loaded,
+}
+
+
+def register_policy(name, obj, override=False):
+    """
+    Registers a policy for choosing the units removed on scale down. Policies
+    are called with the manager and the units of the instance, and return
+    the units sorted from the first to the last to be removed.
+    """
+    if not override and name in policies:
+        raise ValueError("Policy already registered")
+    policies[name] = obj
+
+
+def select(manager, units, quantity):
+    """
+    Returns the quantity units that should be removed, according to the
+    policy in the SCALE_DOWN_POLICY environment variable (default:
+    unhealthy_first).
+    """
+    name = os.environ.get("SCALE_DOWN_POLICY", DEFAULT_POLICY)
+    if name not in policies:
+        raise ValueError("{0} is not a valid scale down policy".format(name))
+    return policies[name](manager, list(units))[:quantity]
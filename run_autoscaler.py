@@ -0,0 +1,22 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import autoscaler
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Autoscaler runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval between evaluations of the instances (in seconds)",
+                        default=60, type=int)
+    args = parser.parse_args()
+    scaler = autoscaler.Autoscaler(manager, args.interval)
+    scaler.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
@@ -13,8 +13,19 @@ def run(manager):
     parser.add_argument("-i", "--interval",
                         help="Interval for running InstanceTerminator (in seconds)",
                         default=10, type=int)
+    parser.add_argument("-w", "--workers",
+                        help="Maximum number of instances scaled concurrently",
+                        default=5, type=int)
+    parser.add_argument("-m", "--max-attempts",
+                        help="Number of attempts of a scale job before moving it to error",
+                        default=5, type=int)
+    parser.add_argument("-r", "--retry-delay",
+                        help="Delay before retrying a failed scale job (in seconds), "
+                             "doubled on each attempt",
+                        default=30, type=int)
     args = parser.parse_args()
-    scalator = instance_scalator.InstanceScalator(manager, args.interval)
+    scalator = instance_scalator.InstanceScalator(manager, args.interval, args.workers,
+                                                  args.max_attempts, args.retry_delay)
     scalator.loop()
 
 if __name__ == "__main__":
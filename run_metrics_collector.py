@@ -0,0 +1,26 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import metrics_collector
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Metrics collector runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval between collections, the resolution of the metrics "
+                             "(in seconds)",
+                        default=60, type=int)
+    parser.add_argument("-w", "--workers",
+                        help="Maximum number of units read concurrently",
+                        default=10, type=int)
+    args = parser.parse_args()
+    collector = metrics_collector.MetricsCollector(manager, args.interval, args.workers)
+    collector.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
@@ -0,0 +1,25 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import param_writer
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Varnish parameter writer runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval between checks of the parameters (in seconds)",
+                        default=60, type=int)
+    parser.add_argument("-w", "--workers",
+                        help="Maximum number of units checked concurrently",
+                        default=10, type=int)
+    args = parser.parse_args()
+    writer = param_writer.ParamWriter(manager, args.interval, args.workers)
+    writer.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
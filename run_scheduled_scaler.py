@@ -0,0 +1,25 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import scheduled_scaler
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Scheduled scaler runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval between evaluations of the schedules (in seconds)",
+                        default=60, type=int)
+    parser.add_argument("-l", "--lead-time",
+                        help="Lead time used before boot latency is measured (in seconds)",
+                        default=300, type=int)
+    args = parser.parse_args()
+    scaler = scheduled_scaler.ScheduledScaler(manager, args.interval, args.lead_time)
+    scaler.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
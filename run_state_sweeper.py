@@ -0,0 +1,36 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import state_sweeper
+
+
+def deadline(value):
+    state, _, seconds = value.partition("=")
+    if state not in state_sweeper.DEADLINES or not seconds.isdigit():
+        raise argparse.ArgumentTypeError("invalid deadline: {0}".format(value))
+    return state, int(seconds)
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("State sweeper runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval for running StateSweeper (in seconds)",
+                        default=60, type=int)
+    parser.add_argument("-d", "--deadline",
+                        help="Deadline of a state, as state=seconds (may be repeated)",
+                        action="append", default=[], type=deadline)
+    parser.add_argument("-m", "--max-attempts",
+                        help="Sweeps of a record before it's moved to error",
+                        default=3, type=int)
+    args = parser.parse_args()
+    sweeper = state_sweeper.StateSweeper(manager, args.interval, dict(args.deadline),
+                                         args.max_attempts)
+    sweeper.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
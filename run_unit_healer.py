@@ -0,0 +1,35 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import unit_healer
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("Unit healer runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval between health probes (in seconds)",
+                        default=30, type=int)
+    parser.add_argument("-f", "--failures",
+                        help="Consecutive failed probes before a unit is replaced",
+                        default=3, type=int)
+    parser.add_argument("-b", "--boot-deadline",
+                        help="Time for new units to come up before being replaced (in seconds)",
+                        default=900, type=int)
+    parser.add_argument("-m", "--max-replacements",
+                        help="Maximum number of replacements per instance per window",
+                        default=2, type=int)
+    parser.add_argument("--replacement-window",
+                        help="Window of the replacement limit (in seconds)",
+                        default=3600, type=int)
+    args = parser.parse_args()
+    healer = unit_healer.UnitHealer(manager, args.interval, args.failures, args.boot_deadline,
+                                    args.max_replacements, args.replacement_window)
+    healer.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
@@ -0,0 +1,41 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+
+from feaas import api
+from feaas.runners import vcl_rollout
+
+
+def run(manager):
+    parser = argparse.ArgumentParser("VCL rollout runner")
+    parser.add_argument("-i", "--interval",
+                        help="Interval between rollout waves (in seconds)",
+                        default=60, type=int)
+    parser.add_argument("-c", "--canary-percent",
+                        help="Percentage of units in the first (canary) wave",
+                        default=5, type=float)
+    parser.add_argument("-p", "--wave-percent",
+                        help="Percentage of units in each of the following waves",
+                        default=20, type=float)
+    parser.add_argument("-e", "--max-error-rate",
+                        help="Error rate (0-1) that pauses the rollout",
+                        default=0.1, type=float)
+    parser.add_argument("-w", "--workers",
+                        help="Maximum number of concurrent VCL writes",
+                        default=10, type=int)
+    parser.add_argument("--resume",
+                        help="Resume a paused or failed rollout, retrying failed units",
+                        action="store_true")
+    args = parser.parse_args()
+    rollout = vcl_rollout.VCLRollout(manager, args.interval, args.canary_percent,
+                                     args.wave_percent, args.max_error_rate,
+                                     args.workers)
+    if args.resume:
+        rollout.resume()
+    rollout.loop()
+
+if __name__ == "__main__":
+    manager = api.get_manager()
+    run(manager)
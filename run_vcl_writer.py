@@ -16,8 +16,38 @@ def run(manager):
     parser.add_argument("-n", "--max-items",
                         help="Maximum number of units to process at a time",
                         type=int)
+    parser.add_argument("-f", "--force-refresh",
+                        help="Push VCL to units even if they already run it",
+                        action="store_true")
+    parser.add_argument("-w", "--workers",
+                        help="Maximum number of concurrent VCL writes",
+                        default=10, type=int)
+    parser.add_argument("--max-per-host",
+                        help="Maximum number of concurrent VCL writes to the same unit",
+                        default=2, type=int)
+    parser.add_argument("--warm-workers",
+                        help="Maximum number of concurrent requests when warming a unit up",
+                        default=10, type=int)
+    parser.add_argument("--warm-timeout",
+                        help="Maximum duration of the warm-up of new units (in seconds)",
+                        default=120, type=int)
+    parser.add_argument("--max-attempts",
+                        help="Failed VCL writes to a unit before it's dead-lettered",
+                        default=10, type=int)
+    parser.add_argument("--writer-id",
+                        help="Identifier of this writer (default: hostname:pid)")
+    parser.add_argument("--heartbeat-timeout",
+                        help="Time without heartbeats before a writer is dropped (in seconds)",
+                        type=int)
     args = parser.parse_args()
-    writer = vcl_writer.VCLWriter(manager, args.interval, args.max_items)
+    writer = vcl_writer.VCLWriter(manager, args.interval, args.max_items,
+                                  args.force_refresh, args.workers, args.max_per_host,
+                                  warm_workers=args.warm_workers,
+                                  warm_timeout=args.warm_timeout,
+                                  max_attempts=args.max_attempts,
+                                  writer_id=args.writer_id,
+                                  heartbeat_timeout=args.heartbeat_timeout)
+    writer.handle_signals()
     writer.loop()
 
 if __name__ == "__main__":
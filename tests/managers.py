@@ -2,7 +2,9 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from feaas import storage
+import json
+
+from feaas import autoscale, policy as cache_policy, schedule, storage
 
 
 class FakeInstance(object):
@@ -12,6 +14,12 @@ class FakeInstance(object):
         self.state = state
         self.units = 1
         self.bound = []
+        self.purged = []
+        self.cache_policy = {}
+        self.params = {}
+        self.warm_urls = []
+        self.autoscale = {}
+        self.schedule = {}
 
     def bind(self, app_host):
         self.bound.append(app_host)
@@ -25,8 +33,12 @@ class FakeManager(object):
     def __init__(self, storage=None):
         self.instances = []
 
-    def new_instance(self, name, state="running"):
-        self.instances.append(FakeInstance(name, state))
+    def new_instance(self, name, state="running", plan=None):
+        if plan == "huge":
+            raise ValueError("invalid plan: huge")
+        instance = FakeInstance(name, state)
+        instance.plan = plan
+        self.instances.append(instance)
 
     def bind(self, name, app_host):
         index, instance = self.find_instance(name)
@@ -68,6 +80,134 @@ class FakeManager(object):
         instance.units += difference
         self.instances[index] = instance
 
+    def purge(self, name, pattern=None, expression=None):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        if not expression:
+            expression = 'req.url ~ "%s"' % pattern
+        if "\n" in expression:
+            raise ValueError("invalid ban expression")
+        units = [{"unit": "%s-%d.cloud.tsuru.io" % (name, i), "ok": True, "latency": 0.01}
+                 for i in xrange(instance.units)]
+        if instance.state == "broken":
+            units[-1] = {"unit": units[-1]["unit"], "ok": False, "error": "timed out"}
+        instance.purged.append(expression)
+        return {"expression": expression, "units": units, "latency": 0.02}
+
+    def set_params(self, name, params):
+        if not params:
+            raise ValueError("at least one parameter is required")
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        params = dict([(k, int(v)) for k, v in params.items()])
+        instance.params.update(params)
+        return params
+
+    def get_warm_urls(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        return {"urls": instance.warm_urls, "warmups": []}
+
+    def get_vcl_retries(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        return [{"instance_name": name, "unit_id": "i-0800", "attempts": 10,
+                 "state": "dead", "error": "timed out"}]
+
+    def requeue_vcl_retries(self, name, unit_id=None):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        if unit_id and unit_id != "i-0800":
+            return 0
+        return 1
+
+    def set_warm_urls(self, name, urls):
+        if not isinstance(urls, list):
+            raise ValueError("urls must be a list")
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.warm_urls = urls
+        return urls
+
+    def get_metrics(self, name, minutes=60, step=None):
+        if minutes < 1:
+            raise ValueError("minutes must be a positive integer")
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        return [{"minutes": minutes, "step": step, "requests": 10, "hits": 9, "misses": 1,
+                 "hit_ratio": 0.9}]
+
+    def get_autoscale(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        return instance.autoscale
+
+    def set_autoscale(self, name, config):
+        config = autoscale.validate(config)
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.autoscale = config
+        return config
+
+    def disable_autoscale(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.autoscale = {}
+
+    def get_schedule(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        return instance.schedule
+
+    def set_schedule(self, name, scaling_schedule):
+        scaling_schedule = schedule.validate(scaling_schedule)
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.schedule = scaling_schedule
+        return scaling_schedule
+
+    def remove_schedule(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.schedule = {}
+
+    def get_cache_policy(self, name):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        return instance.cache_policy
+
+    def set_cache_policy(self, name, policy):
+        policy = cache_policy.validate(policy)
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.cache_policy = policy
+        return policy
+
+    def preview_vcl(self, name, policy=None):
+        if policy is not None:
+            policy = cache_policy.validate(policy)
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        if policy is None:
+            policy = instance.cache_policy
+        return "vcl of %s with %s" % (name, json.dumps(policy, sort_keys=True))
+
     def find_instance(self, name):
         for i, instance in enumerate(self.instances):
             if instance.name == name:
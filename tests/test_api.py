@@ -29,6 +29,28 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(201, resp.status_code)
         self.assertEqual("someapp", self.manager.instances[0].name)
 
+    def test_start_instance_plan(self):
+        resp = self.api.post("/resources", data={"name": "someapp", "plan": "small"})
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual("small", self.manager.instances[0].plan)
+
+    def test_start_instance_invalid_plan(self):
+        resp = self.api.post("/resources", data={"name": "someapp", "plan": "huge"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid plan: huge", resp.data)
+        self.assertEqual([], self.manager.instances)
+
+    def test_list_plans(self):
+        os.environ["API_PLANS"] = json.dumps([{"name": "small", "description": "1GB",
+                                               "memory": 1024, "instance_type": "m1.small"},
+                                              {"name": "large", "memory": 8192}])
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        resp = self.api.get("/resources/plans")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual([{"name": "small", "description": "1GB"},
+                          {"name": "large", "description": ""}], json.loads(resp.data))
+
     def test_start_instance_without_name(self):
         resp = self.api.post("/resources", data={"names": "someapp"})
         self.assertEqual(400, resp.status_code)
@@ -220,6 +242,384 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(401, resp.status_code)
         self.assertEqual("you do not have access to this resource", resp.data)
 
+    def test_purge_pattern(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/purge", data={"pattern": "^/static/"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        data = json.loads(resp.data)
+        self.assertEqual('req.url ~ "^/static/"', data["expression"])
+        self.assertEqual([{"unit": "someapp-0.cloud.tsuru.io", "ok": True, "latency": 0.01}],
+                         data["units"])
+        self.assertEqual(0.02, data["latency"])
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(['req.url ~ "^/static/"'], instance.purged)
+
+    def test_purge_expression(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/purge",
+                             data={"expression": "obj.http.Content-Type ~ image"})
+        self.assertEqual(200, resp.status_code)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(["obj.http.Content-Type ~ image"], instance.purged)
+
+    def test_purge_unit_failure(self):
+        self.manager.new_instance("someapp", state="broken")
+        resp = self.api.post("/resources/someapp/purge", data={"pattern": "^/static/"})
+        self.assertEqual(500, resp.status_code)
+        data = json.loads(resp.data)
+        self.assertEqual([{"unit": "someapp-0.cloud.tsuru.io", "ok": False,
+                           "error": "timed out"}], data["units"])
+
+    def test_purge_missing_pattern(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/purge", data={})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("pattern or expression is required", resp.data)
+
+    def test_purge_invalid_expression(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/purge",
+                             data={"expression": "req.url ~ a\nvcl.discard boot"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid ban expression", resp.data)
+
+    def test_purge_instance_not_found(self):
+        resp = self.api.post("/resources/someapp/purge", data={"pattern": "^/static/"})
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_purge_unauthorized(self):
+        self.set_auth_env("varnishapi", "varnish123")
+        self.addCleanup(self.delete_auth_env)
+        resp = self.open_with_auth("/resources/someapp/purge", method="POST",
+                                   data={"pattern": "^/static/"},
+                                   user="varnishapi", password="wat")
+        self.assertEqual(401, resp.status_code)
+        self.assertEqual("you do not have access to this resource", resp.data)
+
+    def test_set_params(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/params",
+                             data={"thread_pool_min": "100", "thread_pools": "4"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual({"thread_pool_min": 100, "thread_pools": 4}, json.loads(resp.data))
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual({"thread_pool_min": 100, "thread_pools": 4}, instance.params)
+
+    def test_set_params_missing_params(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/params", data={})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("at least one parameter is required", resp.data)
+
+    def test_set_params_instance_not_found(self):
+        resp = self.api.post("/resources/someapp/params", data={"thread_pools": "4"})
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_get_warm_urls(self):
+        self.manager.new_instance("someapp")
+        self.manager.set_warm_urls("someapp", ["http://someapp.com/"])
+        resp = self.api.get("/resources/someapp/warm-urls")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual({"urls": ["http://someapp.com/"], "warmups": []},
+                         json.loads(resp.data))
+
+    def test_get_warm_urls_instance_not_found(self):
+        resp = self.api.get("/resources/someapp/warm-urls")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_get_vcl_retries(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/vcl-retries")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual([{"instance_name": "someapp", "unit_id": "i-0800", "attempts": 10,
+                           "state": "dead", "error": "timed out"}],
+                         json.loads(resp.data))
+
+    def test_get_vcl_retries_instance_not_found(self):
+        resp = self.api.get("/resources/someapp/vcl-retries")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_requeue_vcl_retries(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/vcl-retries/requeue")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({"requeued": 1}, json.loads(resp.data))
+        resp = self.api.post("/resources/someapp/vcl-retries/requeue",
+                             data={"unit": "i-0801"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({"requeued": 0}, json.loads(resp.data))
+
+    def test_requeue_vcl_retries_instance_not_found(self):
+        resp = self.api.post("/resources/someapp/vcl-retries/requeue")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_set_warm_urls(self):
+        self.manager.new_instance("someapp")
+        urls = ["http://someapp.com/", "http://someapp.com/news?page=1"]
+        resp = self.api.put("/resources/someapp/warm-urls", data=json.dumps(urls),
+                            content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(urls, json.loads(resp.data))
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(urls, instance.warm_urls)
+
+    def test_set_warm_urls_invalid(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.put("/resources/someapp/warm-urls", data="{}",
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("urls must be a list", resp.data)
+
+    def test_set_warm_urls_invalid_json(self):
+        resp = self.api.put("/resources/someapp/warm-urls", data="[http://",
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("urls must be valid JSON", resp.data)
+
+    def test_set_warm_urls_instance_not_found(self):
+        resp = self.api.put("/resources/someapp/warm-urls", data="[]",
+                            content_type="application/json")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_get_metrics(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/metrics?minutes=30&step=300")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual([{"minutes": 30, "step": 300, "requests": 10, "hits": 9,
+                           "misses": 1, "hit_ratio": 0.9}], json.loads(resp.data))
+
+    def test_get_metrics_defaults(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/metrics")
+        self.assertEqual(200, resp.status_code)
+        points = json.loads(resp.data)
+        self.assertEqual(60, points[0]["minutes"])
+        self.assertIsNone(points[0]["step"])
+
+    def test_get_metrics_invalid(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/metrics?minutes=lots")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("minutes and step must be integers", resp.data)
+        resp = self.api.get("/resources/someapp/metrics?minutes=0")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("minutes must be a positive integer", resp.data)
+
+    def test_get_metrics_instance_not_found(self):
+        resp = self.api.get("/resources/someapp/metrics")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_get_schedule(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/schedule")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual({}, json.loads(resp.data))
+
+    def test_get_schedule_instance_not_found(self):
+        resp = self.api.get("/resources/someapp/schedule")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_set_schedule(self):
+        self.manager.new_instance("someapp")
+        scaling_schedule = {"default_units": 2,
+                            "rules": [{"start": "08:00", "end": "23:00", "units": 6,
+                                       "days": ["mon", "fri"]}]}
+        resp = self.api.put("/resources/someapp/schedule", data=json.dumps(scaling_schedule),
+                            content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual(scaling_schedule, json.loads(resp.data))
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(scaling_schedule, instance.schedule)
+
+    def test_set_schedule_invalid(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.put("/resources/someapp/schedule",
+                            data=json.dumps({"default_units": 2, "rules": []}),
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("rules must be a non-empty list", resp.data)
+
+    def test_set_schedule_invalid_json(self):
+        resp = self.api.put("/resources/someapp/schedule", data="{",
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("schedule must be valid JSON", resp.data)
+
+    def test_set_schedule_instance_not_found(self):
+        scaling_schedule = {"default_units": 2,
+                            "rules": [{"start": "08:00", "end": "23:00", "units": 6}]}
+        resp = self.api.put("/resources/someapp/schedule", data=json.dumps(scaling_schedule),
+                            content_type="application/json")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_remove_schedule(self):
+        self.manager.new_instance("someapp")
+        self.manager.set_schedule("someapp", {"default_units": 2,
+                                              "rules": [{"start": "08:00", "end": "23:00",
+                                                         "units": 6}]})
+        resp = self.api.delete("/resources/someapp/schedule")
+        self.assertEqual(200, resp.status_code)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual({}, instance.schedule)
+
+    def test_remove_schedule_instance_not_found(self):
+        resp = self.api.delete("/resources/someapp/schedule")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_get_autoscale(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.get("/resources/someapp/autoscale")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual({}, json.loads(resp.data))
+
+    def test_get_autoscale_instance_not_found(self):
+        resp = self.api.get("/resources/someapp/autoscale")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_set_autoscale(self):
+        self.manager.new_instance("someapp")
+        config = {"signal": "requests", "capacity": 500, "min_units": 2, "max_units": 4}
+        resp = self.api.put("/resources/someapp/autoscale", data=json.dumps(config),
+                            content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        stored = json.loads(resp.data)
+        self.assertEqual(2, stored["min_units"])
+        self.assertEqual(0.7, stored["target_utilization"])
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(stored, instance.autoscale)
+
+    def test_set_autoscale_invalid(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.put("/resources/someapp/autoscale",
+                            data=json.dumps({"signal": "requests", "capacity": 500,
+                                             "min_units": 5, "max_units": 4}),
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("min_units must not be greater than max_units", resp.data)
+
+    def test_set_autoscale_invalid_json(self):
+        resp = self.api.put("/resources/someapp/autoscale", data="{",
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("autoscale configuration must be valid JSON", resp.data)
+
+    def test_set_autoscale_instance_not_found(self):
+        config = {"signal": "requests", "capacity": 500, "min_units": 2, "max_units": 4}
+        resp = self.api.put("/resources/someapp/autoscale", data=json.dumps(config),
+                            content_type="application/json")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_disable_autoscale(self):
+        self.manager.new_instance("someapp")
+        self.manager.set_autoscale("someapp", {"signal": "requests", "capacity": 500,
+                                               "min_units": 2, "max_units": 4})
+        resp = self.api.delete("/resources/someapp/autoscale")
+        self.assertEqual(200, resp.status_code)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual({}, instance.autoscale)
+
+    def test_disable_autoscale_instance_not_found(self):
+        resp = self.api.delete("/resources/someapp/autoscale")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_get_cache_policy(self):
+        self.manager.new_instance("someapp")
+        self.manager.set_cache_policy("someapp", {"grace": 30})
+        resp = self.api.get("/resources/someapp/cache-policy")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        self.assertEqual({"grace": 30}, json.loads(resp.data))
+
+    def test_get_cache_policy_instance_not_found(self):
+        resp = self.api.get("/resources/someapp/cache-policy")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_set_cache_policy(self):
+        self.manager.new_instance("someapp")
+        policy = {"ttls": [{"url": "^/static/", "ttl": 3600}],
+                  "strip_cookies": ["^/static/"], "grace": 30}
+        resp = self.api.put("/resources/someapp/cache-policy", data=json.dumps(policy),
+                            content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(policy, json.loads(resp.data))
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual(policy, instance.cache_policy)
+
+    def test_set_cache_policy_invalid(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.put("/resources/someapp/cache-policy",
+                            data=json.dumps({"ttls": [{"url": "(", "ttl": 10}]}),
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid URL pattern in ttls: (", resp.data)
+
+    def test_set_cache_policy_invalid_json(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.put("/resources/someapp/cache-policy", data="{grace: 30",
+                            content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("cache policy must be valid JSON", resp.data)
+
+    def test_set_cache_policy_instance_not_found(self):
+        resp = self.api.put("/resources/someapp/cache-policy", data="{}",
+                            content_type="application/json")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
+    def test_preview_cache_policy(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/cache-policy/preview",
+                             data=json.dumps({"grace": 10}),
+                             content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("text/plain", resp.mimetype)
+        self.assertEqual('vcl of someapp with {"grace": 10}', resp.data)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual({}, instance.cache_policy)
+
+    def test_preview_cache_policy_stored(self):
+        self.manager.new_instance("someapp")
+        self.manager.set_cache_policy("someapp", {"grace": 30})
+        resp = self.api.post("/resources/someapp/cache-policy/preview")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('vcl of someapp with {"grace": 30}', resp.data)
+
+    def test_preview_cache_policy_invalid(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/cache-policy/preview",
+                             data=json.dumps({"grace": -1}),
+                             content_type="application/json")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("grace must be a non-negative integer", resp.data)
+
+    def test_preview_cache_policy_instance_not_found(self):
+        resp = self.api.post("/resources/someapp/cache-policy/preview")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("Instance not found", resp.data)
+
     def test_plugin(self):
         expected = inspect.getsource(plugin)
         resp = self.api.get("/plugin")
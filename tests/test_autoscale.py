@@ -0,0 +1,102 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import autoscale, storage
+
+
+class AutoscaleTestCase(unittest.TestCase):
+
+    def config(self, **kwargs):
+        config = {"signal": "requests", "capacity": 100, "min_units": 1, "max_units": 10}
+        config.update(kwargs)
+        return autoscale.validate(config)
+
+    def test_validate(self):
+        config = {"signal": "requests", "capacity": 500, "min_units": 2, "max_units": 10}
+        expected = {"signal": "requests", "capacity": 500, "min_units": 2, "max_units": 10,
+                    "target_utilization": 0.7, "tolerance": 0.1, "scale_up_cooldown": 120,
+                    "scale_down_cooldown": 600}
+        self.assertEqual(expected, autoscale.validate(config))
+
+    def test_validate_invalid(self):
+        base = {"signal": "requests", "capacity": 500, "min_units": 2, "max_units": 10}
+        cases = [([], "autoscale configuration must be an object"),
+                 ({"wat": 1}, "unknown autoscale field: wat"),
+                 ({"signal": "cpu"}, "invalid signal: cpu"),
+                 ({"capacity": 0}, "capacity must be a positive number"),
+                 ({"min_units": 0}, "min_units must be a positive integer"),
+                 ({"max_units": 2.5}, "max_units must be a positive integer"),
+                 ({"min_units": 11}, "min_units must not be greater than max_units"),
+                 ({"target_utilization": 1.5}, "target_utilization must be at most 1"),
+                 ({"target_utilization": True}, "target_utilization must be a positive number"),
+                 ({"tolerance": 1}, "tolerance must be at least 0 and less than 1"),
+                 ({"scale_up_cooldown": -1},
+                  "scale_up_cooldown must be a non-negative integer")]
+        for changes, msg in cases:
+            config = changes
+            if isinstance(changes, dict):
+                config = dict(base, **changes)
+            with self.assertRaises(ValueError) as cm:
+                autoscale.validate(config)
+            exc = cm.exception
+            self.assertEqual((msg,), exc.args)
+
+    def test_validate_missing_field(self):
+        with self.assertRaises(ValueError) as cm:
+            autoscale.validate({"signal": "requests", "min_units": 1, "max_units": 2})
+        exc = cm.exception
+        self.assertEqual(("capacity is required",), exc.args)
+
+    def test_desired_units_scale_up(self):
+        self.assertEqual(6, autoscale.desired_units(4, 100, self.config()))
+
+    def test_desired_units_scale_down(self):
+        self.assertEqual(2, autoscale.desired_units(4, 30, self.config()))
+
+    def test_desired_units_within_tolerance(self):
+        config = self.config()
+        self.assertEqual(4, autoscale.desired_units(4, 76, config))
+        self.assertEqual(4, autoscale.desired_units(4, 64, config))
+
+    def test_desired_units_bounds(self):
+        config = self.config(min_units=3, max_units=5)
+        self.assertEqual(5, autoscale.desired_units(4, 1000, config))
+        self.assertEqual(3, autoscale.desired_units(4, 1, config))
+        self.assertEqual(3, autoscale.desired_units(1, None, config))
+        self.assertEqual(5, autoscale.desired_units(8, None, config))
+
+    def test_request_rate(self):
+        strg = mock.Mock()
+        strg.retrieve_metrics.return_value = [
+            {"timestamp": datetime.datetime(2014, 2, 16, 12, 0), "requests": 900, "units": 2},
+            {"timestamp": datetime.datetime(2014, 2, 16, 12, 1), "requests": 600, "units": 2,
+             "backend_fetches": 60}]
+        instance = storage.Instance(name="myinstance")
+        with freezegun.freeze_time("2014-02-16 12:10:00"):
+            self.assertEqual(5, autoscale.RequestRate(strg).load(instance))
+        strg.retrieve_metrics.assert_called_with(
+            "myinstance", since=datetime.datetime(2014, 2, 16, 12, 0))
+        self.assertEqual(0.5, autoscale.BackendFetchRate(strg).load(instance))
+
+    def test_request_rate_not_enough_points(self):
+        strg = mock.Mock()
+        strg.retrieve_metrics.return_value = [
+            {"timestamp": datetime.datetime(2014, 2, 16, 12, 0), "requests": 900, "units": 2}]
+        signal = autoscale.RequestRate(strg)
+        self.assertIsNone(signal.load(storage.Instance(name="myinstance")))
+
+    def test_register_signal(self):
+        self.addCleanup(autoscale.signals.pop, "cpu")
+        source = mock.Mock()
+        autoscale.register_signal("cpu", source)
+        self.assertEqual(source, autoscale.signals["cpu"])
+        with self.assertRaises(ValueError):
+            autoscale.register_signal("cpu", mock.Mock())
+        autoscale.register_signal("cpu", source, override=True)
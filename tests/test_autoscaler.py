@@ -0,0 +1,135 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import autoscale, runners, storage
+from feaas.runners import autoscaler
+
+
+class AutoscalerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.signal = mock.Mock()
+        autoscale.register_signal("fake", lambda strg: self.signal)
+        self.addCleanup(autoscale.signals.pop, "fake")
+
+    def build_autoscaler(self, units=4, state="started", jobs=None):
+        strg = mock.Mock()
+        instance = storage.Instance(name="myinstance", state=state,
+                                    units=[storage.Unit(id="i-08%02d" % i)
+                                           for i in xrange(units)])
+        strg.retrieve_instance.return_value = instance
+        strg.retrieve_scale_jobs.return_value = jobs or []
+        manager = mock.Mock(storage=strg)
+        return autoscaler.Autoscaler(manager)
+
+    def config(self, **kwargs):
+        config = autoscale.validate({"signal": "fake", "capacity": 100, "min_units": 1,
+                                     "max_units": 10})
+        config["instance_name"] = "myinstance"
+        config.update(kwargs)
+        return config
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        scaler = autoscaler.Autoscaler(manager, interval=30)
+        self.assertEqual(30, scaler.interval)
+        scaler.locker.lock(scaler.lock_name)
+        scaler.locker.unlock(scaler.lock_name)
+
+    def test_inherits_from_base_runner(self):
+        self.assertIsInstance(self.build_autoscaler(), runners.Base)
+
+    def test_run(self):
+        scaler = self.build_autoscaler()
+        scaler.locker = mock.Mock()
+        scaler.evaluate = mock.Mock()
+        configs = [self.config(), self.config(instance_name="other")]
+        scaler.storage.retrieve_autoscale.return_value = configs
+        scaler.run()
+        scaler.locker.lock.assert_called_with(scaler.lock_name)
+        self.assertEqual([mock.call(configs[0]), mock.call(configs[1])],
+                         scaler.evaluate.call_args_list)
+        scaler.locker.unlock.assert_called_with(scaler.lock_name)
+
+    def test_evaluate_scale_up(self):
+        scaler = self.build_autoscaler()
+        self.signal.load.return_value = 105
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            scaler.evaluate(self.config())
+        scaler.storage.retrieve_instance.assert_called_with(name="myinstance",
+                                                            check_liveness=True)
+        scaler.storage.retrieve_scale_jobs.assert_called_with(
+            instance="myinstance", state={"$in": ["pending", "processing"]})
+        scaler.manager.scale_instance.assert_called_with("myinstance", 6)
+        scaler.storage.update_autoscale.assert_called_with(
+            "myinstance", last_scaled_at=datetime.datetime(2014, 2, 16, 12, 0),
+            last_decision={"from": 4, "to": 6, "load": 105})
+
+    def test_evaluate_within_tolerance(self):
+        scaler = self.build_autoscaler()
+        self.signal.load.return_value = 72
+        scaler.evaluate(self.config())
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    def test_evaluate_no_data(self):
+        scaler = self.build_autoscaler()
+        self.signal.load.return_value = None
+        scaler.evaluate(self.config())
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    def test_evaluate_cooldown(self):
+        scaler = self.build_autoscaler()
+        self.signal.load.return_value = 10
+        config = self.config(last_scaled_at=datetime.datetime(2014, 2, 16, 11, 55))
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            scaler.evaluate(config)
+        self.assertFalse(scaler.manager.scale_instance.called)
+        self.signal.load.return_value = 150
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            scaler.evaluate(config)
+        scaler.manager.scale_instance.assert_called_with("myinstance", 9)
+
+    def test_evaluate_instance_not_started(self):
+        scaler = self.build_autoscaler(state="scaling")
+        scaler.evaluate(self.config())
+        self.assertFalse(self.signal.load.called)
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    def test_evaluate_pending_job(self):
+        scaler = self.build_autoscaler(jobs=[{"instance": "myinstance", "quantity": 2,
+                                              "state": "pending"}])
+        scaler.evaluate(self.config())
+        self.assertFalse(self.signal.load.called)
+
+    def test_evaluate_instance_not_found(self):
+        scaler = self.build_autoscaler()
+        scaler.storage.retrieve_instance.side_effect = storage.InstanceNotFoundError()
+        scaler.evaluate(self.config())
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    @mock.patch("sys.stderr")
+    def test_evaluate_signal_failure(self, stderr):
+        scaler = self.build_autoscaler()
+        self.signal.load.side_effect = ValueError("no route to host")
+        scaler.evaluate(self.config())
+        self.assertFalse(scaler.manager.scale_instance.called)
+        stderr.write.assert_called_with("[ERROR] failed to read the load of myinstance: "
+                                        "no route to host\n")
+
+    @mock.patch("sys.stderr")
+    def test_evaluate_scale_failure(self, stderr):
+        scaler = self.build_autoscaler()
+        self.signal.load.return_value = 105
+        scaler.manager.scale_instance.side_effect = ValueError("instance is already scaling")
+        scaler.evaluate(self.config())
+        self.assertFalse(scaler.storage.update_autoscale.called)
+        stderr.write.assert_called_with("[ERROR] failed to scale myinstance: "
+                                        "instance is already scaling\n")
@@ -2,11 +2,17 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import hashlib
+import json
+import os
+import tempfile
 import unittest
 
+import freezegun
 import mock
 
-from feaas import managers, storage as api_storage
+from feaas import breaker, managers, storage as api_storage
 
 
 class BaseManagerTestCase(unittest.TestCase):
@@ -21,6 +27,74 @@ class BaseManagerTestCase(unittest.TestCase):
         instance = manager.new_instance("someapp")
         storage.store_instance.assert_called_with(instance)
 
+    def test_new_instance_plan(self):
+        os.environ["API_PLANS"] = json.dumps([{"name": "small"}, {"name": "large"}])
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        instance = manager.new_instance("someapp", plan="large")
+        self.assertEqual("large", instance.plan)
+        instance = manager.new_instance("otherapp")
+        self.assertEqual("small", instance.plan)
+
+    def test_new_instance_invalid_plan(self):
+        os.environ["API_PLANS"] = json.dumps([{"name": "small"}])
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(ValueError) as cm:
+            manager.new_instance("someapp", plan="huge")
+        exc = cm.exception
+        self.assertEqual(("invalid plan: huge",), exc.args)
+        self.assertFalse(storage.store_instance.called)
+
+    def test_instance_plan(self):
+        os.environ["API_PLANS"] = json.dumps([{"name": "small"}, {"name": "large"}])
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        manager = managers.BaseManager(None)
+        instance = api_storage.Instance(name="someapp", plan="large")
+        self.assertEqual({"name": "large"}, manager.instance_plan(instance))
+        self.assertIsNone(manager.instance_plan(api_storage.Instance(name="someapp")))
+
+    @mock.patch("sys.stderr")
+    def test_instance_plan_removed(self, stderr):
+        os.environ["API_PLANS"] = json.dumps([{"name": "small"}, {"name": "large"}])
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        manager = managers.BaseManager(None)
+        instance = api_storage.Instance(name="someapp", plan="huge")
+        self.assertEqual({"name": "small"}, manager.instance_plan(instance))
+        stderr.write.assert_called_with("[ERROR] plan huge of someapp not found, "
+                                        "using the default plan (small)\n")
+
+    @mock.patch("sys.stderr")
+    def test_instance_plan_removed_without_plans(self, stderr):
+        manager = managers.BaseManager(None)
+        instance = api_storage.Instance(name="someapp", plan="huge")
+        self.assertIsNone(manager.instance_plan(instance))
+        self.assertTrue(stderr.write.called)
+
+    @mock.patch("sys.stderr")
+    def test_instance_plan_removed_with_invalid_default(self, stderr):
+        manager = managers.BaseManager(None)
+        os.environ["API_PLANS"] = json.dumps([{"name": "small"}])
+        os.environ["DEFAULT_PLAN"] = "large"
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        self.addCleanup(os.environ.pop, "DEFAULT_PLAN")
+        instance = api_storage.Instance(name="someapp", plan="huge")
+        self.assertIsNone(manager.instance_plan(instance))
+        stderr.write.assert_called_with("[ERROR] default plan large not found, "
+                                        "using no plan\n")
+
+    def test_init_invalid_default_plan(self):
+        os.environ["API_PLANS"] = json.dumps([{"name": "small"}])
+        os.environ["DEFAULT_PLAN"] = "large"
+        self.addCleanup(os.environ.pop, "API_PLANS")
+        self.addCleanup(os.environ.pop, "DEFAULT_PLAN")
+        with self.assertRaises(ValueError) as cm:
+            managers.BaseManager(None)
+        self.assertEqual("default plan large is not in API_PLANS", str(cm.exception))
+
     def test_new_duplicate_instance(self):
         storage = mock.Mock()
         storage.retrieve_instance.return_value = "instance"
@@ -43,23 +117,32 @@ class BaseManagerTestCase(unittest.TestCase):
         storage.store_bind.assert_called_with("abacaxi")
         Bind.assert_called_with("myapp.cloud.tsuru.io", instance)
 
-    @mock.patch("feaas.storage.Bind")
-    def test_unbind_instance(self, Bind):
-        Bind.return_value = "abacaxi"
+    def test_unbind_instance(self):
         instance = api_storage.Instance(name="myinstance",
                                         units=[api_storage.Unit(id="i-0800",
                                                                 secret="abc-123",
                                                                 dns_name="10.1.1.2")])
+        bind = api_storage.Bind("myapp.cloud.tsuru.io", instance, state="created")
         storage = mock.Mock()
         storage.retrieve_instance.return_value = instance
+        storage.retrieve_binds.return_value = [bind]
         manager = managers.BaseManager(storage)
-        remove_vcl = mock.Mock()
-        manager.remove_vcl = remove_vcl
+        manager.remove_vcl = mock.Mock()
         manager.unbind("someapp", "myapp.cloud.tsuru.io")
         storage.retrieve_instance.assert_called_with(name="someapp")
-        storage.remove_bind.assert_called_with("abacaxi")
-        Bind.assert_called_with("myapp.cloud.tsuru.io", instance)
-        remove_vcl.assert_called_with("10.1.1.2", "abc-123")
+        storage.retrieve_binds.assert_called_with(instance_name="someapp",
+                                                  app_host="myapp.cloud.tsuru.io")
+        storage.update_bind.assert_called_with(bind, state="removing")
+        self.assertFalse(storage.remove_bind.called)
+        self.assertFalse(manager.remove_vcl.called)
+
+    def test_unbind_instance_not_found(self):
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(api_storage.InstanceNotFoundError):
+            manager.unbind("someapp", "myapp.cloud.tsuru.io")
+        self.assertFalse(storage.update_bind.called)
 
     def test_vcl_template(self):
         manager = managers.BaseManager(None)
@@ -69,29 +152,189 @@ class BaseManagerTestCase(unittest.TestCase):
             self.assertEqual('"%s"' % content.strip(),
                              manager.vcl_template())
 
+    def test_render_vcl(self):
+        manager = managers.BaseManager(None)
+        vcl = manager.render_vcl(backends="backend app0 {\n\t.host = \"a\";\n}",
+                                 director="hash", director_members="",
+                                 recv_policy='\tset req.url = regsub(req.url, "\\?$", "");',
+                                 fetch_policy="")
+        expected_params = {"backends": r'backend app0 { .host = \"a\"; }',
+                           "director": "hash", "director_members": "",
+                           "recv_policy": r'set req.url = regsub(req.url, \"\\?$\", \"\");',
+                           "fetch_policy": ""}
+        self.assertEqual(manager.vcl_template() % expected_params, vcl)
+
+    def test_vcl_params(self):
+        manager = managers.BaseManager(None)
+        params = manager.vcl_params(["app1.cloud.tsuru.io", "app2.cloud.tsuru.io"])
+        expected_backends = """backend app0 {
+\t.host = "app1.cloud.tsuru.io";
+\t.port = "80";
+\t.host_header = "app1.cloud.tsuru.io";
+}
+
+backend app1 {
+\t.host = "app2.cloud.tsuru.io";
+\t.port = "80";
+\t.host_header = "app2.cloud.tsuru.io";
+}"""
+        expected = {"backends": expected_backends, "director": "round-robin",
+                    "director_members": "\t{ .backend = app0; }\n\t{ .backend = app1; }",
+                    "recv_policy": "", "fetch_policy": ""}
+        self.assertEqual(expected, params)
+
+    def test_vcl_params_cache_policy(self):
+        manager = managers.BaseManager(None)
+        params = manager.vcl_params(["app1.cloud.tsuru.io"], {"grace": 30})
+        self.assertEqual("\tset req.grace = 30s;", params["recv_policy"])
+        self.assertEqual("\tset beresp.grace = 30s;", params["fetch_policy"])
+
+    def test_vcl_params_backend_probe(self):
+        manager = managers.BaseManager(None)
+        policy = {"probe": {"url": "/", "interval": 1, "timeout": 1, "window": 3,
+                            "threshold": 2}}
+        params = manager.vcl_params(["app1.cloud.tsuru.io", "app2.cloud.tsuru.io"], policy)
+        expected = """\t.host_header = "app2.cloud.tsuru.io";
+\t.probe = {
+\t\t.request = "GET / HTTP/1.1" "Host: app2.cloud.tsuru.io" "Connection: close";"""
+        self.assertIn(expected, params["backends"])
+        self.assertEqual(2, params["backends"].count(".probe = {"))
+
+    def test_vcl_params_hash_director(self):
+        os.environ["VCL_DIRECTOR"] = "hash"
+        self.addCleanup(os.environ.pop, "VCL_DIRECTOR")
+        manager = managers.BaseManager(None)
+        params = manager.vcl_params(["app1.cloud.tsuru.io", "app2.cloud.tsuru.io"])
+        self.assertEqual("hash", params["director"])
+        self.assertEqual("\t{ .backend = app0; .weight = 1; }\n" +
+                         "\t{ .backend = app1; .weight = 1; }",
+                         params["director_members"])
+
+    def test_vcl_params_invalid_director(self):
+        os.environ["VCL_DIRECTOR"] = "fallback"
+        self.addCleanup(os.environ.pop, "VCL_DIRECTOR")
+        manager = managers.BaseManager(None)
+        with self.assertRaises(ValueError) as cm:
+            manager.vcl_params(["app1.cloud.tsuru.io"])
+        exc = cm.exception
+        self.assertEqual(("fallback is not a valid director",), exc.args)
+
+    def test_instance_vcl(self):
+        manager = managers.BaseManager(None)
+        hosts = ["app1.cloud.tsuru.io", "app2.cloud.tsuru.io"]
+        vcl = manager.instance_vcl(hosts)
+        self.assertEqual(manager.render_vcl(**manager.vcl_params(hosts)), vcl)
+        self.assertIn(r'.host = \"app2.cloud.tsuru.io\";', vcl)
+        self.assertNotIn("\n", vcl)
+
     @mock.patch("varnish.VarnishHandler")
     def test_write_vcl(self, VarnishHandler):
         varnish_handler = mock.Mock()
+        varnish_handler.fetch.return_value = ((200, 10), "active 0 boot\n")
         VarnishHandler.return_value = varnish_handler
-        app_host, instance_ip = "yeah.cloud.tsuru.io", "10.2.1.2"
-        manager = managers.BaseManager(None)
-        manager.write_vcl(instance_ip, "abc-def", app_host)
-        vcl = manager.vcl_template() % {"app_host": app_host}
-        VarnishHandler.assert_called_with("{0}:6082".format(instance_ip),
-                                          secret="abc-def")
-        varnish_handler.vcl_inline.assert_called_with("feaas", vcl)
-        varnish_handler.vcl_use.assert_called_with("feaas")
-        varnish_handler.quit.assert_called()
+        app_hosts = ["yeah.cloud.tsuru.io", "yo.cloud.tsuru.io"]
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def")
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        self.assertTrue(manager.write_vcl(unit, app_hosts))
+        vcl = manager.instance_vcl(app_hosts)
+        vcl_hash = hashlib.sha1(vcl).hexdigest()
+        name = "feaas_" + vcl_hash[:16]
+        VarnishHandler.assert_called_with("10.2.1.2:6082", secret="abc-def")
+        varnish_handler.vcl_inline.assert_called_with(name, vcl)
+        varnish_handler.vcl_use.assert_called_with(name)
+        varnish_handler.fetch.assert_called_with("vcl.list")
+        self.assertFalse(varnish_handler.vcl_discard.called)
+        self.assertTrue(varnish_handler.quit.called)
+        self.assertEqual(vcl_hash, unit.vcl_hash)
+        storage.update_units.assert_called_with([unit], vcl_hash=vcl_hash)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_write_vcl_cache_policy(self, VarnishHandler):
+        varnish_handler = mock.Mock()
+        varnish_handler.fetch.return_value = ((200, 10), "active 0 boot\n")
+        VarnishHandler.return_value = varnish_handler
+        app_hosts = ["yeah.cloud.tsuru.io"]
+        policy = {"ttls": [{"url": "\\.css$", "ttl": 600}]}
+        vcl_hash = hashlib.sha1(self.manager.instance_vcl(app_hosts)).hexdigest()
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def",
+                                vcl_hash=vcl_hash)
+        manager = managers.BaseManager(mock.Mock())
+        self.assertTrue(manager.write_vcl(unit, app_hosts, policy=policy))
+        vcl = manager.instance_vcl(app_hosts, policy)
+        self.assertIn(r'if (req.url ~ \"\\.css$\") { set beresp.ttl = 600s; }', vcl)
+        name = "feaas_" + hashlib.sha1(vcl).hexdigest()[:16]
+        varnish_handler.vcl_inline.assert_called_with(name, vcl)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_write_vcl_discards_old_vcls(self, VarnishHandler):
+        vcl_list = """available       0 boot
+available       0 feaas
+discarded       1 feaas_000
+available       0 feaas_111
+available       0 feaas_222
+available       3 feaas_333
+active          1 feaas_444
+"""
+        varnish_handler = mock.Mock()
+        varnish_handler.fetch.return_value = ((200, len(vcl_list)), vcl_list)
+        varnish_handler.vcl_discard.side_effect = [AssertionError("busy"), None]
+        VarnishHandler.return_value = varnish_handler
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def")
+        manager = managers.BaseManager(mock.Mock())
+        manager.write_vcl(unit, ["yeah.cloud.tsuru.io"])
+        self.assertEqual([mock.call("feaas"), mock.call("feaas_111")],
+                         varnish_handler.vcl_discard.call_args_list)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_write_vcl_keep_loaded_from_env(self, VarnishHandler):
+        os.environ["VCL_KEEP_LOADED"] = "1"
+        self.addCleanup(os.environ.pop, "VCL_KEEP_LOADED")
+        vcl_list = "available 0 boot\navailable 0 feaas_111\nactive 1 feaas_222\n"
+        varnish_handler = mock.Mock()
+        varnish_handler.fetch.return_value = ((200, len(vcl_list)), vcl_list)
+        VarnishHandler.return_value = varnish_handler
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def")
+        manager = managers.BaseManager(mock.Mock())
+        manager.write_vcl(unit, ["yeah.cloud.tsuru.io"])
+        varnish_handler.vcl_discard.assert_called_once_with("feaas_111")
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_write_vcl_same_hash(self, VarnishHandler):
+        manager = managers.BaseManager(mock.Mock())
+        vcl = manager.instance_vcl(["yeah.cloud.tsuru.io"])
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def",
+                                vcl_hash=hashlib.sha1(vcl).hexdigest())
+        self.assertFalse(manager.write_vcl(unit, ["yeah.cloud.tsuru.io"]))
+        self.assertFalse(VarnishHandler.called)
+        self.assertFalse(manager.storage.update_units.called)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_write_vcl_same_hash_force(self, VarnishHandler):
+        varnish_handler = mock.Mock()
+        varnish_handler.fetch.return_value = ((200, 0), "")
+        VarnishHandler.return_value = varnish_handler
+        manager = managers.BaseManager(mock.Mock())
+        vcl = manager.instance_vcl(["yeah.cloud.tsuru.io"])
+        vcl_hash = hashlib.sha1(vcl).hexdigest()
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def",
+                                vcl_hash=vcl_hash)
+        self.assertTrue(manager.write_vcl(unit, ["yeah.cloud.tsuru.io"], force=True))
+        varnish_handler.vcl_inline.assert_called_with("feaas_" + vcl_hash[:16], vcl)
 
     @mock.patch("varnish.VarnishHandler")
-    def test_write_vcl_ignores_106(self, VarnishHandler):
+    def test_write_vcl_already_loaded(self, VarnishHandler):
         varnish_handler = mock.Mock()
-        exc = AssertionError("106 Already a VCL program named feaas")
+        varnish_handler.fetch.return_value = ((200, 0), "")
+        exc = AssertionError("106 Already a VCL program named feaas_abc")
         varnish_handler.vcl_inline.side_effect = exc
         VarnishHandler.return_value = varnish_handler
-        app_host, instance_ip = "yeah.cloud.tsuru.io", "10.2.1.2"
-        manager = managers.BaseManager(None)
-        manager.write_vcl(instance_ip, "abc-def", app_host)
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def")
+        manager = managers.BaseManager(mock.Mock())
+        self.assertTrue(manager.write_vcl(unit, ["yeah.cloud.tsuru.io"]))
+        vcl_name = "feaas_" + unit.vcl_hash[:16]
+        varnish_handler.vcl_use.assert_called_with(vcl_name)
+        self.assertTrue(varnish_handler.quit.called)
 
     @mock.patch("varnish.VarnishHandler")
     def test_write_vcl_doesnt_swallow_exceptions_that_arent_106(self, VarnishHandler):
@@ -99,24 +342,508 @@ class BaseManagerTestCase(unittest.TestCase):
         exc = AssertionError("Something went wrong")
         varnish_handler.vcl_inline.side_effect = exc
         VarnishHandler.return_value = varnish_handler
-        app_host, instance_ip = "yeah.cloud.tsuru.io", "10.2.1.2"
-        manager = managers.BaseManager(None)
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.1.2", secret="abc-def")
+        manager = managers.BaseManager(mock.Mock())
         with self.assertRaises(AssertionError) as cm:
-            manager.write_vcl(instance_ip, "abc-def", app_host)
+            manager.write_vcl(unit, ["yeah.cloud.tsuru.io"])
         exc = cm.exception
         self.assertEqual(("Something went wrong",), exc.args)
+        self.assertIsNone(unit.vcl_hash)
+        self.assertFalse(varnish_handler.vcl_use.called)
+        self.assertTrue(varnish_handler.quit.called)
+        self.assertFalse(manager.storage.update_units.called)
 
     @mock.patch("varnish.VarnishHandler")
     def test_remove_vcl(self, VarnishHandler):
+        vcl_list = "active 0 boot\navailable 0 feaas_111\navailable 1 feaas_222\n"
         varnish_handler = mock.Mock()
+        varnish_handler.fetch.return_value = ((200, len(vcl_list)), vcl_list)
         VarnishHandler.return_value = varnish_handler
-        instance_ip = "10.2.2.1"
-        manager = managers.BaseManager(None)
-        manager.remove_vcl(instance_ip, "abc123")
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.2.1", secret="abc123",
+                                vcl_hash="abc")
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        manager.remove_vcl(unit)
         VarnishHandler.assert_called_with("10.2.2.1:6082", secret="abc123")
         varnish_handler.vcl_use.assert_called_with("boot")
-        varnish_handler.vcl_discard.assert_called_with("feaas")
-        varnish_handler.quit.assert_called()
+        self.assertEqual([mock.call("feaas_111"), mock.call("feaas_222")],
+                         varnish_handler.vcl_discard.call_args_list)
+        self.assertTrue(varnish_handler.quit.called)
+        self.assertIsNone(unit.vcl_hash)
+        storage.update_units.assert_called_with([unit], vcl_hash=None)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_admin_circuit_breaker(self, VarnishHandler):
+        VarnishHandler.side_effect = IOError("timed out")
+        unit = api_storage.Unit(id="i-0800", dns_name="10.2.2.1", secret="abc123",
+                                vcl_hash="abc")
+        manager = managers.BaseManager(mock.Mock())
+        for _ in xrange(managers.BREAKER_THRESHOLD):
+            with self.assertRaises(IOError):
+                manager.remove_vcl(unit)
+        with self.assertRaises(breaker.CircuitOpenError):
+            manager.write_vcl(unit, ["yeah.cloud.tsuru.io"])
+        self.assertEqual(managers.BREAKER_THRESHOLD, VarnishHandler.call_count)
+        self.assertEqual("open", manager.breaker.state("10.2.2.1"))
+
+    @mock.patch("telnetlib.Telnet")
+    def test_is_unit_up(self, Telnet):
+        telnet_client = mock.Mock()
+        Telnet.return_value = telnet_client
+        unit = api_storage.Unit(dns_name="instance1.cloud.tsuru.io")
+        manager = managers.BaseManager(None)
+        self.assertTrue(manager.is_unit_up(unit))
+        Telnet.assert_called_with(unit.dns_name, "6082", timeout=3)
+        self.assertEqual(1, telnet_client.close.call_count)
+
+    @mock.patch("telnetlib.Telnet")
+    def test_is_unit_up_down(self, Telnet):
+        Telnet.side_effect = ValueError("connection refused")
+        unit = api_storage.Unit(dns_name="instance1.cloud.tsuru.io")
+        manager = managers.BaseManager(None)
+        self.assertFalse(manager.is_unit_up(unit))
+        Telnet.assert_called_with(unit.dns_name, "6082", timeout=3)
+
+    @mock.patch("telnetlib.Telnet")
+    def test_is_unit_up_circuit_open(self, Telnet):
+        Telnet.side_effect = IOError("timed out")
+        unit = api_storage.Unit(dns_name="instance1.cloud.tsuru.io")
+        manager = managers.BaseManager(None)
+        manager.breaker = breaker.CircuitBreaker(threshold=2)
+        for _ in xrange(3):
+            self.assertFalse(manager.is_unit_up(unit))
+        self.assertEqual(2, Telnet.call_count)
+
+    def test_breaker_from_env(self):
+        os.environ["BREAKER_THRESHOLD"] = "2"
+        self.addCleanup(os.environ.pop, "BREAKER_THRESHOLD")
+        os.environ["BREAKER_COOLDOWN"] = "60"
+        self.addCleanup(os.environ.pop, "BREAKER_COOLDOWN")
+        manager = managers.BaseManager(mock.Mock())
+        self.assertEqual(2, manager.breaker.threshold)
+        self.assertEqual(60, manager.breaker.cooldown)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_purge_pattern(self, VarnishHandler):
+        handlers = {"10.1.1.1:6082": mock.Mock(), "10.1.1.2:6082": mock.Mock()}
+        VarnishHandler.side_effect = lambda addr, secret: handlers[addr]
+        units = [api_storage.Unit(id="i-0800", dns_name="10.1.1.1", secret="abc",
+                                  state="started"),
+                 api_storage.Unit(id="i-0801", dns_name="10.1.1.2", secret="def",
+                                  state="started"),
+                 api_storage.Unit(id="i-0802", dns_name="10.1.1.3", secret="ghi",
+                                  state="creating")]
+        instance = api_storage.Instance(name="secret", units=units)
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        result = manager.purge("secret", pattern='^/static/"')
+        expression = r'req.url ~ "^/static/\""'
+        self.assertEqual(expression, result["expression"])
+        for handler in handlers.values():
+            handler.ban.assert_called_once_with(expression)
+            handler.quit.assert_called_once_with()
+        self.assertEqual(["10.1.1.1", "10.1.1.2"], [u["unit"] for u in result["units"]])
+        self.assertEqual([True, True], [u["ok"] for u in result["units"]])
+        self.assertIn("latency", result["units"][0])
+        self.assertGreaterEqual(result["latency"], 0)
+        storage.retrieve_instance.assert_called_with(name="secret")
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_purge_expression_unit_failure(self, VarnishHandler):
+        handler = mock.Mock()
+        handler.ban.side_effect = [AssertionError("Bad response code: 106 Syntax error"),
+                                   None]
+        VarnishHandler.return_value = handler
+        units = [api_storage.Unit(id="i-0800", dns_name="10.1.1.1", state="started")]
+        instance = api_storage.Instance(name="secret", units=units)
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        result = manager.purge("secret", expression="obj.http.X ~ y")
+        self.assertEqual("obj.http.X ~ y", result["expression"])
+        self.assertEqual([{"unit": "10.1.1.1", "ok": False,
+                           "error": "Bad response code: 106 Syntax error"}],
+                         result["units"])
+        handler.quit.assert_called_once_with()
+
+    def test_purge_missing_pattern(self):
+        manager = managers.BaseManager(mock.Mock())
+        with self.assertRaises(ValueError) as cm:
+            manager.purge("secret")
+        exc = cm.exception
+        self.assertEqual(("pattern or expression is required",), exc.args)
+
+    def test_purge_invalid_expression(self):
+        manager = managers.BaseManager(mock.Mock())
+        with self.assertRaises(ValueError) as cm:
+            manager.purge("secret", pattern="/a\nvcl.use boot")
+        exc = cm.exception
+        self.assertEqual(("invalid ban expression",), exc.args)
+        self.assertFalse(manager.storage.retrieve_instance.called)
+
+    def test_purge_instance_not_found(self):
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(api_storage.InstanceNotFoundError):
+            manager.purge("secret", pattern="/")
+
+    def test_set_params(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        params = manager.set_params("secret", {"thread_pool_min": "100", "thread_pools": 4})
+        self.assertEqual({"thread_pool_min": 100, "thread_pools": 4}, params)
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.store_varnish_params.assert_called_with("secret", params)
+
+    def test_set_params_empty(self):
+        manager = managers.BaseManager(mock.Mock())
+        with self.assertRaises(ValueError) as cm:
+            manager.set_params("secret", {})
+        exc = cm.exception
+        self.assertEqual(("at least one parameter is required",), exc.args)
+
+    def test_set_params_unknown_param(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(ValueError) as cm:
+            manager.set_params("secret", {"cc_command": "rm -rf /"})
+        exc = cm.exception
+        self.assertEqual(("cc_command is not a tunable parameter",), exc.args)
+        self.assertFalse(storage.store_varnish_params.called)
+
+    def test_set_params_invalid_value(self):
+        manager = managers.BaseManager(mock.Mock())
+        for value in ("lots", "-1"):
+            with self.assertRaises(ValueError) as cm:
+                manager.set_params("secret", {"thread_pools": value})
+            exc = cm.exception
+            self.assertEqual(("invalid value for thread_pools: " + value,), exc.args)
+
+    def test_set_params_instance_not_found(self):
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(api_storage.InstanceNotFoundError):
+            manager.set_params("secret", {"thread_pools": 4})
+        self.assertFalse(storage.store_varnish_params.called)
+
+    def test_get_warm_urls(self):
+        storage = mock.Mock()
+        storage.retrieve_warm_urls.return_value = [{"instance_name": "secret",
+                                                    "urls": ["http://myapp.com/"]}]
+        storage.retrieve_warmups.return_value = [{"unit_id": "i-0800", "coverage": 1.0}]
+        manager = managers.BaseManager(storage)
+        result = manager.get_warm_urls("secret")
+        self.assertEqual({"urls": ["http://myapp.com/"],
+                          "warmups": [{"unit_id": "i-0800", "coverage": 1.0}]}, result)
+        storage.retrieve_instance.assert_called_with(name="secret")
+
+    def test_get_vcl_retries(self):
+        storage = mock.Mock()
+        retries = [{"instance_name": "secret", "unit_id": "i-0800", "attempts": 10,
+                    "state": "dead"}]
+        storage.retrieve_vcl_retries.return_value = retries
+        manager = managers.BaseManager(storage)
+        self.assertEqual(retries, manager.get_vcl_retries("secret"))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.retrieve_vcl_retries.assert_called_with(instance_name="secret")
+
+    def test_requeue_vcl_retries(self):
+        storage = mock.Mock()
+        storage.requeue_vcl_retries.return_value = 2
+        manager = managers.BaseManager(storage)
+        self.assertEqual(2, manager.requeue_vcl_retries("secret"))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.requeue_vcl_retries.assert_called_with("secret", None)
+
+    def test_requeue_vcl_retries_instance_not_found(self):
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(api_storage.InstanceNotFoundError):
+            manager.requeue_vcl_retries("secret", "i-0800")
+        self.assertFalse(storage.requeue_vcl_retries.called)
+
+    def test_get_warm_urls_not_stored(self):
+        storage = mock.Mock()
+        storage.retrieve_warm_urls.return_value = []
+        storage.retrieve_warmups.return_value = []
+        manager = managers.BaseManager(storage)
+        self.assertEqual({"urls": [], "warmups": []}, manager.get_warm_urls("secret"))
+
+    def test_set_warm_urls(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        urls = ["http://myapp.com/", "https://myapp.com/news?page=2"]
+        self.assertEqual(urls, manager.set_warm_urls("secret", urls))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.store_warm_urls.assert_called_with("secret", urls)
+
+    def test_set_warm_urls_invalid(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        for urls, msg in [("http://myapp.com/", "urls must be a list"),
+                          (["/news"], "invalid url: /news"),
+                          (["ftp://myapp.com/"], "invalid url: ftp://myapp.com/"),
+                          ([42], "invalid url: 42")]:
+            with self.assertRaises(ValueError) as cm:
+                manager.set_warm_urls("secret", urls)
+            exc = cm.exception
+            self.assertEqual((msg,), exc.args)
+        self.assertFalse(storage.store_warm_urls.called)
+
+    def test_set_warm_urls_too_many(self):
+        manager = managers.BaseManager(mock.Mock())
+        urls = ["http://myapp.com/%d" % i for i in xrange(managers.WARM_URLS_LIMIT + 1)]
+        with self.assertRaises(ValueError) as cm:
+            manager.set_warm_urls("secret", urls)
+        exc = cm.exception
+        self.assertEqual(("at most 1000 urls are allowed",), exc.args)
+
+    @mock.patch("httplib2.Http")
+    def test_warm_unit(self, Http):
+        statuses = {"http://10.0.0.1:8080/": 200, "http://10.0.0.1:8080/news?page=1": 200,
+                    "http://10.0.0.1:8080/missing": 404}
+        http = mock.Mock()
+        http.request.side_effect = lambda url, headers: (mock.Mock(status=statuses[url]), "")
+        Http.return_value = http
+        unit = api_storage.Unit(id="i-0800", dns_name="10.0.0.1")
+        manager = managers.BaseManager(mock.Mock())
+        urls = ["http://myapp.com", "http://myapp.com/news?page=1", "http://myapp.com/missing",
+                "http://myapp.com/down"]
+        result = manager.warm_unit(unit, urls, max_workers=2)
+        self.assertEqual(4, result["urls"])
+        self.assertEqual(2, result["warmed"])
+        self.assertEqual(0.5, result["coverage"])
+        self.assertTrue(result["duration"] >= 0)
+        Http.assert_called_with(timeout=managers.WARM_TIMEOUT)
+        http.request.assert_any_call("http://10.0.0.1:8080/news?page=1",
+                                     headers={"Host": "myapp.com"})
+
+    @mock.patch("time.time")
+    @mock.patch("httplib2.Http")
+    def test_warm_unit_deadline(self, Http, time):
+        clock = [100.0]
+        time.side_effect = lambda: clock[0]
+
+        def request(url, headers):
+            clock[0] += 3
+            return mock.Mock(status=200), ""
+
+        http = mock.Mock()
+        http.request.side_effect = request
+        Http.return_value = http
+        unit = api_storage.Unit(id="i-0800", dns_name="10.0.0.1")
+        manager = managers.BaseManager(mock.Mock())
+        urls = ["http://myapp.com/a", "http://myapp.com/b", "http://myapp.com/c",
+                "http://myapp.com/d"]
+        result = manager.warm_unit(unit, urls, max_workers=1, deadline=105.0)
+        self.assertEqual(4, result["urls"])
+        self.assertEqual(2, result["warmed"])
+        self.assertEqual(0.5, result["coverage"])
+        self.assertEqual([mock.call(timeout=5), mock.call(timeout=2.0)], Http.call_args_list)
+
+    @mock.patch("httplib2.Http")
+    def test_unit_stats(self, Http):
+        content = json.dumps({"timestamp": "2014-02-16T12:00:01",
+                              "client_req": {"value": 100, "description": "Client requests"},
+                              "cache_hit": {"value": 80}, "MAIN.cache_miss": {"value": 20},
+                              "backend_req": {"value": 21}, "n_object": {"value": 300},
+                              "n_wrk": {"value": 10}})
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=200), content)
+        Http.return_value = http
+        unit = api_storage.Unit(id="i-0800", dns_name="10.0.0.1", secret="abc123")
+        manager = managers.BaseManager(mock.Mock())
+        counters = manager.unit_stats(unit)
+        self.assertEqual({"client_req": 100, "cache_hit": 80, "cache_miss": 20,
+                          "backend_req": 21, "n_object": 300}, counters)
+        http.request.assert_called_with("http://10.0.0.1:8081/stats",
+                                        headers={"X-Varnish-Secret": "abc123"})
+
+    @mock.patch("httplib2.Http")
+    def test_unit_stats_custom_port(self, Http):
+        os.environ["STATS_PORT"] = "9000"
+        self.addCleanup(os.environ.pop, "STATS_PORT")
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=200), "{}")
+        Http.return_value = http
+        unit = api_storage.Unit(id="i-0800", dns_name="10.0.0.1", secret="abc123")
+        manager = managers.BaseManager(mock.Mock())
+        self.assertEqual({}, manager.unit_stats(unit))
+        http.request.assert_called_with("http://10.0.0.1:9000/stats",
+                                        headers={"X-Varnish-Secret": "abc123"})
+
+    @mock.patch("httplib2.Http")
+    def test_unit_stats_failure(self, Http):
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=404), "not found")
+        Http.return_value = http
+        unit = api_storage.Unit(id="i-0800", dns_name="10.0.0.1")
+        manager = managers.BaseManager(mock.Mock())
+        with self.assertRaises(ValueError) as cm:
+            manager.unit_stats(unit)
+        exc = cm.exception
+        self.assertEqual(("stats endpoint returned 404",), exc.args)
+
+    def test_get_metrics(self):
+        points = [{"timestamp": datetime.datetime(2014, 2, 16, 12, 0), "requests": 10}]
+        storage = mock.Mock()
+        storage.retrieve_metrics.return_value = points
+        manager = managers.BaseManager(storage)
+        with freezegun.freeze_time("2014-02-16 12:30:00"):
+            self.assertEqual(points, manager.get_metrics("secret", minutes=30))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.retrieve_metrics.assert_called_with(
+            "secret", since=datetime.datetime(2014, 2, 16, 12, 0))
+
+    @mock.patch("feaas.metrics.downsample")
+    def test_get_metrics_step(self, downsample):
+        downsample.return_value = [{"requests": 20}]
+        storage = mock.Mock()
+        storage.retrieve_metrics.return_value = [{"requests": 10}, {"requests": 10}]
+        manager = managers.BaseManager(storage)
+        self.assertEqual([{"requests": 20}], manager.get_metrics("secret", step=300))
+        downsample.assert_called_with([{"requests": 10}, {"requests": 10}], 300)
+
+    def test_get_metrics_rollups(self):
+        buckets = [{"timestamp": datetime.datetime(2014, 2, 16, 10), "requests": 10,
+                    "hits": 3, "misses": 1, "backend_fetches": 1, "objects": 300,
+                    "units": 4, "samples": 2},
+                   {"timestamp": datetime.datetime(2014, 2, 16, 11), "requests": 20,
+                    "hits": 0, "misses": 0, "backend_fetches": 0, "objects": 100,
+                    "units": 2, "samples": 1}]
+        storage = mock.Mock()
+        storage.retrieve_metric_rollups.return_value = buckets
+        manager = managers.BaseManager(storage)
+        with freezegun.freeze_time("2014-02-16 12:30:00"):
+            points = manager.get_metrics("secret", minutes=150, step=3600)
+        storage.retrieve_metric_rollups.assert_called_with(
+            "secret", since=datetime.datetime(2014, 2, 16, 10))
+        self.assertFalse(storage.retrieve_metrics.called)
+        expected = [{"timestamp": datetime.datetime(2014, 2, 16, 10), "requests": 10,
+                     "hits": 3, "misses": 1, "backend_fetches": 1, "objects": 150,
+                     "units": 2, "hit_ratio": 0.75},
+                    {"timestamp": datetime.datetime(2014, 2, 16, 11), "requests": 20,
+                     "hits": 0, "misses": 0, "backend_fetches": 0, "objects": 100,
+                     "units": 2, "hit_ratio": None}]
+        self.assertEqual(expected, points)
+
+    def test_get_metrics_invalid(self):
+        manager = managers.BaseManager(mock.Mock())
+        for kwargs, msg in [({"minutes": 0}, "minutes must be a positive integer"),
+                            ({"step": -1}, "step must be a positive integer")]:
+            with self.assertRaises(ValueError) as cm:
+                manager.get_metrics("secret", **kwargs)
+            exc = cm.exception
+            self.assertEqual((msg,), exc.args)
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_apply_params(self, VarnishHandler):
+        shown = {"thread_pool_min": "thread_pool_min            5 [threads]\n"
+                                    "                           Default is 5\n",
+                 "thread_pools": "thread_pools               4 [pools]\n"}
+        handler = mock.Mock()
+        handler.param_show.side_effect = lambda param: ((200, 10), shown[param])
+        VarnishHandler.return_value = handler
+        unit = api_storage.Unit(id="i-0800", dns_name="10.1.1.1", secret="abc")
+        manager = managers.BaseManager(mock.Mock())
+        changed = manager.apply_params(unit, {"thread_pool_min": 100, "thread_pools": 4})
+        self.assertEqual(["thread_pool_min"], changed)
+        VarnishHandler.assert_called_with("10.1.1.1:6082", secret="abc")
+        handler.param_set.assert_called_once_with("thread_pool_min", 100)
+        handler.quit.assert_called_once_with()
+
+    @mock.patch("varnish.VarnishHandler")
+    def test_apply_params_failure(self, VarnishHandler):
+        handler = mock.Mock()
+        handler.param_show.return_value = ((200, 10), "thread_pools 2 [pools]\n")
+        handler.param_set.side_effect = AssertionError("Bad response code: 106")
+        VarnishHandler.return_value = handler
+        unit = api_storage.Unit(id="i-0800", dns_name="10.1.1.1", secret="abc")
+        manager = managers.BaseManager(mock.Mock())
+        with self.assertRaises(AssertionError):
+            manager.apply_params(unit, {"thread_pools": 4})
+        handler.quit.assert_called_once_with()
+
+    def test_get_cache_policy(self):
+        storage = mock.Mock()
+        storage.retrieve_cache_policy.return_value = {"instance_name": "secret",
+                                                      "policy": {"grace": 30},
+                                                      "state": "applied"}
+        manager = managers.BaseManager(storage)
+        self.assertEqual({"grace": 30}, manager.get_cache_policy("secret"))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.retrieve_cache_policy.assert_called_with("secret")
+
+    def test_get_cache_policy_not_set(self):
+        storage = mock.Mock()
+        storage.retrieve_cache_policy.return_value = None
+        manager = managers.BaseManager(storage)
+        self.assertEqual({}, manager.get_cache_policy("secret"))
+
+    def test_set_cache_policy(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        policy = manager.set_cache_policy("secret", {"grace": 30, "strip_cookies": []})
+        self.assertEqual({"grace": 30, "strip_cookies": []}, policy)
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.store_cache_policy.assert_called_with("secret", policy)
+
+    def test_set_cache_policy_invalid(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(ValueError) as cm:
+            manager.set_cache_policy("secret", {"grace": "30s"})
+        exc = cm.exception
+        self.assertEqual(("grace must be a non-negative integer",), exc.args)
+        self.assertFalse(storage.store_cache_policy.called)
+
+    def test_set_cache_policy_instance_not_found(self):
+        storage = mock.Mock()
+        storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(api_storage.InstanceNotFoundError):
+            manager.set_cache_policy("secret", {})
+        self.assertFalse(storage.store_cache_policy.called)
+
+    def test_preview_vcl(self):
+        storage = mock.Mock()
+        instance = api_storage.Instance(name="secret")
+        storage.retrieve_binds.return_value = [api_storage.Bind("myapp.cloud.tsuru.io",
+                                                                instance)]
+        manager = managers.BaseManager(storage)
+        vcl = manager.preview_vcl("secret", {"strip_cookies": ["^/static/"]})
+        self.assertIn('backend app0 {\n\t.host = "myapp.cloud.tsuru.io";', vcl)
+        self.assertIn('\tif (req.url ~ "^/static/") {\n\t\tunset req.http.Cookie;\n\t}',
+                      vcl)
+        storage.retrieve_binds.assert_called_with(instance_name="secret",
+                                                  state={"$in": ["creating", "created"]})
+        self.assertFalse(storage.store_cache_policy.called)
+
+    def test_preview_vcl_stored_policy(self):
+        storage = mock.Mock()
+        storage.retrieve_binds.return_value = []
+        storage.retrieve_cache_policy.return_value = {"instance_name": "secret",
+                                                      "policy": {"grace": 30},
+                                                      "state": "applied"}
+        manager = managers.BaseManager(storage)
+        vcl = manager.preview_vcl("secret")
+        self.assertIn("\tset req.grace = 30s;\n", vcl)
+
+    def test_preview_vcl_saint_mode_only_restarts_idempotent_requests(self):
+        storage = mock.Mock()
+        instance = api_storage.Instance(name="secret")
+        storage.retrieve_binds.return_value = [api_storage.Bind("myapp.cloud.tsuru.io",
+                                                                instance)]
+        manager = managers.BaseManager(storage)
+        vcl = manager.preview_vcl("secret", {"saint_mode": 20})
+        fetch = vcl[vcl.index("sub vcl_fetch"):]
+        guard = fetch[:fetch.index("return (restart);")]
+        self.assertIn('(req.request == "GET" || req.request == "HEAD")', guard)
+        self.assertIn("set beresp.saintmode = 20s;", guard)
 
     def test_info(self):
         instance = api_storage.Instance(name="secret",
@@ -142,6 +869,18 @@ class BaseManagerTestCase(unittest.TestCase):
         self.assertEqual(expected, manager.info("secret"))
         storage.retrieve_instance.assert_called_with(name="secret")
 
+    def test_info_draining_unit(self):
+        units = [api_storage.Unit(dns_name="secret.cloud.tsuru.io", id="i-0800",
+                                  state="draining"),
+                 api_storage.Unit(dns_name="not-secret.cloud.tsuru.io", id="i-0801",
+                                  state="started")]
+        instance = api_storage.Instance(name="secret", units=units)
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        manager = managers.BaseManager(storage)
+        expected = [{"label": "Address", "value": "not-secret.cloud.tsuru.io"}]
+        self.assertEqual(expected, manager.info("secret"))
+
     def test_info_instance_not_found(self):
         storage = mock.Mock()
         storage.retrieve_instance.side_effect = api_storage.InstanceNotFoundError()
@@ -180,11 +919,28 @@ class BaseManagerTestCase(unittest.TestCase):
         instance = api_storage.Instance(name="secret", state="scaling")
         storage = mock.Mock()
         storage.retrieve_instance.return_value = instance
+        storage.retrieve_scale_jobs.return_value = [{"instance": "secret", "quantity": 3,
+                                                     "state": "processing"}]
         manager = managers.BaseManager(storage)
-        with self.assertRaises(ValueError) as cm:
-            manager.scale_instance("secret", 2)
-        exc = cm.exception
-        self.assertEqual(("instance is already scaling",), exc.args)
+        manager.scale_instance("secret", 2)
+        storage.retrieve_scale_jobs.assert_called_with(
+            instance="secret", state={"$in": ["pending", "processing"]})
+        storage.store_scale_job.assert_called_with({"instance": "secret",
+                                                    "quantity": 2,
+                                                    "state": "pending"})
+
+    def test_scale_instance_cancel_pending_job(self):
+        instance = api_storage.Instance(name="secret", state="started",
+                                        units=[api_storage.Unit(id="i-0800")])
+        storage = mock.Mock()
+        storage.retrieve_instance.return_value = instance
+        storage.retrieve_scale_jobs.return_value = [{"instance": "secret", "quantity": 3,
+                                                     "state": "pending"}]
+        manager = managers.BaseManager(storage)
+        manager.scale_instance("secret", 1)
+        storage.store_scale_job.assert_called_with({"instance": "secret",
+                                                    "quantity": 1,
+                                                    "state": "pending"})
 
     def test_scale_instance_no_change(self):
         instance = api_storage.Instance(name="secret",
@@ -194,6 +950,7 @@ class BaseManagerTestCase(unittest.TestCase):
                                                                 id="i-0801")])
         storage = mock.Mock()
         storage.retrieve_instance.return_value = instance
+        storage.retrieve_scale_jobs.return_value = []
         manager = managers.BaseManager(storage)
         with self.assertRaises(ValueError) as cm:
             manager.scale_instance("secret", 2)
@@ -215,6 +972,146 @@ class BaseManagerTestCase(unittest.TestCase):
         exc = cm.exception
         self.assertEqual(("quantity must be a positive integer",), exc.args)
 
+    def test_get_schedule(self):
+        storage = mock.Mock()
+        storage.retrieve_schedules.return_value = [{"instance_name": "secret",
+                                                    "default_units": 2}]
+        manager = managers.BaseManager(storage)
+        self.assertEqual({"instance_name": "secret", "default_units": 2},
+                         manager.get_schedule("secret"))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.retrieve_schedules.assert_called_with(instance_name="secret")
+
+    def test_get_schedule_undefined(self):
+        storage = mock.Mock()
+        storage.retrieve_schedules.return_value = []
+        manager = managers.BaseManager(storage)
+        self.assertEqual({}, manager.get_schedule("secret"))
+
+    def test_set_schedule(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        scaling_schedule = manager.set_schedule(
+            "secret", {"default_units": 2,
+                       "rules": [{"start": "08:00", "end": "23:00", "units": 6}]})
+        self.assertEqual(7, len(scaling_schedule["rules"][0]["days"]))
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.store_schedule.assert_called_with("secret", scaling_schedule)
+
+    def test_set_schedule_invalid(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(ValueError):
+            manager.set_schedule("secret", {"default_units": 2, "rules": []})
+        self.assertFalse(storage.store_schedule.called)
+
+    def test_remove_schedule(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        manager.remove_schedule("secret")
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.remove_schedule.assert_called_with("secret")
+
+    def test_get_autoscale(self):
+        storage = mock.Mock()
+        storage.retrieve_autoscale.return_value = [{"instance_name": "secret",
+                                                    "signal": "requests"}]
+        manager = managers.BaseManager(storage)
+        self.assertEqual({"instance_name": "secret", "signal": "requests"},
+                         manager.get_autoscale("secret"))
+        storage.retrieve_instance.assert_called_with(name="secret")
+
+    def test_get_autoscale_disabled(self):
+        storage = mock.Mock()
+        storage.retrieve_autoscale.return_value = []
+        manager = managers.BaseManager(storage)
+        self.assertEqual({}, manager.get_autoscale("secret"))
+
+    def test_set_autoscale(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        config = manager.set_autoscale("secret", {"signal": "requests", "capacity": 500,
+                                                  "min_units": 2, "max_units": 4})
+        self.assertEqual(0.7, config["target_utilization"])
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.store_autoscale.assert_called_with("secret", config)
+
+    def test_set_autoscale_invalid(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        with self.assertRaises(ValueError):
+            manager.set_autoscale("secret", {"signal": "requests"})
+        self.assertFalse(storage.store_autoscale.called)
+
+    def test_disable_autoscale(self):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        manager.disable_autoscale("secret")
+        storage.retrieve_instance.assert_called_with(name="secret")
+        storage.remove_autoscale.assert_called_with("secret")
+
+    @mock.patch("feaas.victims.select")
+    def test_select_victims(self, select):
+        units = [api_storage.Unit(id="i-0800"), api_storage.Unit(id="i-0801")]
+        select.return_value = units[1:]
+        instance = api_storage.Instance(name="secret", units=units)
+        manager = managers.BaseManager(mock.Mock())
+        self.assertEqual(units[1:], manager.select_victims(instance, 1))
+        select.assert_called_with(manager, units, 1)
+
+    @mock.patch("time.sleep")
+    def test_drain_units(self, sleep):
+        os.environ["DRAIN_PERIOD"] = "10"
+        self.addCleanup(os.environ.pop, "DRAIN_PERIOD")
+        units = [api_storage.Unit(id="i-0800", state="started")]
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        manager.unroute_units = mock.Mock()
+        manager.unroute_units.side_effect = lambda units: self.assertFalse(sleep.called)
+        manager.drain_units(units)
+        self.assertEqual("draining", units[0].state)
+        storage.update_units.assert_called_with(units, state="draining")
+        manager.unroute_units.assert_called_once_with(units)
+        sleep.assert_called_with(10)
+
+    @mock.patch("time.sleep")
+    def test_drain_units_default_period(self, sleep):
+        manager = managers.BaseManager(mock.Mock())
+        manager.drain_units([api_storage.Unit(id="i-0800")])
+        sleep.assert_called_with(managers.DRAIN_PERIOD)
+
+    @mock.patch("time.sleep")
+    def test_drain_units_no_units(self, sleep):
+        storage = mock.Mock()
+        manager = managers.BaseManager(storage)
+        manager.drain_units([])
+        self.assertFalse(storage.update_units.called)
+        self.assertFalse(sleep.called)
+
+    @mock.patch("httplib2.Http.request")
+    def test_get_user_data_custom_plan_storage(self, request):
+        request.return_value = (200, "echo VARNISH_SECRET_KEY\nvarnishd -s VARNISH_STORAGE\n")
+        os.environ["USER_DATA_URL"] = "http://localhost/custom_user_data_script"
+        self.addCleanup(os.environ.pop, "USER_DATA_URL")
+        manager = managers.BaseManager(None)
+        plan = {"name": "big", "storage": "file,/var/lib/varnish/storage.bin,20G"}
+        user_data = manager.get_user_data("abc", plan)
+        self.assertEqual("echo abc\nvarnishd -s file,/var/lib/varnish/storage.bin,20G\n",
+                         user_data)
+
+    def test_get_user_data_stats_endpoint(self):
+        os.environ["API_PACKAGES"] = "varnish"
+        os.environ["STATS_PORT"] = "8090"
+        self.addCleanup(os.environ.pop, "API_PACKAGES")
+        self.addCleanup(os.environ.pop, "STATS_PORT")
+        manager = managers.BaseManager(None)
+        user_data = manager.get_user_data("abc")
+        self.assertIn(open(managers.STATS_SERVER_FILE).read(), user_data)
+        self.assertIn("echo '@reboot root /usr/local/bin/varnish_stats 8090' > "
+                      "/etc/cron.d/varnish_stats\n", user_data)
+        self.assertTrue(user_data.endswith(
+            "nohup /usr/local/bin/varnish_stats 8090 > /dev/null 2>&1 &\n"))
+
     def test_start_instance(self):
         with self.assertRaises(NotImplementedError):
             self.manager.start_instance("something")
@@ -226,3 +1123,62 @@ class BaseManagerTestCase(unittest.TestCase):
     def test_physical_scale(self):
         with self.assertRaises(NotImplementedError):
             self.manager.physical_scale("something", 10)
+
+    def test_replace_unit(self):
+        instance = api_storage.Instance(name="something")
+        unit = api_storage.Unit(id="i-0800")
+        self.manager._add_units = mock.Mock(return_value=[unit])
+        self.assertEqual(unit, self.manager.replace_unit(instance))
+        self.manager._add_units.assert_called_with(instance, 1)
+
+    def test_remove_unit(self):
+        with self.assertRaises(NotImplementedError):
+            self.manager.remove_unit(None, None)
+
+
+class VCLTemplateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".vcl")
+        os.write(fd, 'set req.http.Host = "%(app_host)s";\n\tset req.http.X = "%(x)s";\n')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_get(self):
+        template = managers.VCLTemplate(self.path)
+        expected = r'"set req.http.Host = \"%(app_host)s\"; set req.http.X = \"%(x)s\";"'
+        self.assertEqual(expected, template.get())
+
+    def test_get_reads_file_only_once(self):
+        template = managers.VCLTemplate(self.path)
+        template.compile = mock.Mock(return_value='"compiled"')
+        for i in xrange(3):
+            self.assertEqual('"compiled"', template.get())
+        template.compile.assert_called_once_with()
+
+    def test_get_reloads_when_file_changes(self):
+        template = managers.VCLTemplate(self.path)
+        template.get()
+        with open(self.path, "w") as f:
+            f.write("sub vcl_recv {}")
+        mtime = os.path.getmtime(self.path) + 10
+        os.utime(self.path, (mtime, mtime))
+        self.assertEqual('"sub vcl_recv {}"', template.get())
+
+    def test_render_escapes_backslashes(self):
+        template = managers.VCLTemplate(self.path)
+        vcl = template.render(app_host="myapp.cloud.tsuru.io", x="\\1")
+        expected = r'"set req.http.Host = \"myapp.cloud.tsuru.io\"; set req.http.X = \"\\1\";"'
+        self.assertEqual(expected, vcl)
+
+    def test_preview(self):
+        template = managers.VCLTemplate(self.path)
+        vcl = template.preview(app_host="myapp.cloud.tsuru.io", x="y")
+        expected = 'set req.http.Host = "myapp.cloud.tsuru.io";\n\tset req.http.X = "y";\n'
+        self.assertEqual(expected, vcl)
+
+    def test_render(self):
+        template = managers.VCLTemplate(self.path)
+        vcl = template.render(app_host="myapp.cloud.tsuru.io", x="y")
+        expected = r'"set req.http.Host = \"myapp.cloud.tsuru.io\"; set req.http.X = \"y\";"'
+        self.assertEqual(expected, vcl)
@@ -0,0 +1,97 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from feaas import breaker
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def failing(self):
+        raise IOError("timed out")
+
+    def test_init_invalid_threshold(self):
+        with self.assertRaises(ValueError) as cm:
+            breaker.CircuitBreaker(threshold=0)
+        exc = cm.exception
+        self.assertEqual(("threshold must be a positive integer",), exc.args)
+
+    def test_call(self):
+        b = breaker.CircuitBreaker()
+        self.assertEqual(4, b.call("unit1", lambda x, y=1: x * y, 2, y=2))
+        self.assertEqual("closed", b.state("unit1"))
+
+    def test_interrupt_is_not_a_failure(self):
+        b = breaker.CircuitBreaker(threshold=1)
+
+        def interrupted():
+            raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            b.call("unit1", interrupted)
+        self.assertEqual("closed", b.state("unit1"))
+
+    @mock.patch("time.time")
+    def test_opens_after_threshold(self, time):
+        time.return_value = 1000
+        b = breaker.CircuitBreaker(threshold=3, cooldown=30)
+        for _ in xrange(3):
+            with self.assertRaises(IOError):
+                b.call("unit1", self.failing)
+        self.assertEqual("open", b.state("unit1"))
+        fn = mock.Mock()
+        with self.assertRaises(breaker.CircuitOpenError) as cm:
+            b.call("unit1", fn)
+        self.assertEqual(("circuit of unit1 is open",), cm.exception.args)
+        self.assertFalse(fn.called)
+        self.assertEqual("closed", b.state("unit2"))
+        b.call("unit2", fn)
+        self.assertEqual(1, fn.call_count)
+
+    @mock.patch("time.time")
+    def test_success_resets_failures(self, time):
+        time.return_value = 1000
+        b = breaker.CircuitBreaker(threshold=2)
+        with self.assertRaises(IOError):
+            b.call("unit1", self.failing)
+        b.call("unit1", lambda: None)
+        with self.assertRaises(IOError):
+            b.call("unit1", self.failing)
+        self.assertEqual("closed", b.state("unit1"))
+
+    @mock.patch("time.time")
+    def test_half_open_single_trial(self, time):
+        time.return_value = 1000
+        b = breaker.CircuitBreaker(threshold=1, cooldown=30)
+        with self.assertRaises(IOError):
+            b.call("unit1", self.failing)
+        time.return_value = 1030
+        self.assertEqual("half-open", b.state("unit1"))
+
+        def trial():
+            self.assertEqual("half-open", b.state("unit1"))
+            with self.assertRaises(breaker.CircuitOpenError):
+                b.call("unit1", lambda: None)
+            return "ok"
+
+        self.assertEqual("ok", b.call("unit1", trial))
+        self.assertEqual("closed", b.state("unit1"))
+
+    @mock.patch("time.time")
+    def test_half_open_trial_failure_reopens(self, time):
+        time.return_value = 1000
+        b = breaker.CircuitBreaker(threshold=2, cooldown=30)
+        for _ in xrange(2):
+            with self.assertRaises(IOError):
+                b.call("unit1", self.failing)
+        time.return_value = 1040
+        with self.assertRaises(IOError):
+            b.call("unit1", self.failing)
+        self.assertEqual("open", b.state("unit1"))
+        time.return_value = 1069
+        self.assertEqual("open", b.state("unit1"))
+        time.return_value = 1070
+        self.assertEqual("half-open", b.state("unit1"))
@@ -3,6 +3,8 @@
 # license that can be found in the LICENSE file.
 
 import copy
+import datetime
+import json
 import os
 import unittest
 
@@ -118,6 +120,34 @@ class CloudStackManagerTestCase(unittest.TestCase):
         actual_user_data = manager.get_user_data("uuid_val")
         client_mock.encode_user_data.assert_called_with(actual_user_data)
 
+    @mock.patch("uuid.uuid4")
+    def test_start_instance_plan(self, uuid):
+        self.set_api_envs()
+        self.addCleanup(self.del_api_envs)
+        self.set_vm_envs()
+        self.addCleanup(self.del_vm_envs)
+        os.environ["API_PLANS"] = json.dumps([{"name": "large", "memory": 8192,
+                                               "offering": "large-123"}])
+        self.addCleanup(self._remove_envs, "API_PLANS")
+        uuid.return_value = "uuid_val"
+        instance = storage.Instance(name="some_instance", units=[], plan="large")
+        strg_mock = mock.Mock()
+        strg_mock.retrieve_instance.return_value = instance
+        client_mock = mock.Mock()
+        client_mock.deployVirtualMachine.return_value = {"id": "abc123",
+                                                         "jobid": "qwe321"}
+        client_mock.queryAsyncJobResult.return_value = {"jobstatus": 1}
+        vm = {"id": "abc123", "nic": [{"ipaddress": "10.0.0.1"}]}
+        client_mock.listVirtualMachines.return_value = {"virtualmachine": [vm]}
+        manager = cloudstack.CloudStackManager(storage=strg_mock)
+        manager.client = client_mock
+        manager.start_instance("some_instance")
+        create_data = client_mock.deployVirtualMachine.call_args[0][0]
+        self.assertEqual("large-123", create_data["serviceofferingid"])
+        plan = {"name": "large", "memory": 8192, "offering": "large-123"}
+        actual_user_data = manager.get_user_data("uuid_val", plan)
+        client_mock.encode_user_data.assert_called_with(actual_user_data)
+
     @mock.patch("uuid.uuid4")
     def test_start_instance_no_project_id(self, uuid):
         self.set_api_envs()
@@ -359,6 +389,8 @@ class CloudStackManagerTestCase(unittest.TestCase):
         self.assertEqual(instance, unit.instance)
         self.assertEqual("10.0.0.5", unit.dns_name)
         self.assertEqual("creating", unit.state)
+        strg_mock.store_unit.assert_called_once_with(unit)
+        self.assertFalse(strg_mock.store_instance.called)
         create_data = {"group": "feaas", "templateid": self.template_id,
                        "zoneid": self.zone_id,
                        "serviceofferingid": self.service_offering_id,
@@ -371,18 +403,42 @@ class CloudStackManagerTestCase(unittest.TestCase):
     def test_physical_scale_down(self):
         self.set_api_envs()
         self.addCleanup(self.del_api_envs)
-        units = [storage.Unit(id="vm-123"), storage.Unit(id="vm-456"),
-                 storage.Unit(id="vm-789")]
+        units = [storage.Unit(id="vm-123", state="started",
+                              created_at=datetime.datetime(2014, 2, 16, 12, 0, 3)),
+                 storage.Unit(id="vm-456", state="started",
+                              created_at=datetime.datetime(2014, 2, 16, 12, 0, 2)),
+                 storage.Unit(id="vm-789", state="started",
+                              created_at=datetime.datetime(2014, 2, 16, 12, 0, 1))]
         instance = storage.Instance(name="some_instance", units=copy.deepcopy(units))
         strg_mock = mock.Mock()
         manager = cloudstack.CloudStackManager(storage=strg_mock)
         manager.client = client_mock = mock.Mock()
+        manager.drain_units = mock.Mock()
         got_units = manager.physical_scale(instance, 1)
         self.assertEqual(1, len(instance.units))
         self.assertEqual(2, len(got_units))
         self.assertEqual("vm-789", instance.units[0].id)
+        manager.drain_units.assert_called_with(got_units)
         expected_calls = [mock.call({"id": "vm-123"}), mock.call({"id": "vm-456"})]
         self.assertEqual(expected_calls, client_mock.destroyVirtualMachine.call_args_list)
+        self.assertEqual(["vm-123", "vm-456"],
+                         [c[0][0].id for c in strg_mock.remove_unit.call_args_list])
+        self.assertFalse(strg_mock.store_instance.called)
+
+    def test_remove_unit(self):
+        self.set_api_envs()
+        self.addCleanup(self.del_api_envs)
+        units = [storage.Unit(id="vm-123"), storage.Unit(id="vm-456")]
+        instance = storage.Instance(name="some_instance", units=units)
+        strg_mock = mock.Mock()
+        manager = cloudstack.CloudStackManager(storage=strg_mock)
+        manager.client = client_mock = mock.Mock()
+        dead = storage.Unit(id="vm-456")
+        manager.remove_unit(instance, dead)
+        client_mock.destroyVirtualMachine.assert_called_with({"id": "vm-456"})
+        self.assertEqual(["vm-123"], [u.id for u in instance.units])
+        strg_mock.remove_unit.assert_called_with(dead)
+        self.assertFalse(strg_mock.store_instance.called)
 
 
 class MaxTryExceededErrorTestCase(unittest.TestCase):
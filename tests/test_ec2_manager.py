@@ -2,6 +2,8 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import json
 import os
 import unittest
 
@@ -134,7 +136,7 @@ class EC2ManagerTestCase(unittest.TestCase):
         )
         manager = ec2.EC2Manager(None)
         manager._connection = conn
-        manager._run_unit()
+        manager._run_unit(api_storage.Instance(name="myapp"))
         user_data = """apt-get update
 apt-get install -y varnish vim-nox
 sed -i -e 's/-T localhost:6082/-T :6082/' /etc/default/varnish
@@ -145,7 +147,13 @@ cat > /etc/cron.hourly/dump_vcls <<'END'
 {0}
 END
 chmod +x /etc/cron.hourly/dump_vcls
-""".format(open(managers.DUMP_VCL_FILE).read())
+cat > /usr/local/bin/varnish_stats <<'END'
+{1}
+END
+chmod +x /usr/local/bin/varnish_stats
+echo '@reboot root /usr/local/bin/varnish_stats 8081' > /etc/cron.d/varnish_stats
+nohup /usr/local/bin/varnish_stats 8081 > /dev/null 2>&1 &
+""".format(open(managers.DUMP_VCL_FILE).read(), open(managers.STATS_SERVER_FILE).read())
         conn.run_instances.assert_called_once_with(image_id=self.ami_id,
                                                    subnet_id=self.subnet_id,
                                                    user_data=user_data)
@@ -177,7 +185,7 @@ chmod +x /etc/cron.hourly/dump_vcls
         )
         manager = ec2.EC2Manager(None)
         manager._connection = conn
-        manager._run_unit()
+        manager._run_unit(api_storage.Instance(name="myapp"))
         user_data = """apt-get update
 apt-get install -y varnish vim-nox
 sed -i -e 's/-T localhost:6082/-T :6082/' /etc/default/varnish
@@ -193,6 +201,28 @@ chmod +x /etc/cron.hourly/dump_vcls
                                                    subnet_id=self.subnet_id,
                                                    user_data=user_data)
 
+    @mock.patch("uuid.uuid4")
+    def test_start_instance_ec2_plan(self, uuid4):
+        uuid4.return_value = u"abacaxi"
+        os.environ["API_PACKAGES"] = "varnish"
+        os.environ["API_PLANS"] = json.dumps([{"name": "large", "memory": 7680,
+                                               "instance_type": "m3.large"}])
+
+        def recover():
+            del os.environ["API_PACKAGES"], os.environ["API_PLANS"]
+        self.addCleanup(recover)
+        conn = mock.Mock()
+        conn.run_instances.return_value = self.get_fake_reservation(
+            instances=[{"id": "i-800", "dns_name": "abcd.amazonaws.com"}],
+        )
+        manager = ec2.EC2Manager(None)
+        manager._connection = conn
+        manager._run_unit(api_storage.Instance(name="myapp", plan="large"))
+        _, kwargs = conn.run_instances.call_args
+        self.assertEqual("m3.large", kwargs["instance_type"])
+        self.assertIn("sed -i -e 's|-s [^ \"]*|-s malloc,5760M|' /etc/default/varnish\n",
+                      kwargs["user_data"])
+
     def test_remove_instance(self):
         instance = api_storage.Instance(name="secret")
         storage = mock.Mock()
@@ -254,25 +284,67 @@ chmod +x /etc/cron.hourly/dump_vcls
         manager._run_unit = fake_run_unit
         units = manager.physical_scale(instance, 4)
         self.assertEqual(fake_data["calls"], 3)
-        instance.units.extend(fake_data["units"])
-        storage.store_instance.assert_called_with(instance)
+        self.assertEqual([mock.call(unit) for unit in fake_data["units"]],
+                         storage.store_unit.call_args_list)
+        self.assertFalse(storage.store_instance.called)
         self.assertEqual(fake_data["units"], units)
+        self.assertEqual(fake_data["units"], instance.units[1:])
+
+    def test_physical_scale_add_units_stores_each_unit_when_created(self):
+        instance = api_storage.Instance(name="secret")
+        fake_run_unit, fake_data = self.get_fake_run_unit()
+        storage = mock.Mock()
+        manager = ec2.EC2Manager(storage)
+
+        def run_unit(instance):
+            if fake_data["calls"] == 1:
+                raise ValueError("instance limit exceeded")
+            return fake_run_unit(instance)
+
+        manager._run_unit = run_unit
+        with self.assertRaises(ValueError):
+            manager.physical_scale(instance, 3)
+        storage.store_unit.assert_called_once_with(fake_data["units"][0])
 
     def test_physical_scale_remove_units(self):
-        unit1 = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800")
-        unit2 = api_storage.Unit(dns_name="secret2.cloud.tsuru.io", id="i-0801")
-        unit3 = api_storage.Unit(dns_name="secret3.cloud.tsuru.io", id="i-0802")
+        unit1 = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800",
+                                 state="started",
+                                 created_at=datetime.datetime(2014, 2, 16, 12, 0, 1))
+        unit2 = api_storage.Unit(dns_name="secret2.cloud.tsuru.io", id="i-0801",
+                                 state="creating",
+                                 created_at=datetime.datetime(2014, 2, 16, 12, 0, 2))
+        unit3 = api_storage.Unit(dns_name="secret3.cloud.tsuru.io", id="i-0802",
+                                 state="started",
+                                 created_at=datetime.datetime(2014, 2, 16, 12, 0, 3))
         units = [unit1, unit2, unit3]
         instance = api_storage.Instance(name="secret", units=units)
         storage = mock.Mock()
         manager = ec2.EC2Manager(storage)
         manager._terminate_unit = mock.Mock()
+        manager.drain_units = mock.Mock()
         units = manager.physical_scale(instance, 1)
-        expected = [mock.call(unit1), mock.call(unit2)]
+        manager.drain_units.assert_called_with([unit2, unit3])
+        expected = [mock.call(unit2), mock.call(unit3)]
         self.assertEqual(expected, manager._terminate_unit.call_args_list)
-        self.assertEqual([unit3], instance.units)
-        storage.store_instance.assert_called_with(instance)
-        self.assertEqual([unit1, unit2], units)
+        self.assertEqual([unit1], instance.units)
+        self.assertEqual([mock.call(unit2), mock.call(unit3)],
+                         storage.remove_unit.call_args_list)
+        self.assertFalse(storage.store_instance.called)
+        self.assertEqual([unit2, unit3], units)
+
+    def test_remove_unit(self):
+        unit1 = api_storage.Unit(dns_name="secret1.cloud.tsuru.io", id="i-0800")
+        unit2 = api_storage.Unit(dns_name="secret2.cloud.tsuru.io", id="i-0801")
+        instance = api_storage.Instance(name="secret", units=[unit1, unit2])
+        storage = mock.Mock()
+        manager = ec2.EC2Manager(storage)
+        manager._terminate_unit = mock.Mock()
+        dead = api_storage.Unit(id="i-0800")
+        manager.remove_unit(instance, dead)
+        manager._terminate_unit.assert_called_with(dead)
+        self.assertEqual([unit2], instance.units)
+        storage.remove_unit.assert_called_with(dead)
+        self.assertFalse(storage.store_instance.called)
 
     def get_fake_reservation(self, instances):
         reservation = mock.Mock(instances=[])
@@ -283,7 +355,7 @@ chmod +x /etc/cron.hourly/dump_vcls
     def get_fake_run_unit(self):
         fake_data = {"calls": 0, "units": []}
 
-        def fake_run_unit():
+        def fake_run_unit(instance):
             calls = fake_data["calls"] = fake_data["calls"] + 1
             name = "i-080%d" % calls
             unit = api_storage.Unit(id=name, dns_name="%s.domain.com" % name,
@@ -2,8 +2,11 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import threading
 import unittest
 
+import freezegun
 import mock
 
 from feaas import runners, storage
@@ -28,42 +31,161 @@ class InstanceScalatorTestCase(unittest.TestCase):
         scalator = instance_scalator.InstanceScalator(manager, interval=3)
         self.assertIsInstance(scalator, runners.Base)
 
+    def fake_get_job(self, items):
+        """
+        Returns a thread-safe replacement for get_job, which returns the given
+        items and then (None, None), recording the calls.
+        """
+        items = list(items)
+        lock = threading.Lock()
+        calls = []
+
+        def get_job():
+            with lock:
+                calls.append(None)
+                if not items:
+                    return None, None
+                item = items.pop(0)
+            if isinstance(item, Exception):
+                raise item
+            return item
+        get_job.calls = calls
+        return get_job
+
     def test_run(self):
-        job, instance = ({"instance": "something", "quantity": 2},
-                         storage.Instance(name="something"))
-        get_job = mock.Mock()
-        get_job.return_value = instance, job
+        jobs = [({"instance": "something", "quantity": 2}, storage.Instance(name="something")),
+                ({"instance": "otherthing", "quantity": 3}, storage.Instance(name="otherthing"))]
         strg = mock.Mock()
         manager = mock.Mock(storage=strg)
-        scalator = instance_scalator.InstanceScalator(manager, interval=3)
-        scalator.get_job = get_job
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=1)
+        scalator.get_job = self.fake_get_job([(instance, job) for job, instance in jobs])
         scalator.scale_instance = mock.Mock()
         scalator.run()
-        get_job.assert_called_once()
-        scalator.scale_instance.assert_called_with(instance, 2)
-        strg.finish_scale_job.assert_called_with(job)
+        self.assertEqual(3, len(scalator.get_job.calls))
+        self.assertEqual([mock.call(jobs[0][1], 2), mock.call(jobs[1][1], 3)],
+                         scalator.scale_instance.call_args_list)
+        self.assertEqual([mock.call(jobs[0][0]), mock.call(jobs[1][0])],
+                         strg.finish_scale_job.call_args_list)
+
+    def test_run_concurrently(self):
+        instances = [storage.Instance(name="instance%d" % i) for i in xrange(3)]
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=3)
+        scalator.get_job = self.fake_get_job([(instance, {"instance": instance.name,
+                                                          "quantity": 2})
+                                              for instance in instances])
+        lock = threading.Lock()
+        started = []
+        all_started = threading.Event()
+
+        def scale_instance(instance, quantity):
+            with lock:
+                started.append(instance.name)
+                if len(started) == 3:
+                    all_started.set()
+            all_started.wait(2)
+        scalator.run_job = lambda item: scale_instance(item[0], item[1]["quantity"])
+        scalator.run()
+        self.assertTrue(all_started.is_set())
+        self.assertItemsEqual([i.name for i in instances], started)
+
+    def test_run_keeps_workers_fed(self):
+        instances = [storage.Instance(name="instance%d" % i) for i in xrange(3)]
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=2)
+        scalator.get_job = self.fake_get_job([(instance, {"instance": instance.name,
+                                                          "quantity": 2})
+                                              for instance in instances])
+        last_scaled = threading.Event()
+        scaled_while_slow = []
+
+        def run_job(item):
+            instance, job = item
+            if instance.name == "instance0":
+                scaled_while_slow.append(last_scaled.wait(2))
+            elif instance.name == "instance2":
+                last_scaled.set()
+        scalator.run_job = run_job
+        scalator.run()
+        self.assertEqual([True], scaled_while_slow)
 
     def test_run_no_job(self):
-        get_job = mock.Mock()
-        get_job.return_value = None, None
         strg = mock.Mock()
         manager = mock.Mock(storage=strg)
         scalator = instance_scalator.InstanceScalator(manager, interval=3)
-        scalator.get_job = get_job
+        scalator.get_job = self.fake_get_job([])
         scalator.scale_instance = mock.Mock()
         scalator.run()
-        scalator.scale_instance.assert_not_called()
+        self.assertFalse(scalator.scale_instance.called)
+        self.assertEqual(5, len(scalator.get_job.calls))
 
     def test_run_instance_not_found(self):
-        get_job = mock.Mock()
-        get_job.side_effect = storage.InstanceNotFoundError()
+        job, instance = ({"instance": "something", "quantity": 2},
+                         storage.Instance(name="something"))
         strg = mock.Mock()
         manager = mock.Mock(storage=strg)
-        scalator = instance_scalator.InstanceScalator(manager, interval=3)
-        scalator.get_job = get_job
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=1)
+        scalator.get_job = self.fake_get_job([storage.InstanceNotFoundError(),
+                                              (instance, job)])
         scalator.scale_instance = mock.Mock()
         scalator.run()
-        scalator.scale_instance.assert_not_called()
+        scalator.scale_instance.assert_called_once_with(instance, 2)
+
+    def test_run_get_job_failure(self):
+        manager = mock.Mock(storage=mock.Mock())
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=1)
+        scalator.get_job = self.fake_get_job([ValueError("connection refused")])
+        with self.assertRaises(ValueError):
+            scalator.run()
+
+    @mock.patch("sys.stderr")
+    def test_run_failure(self, stderr):
+        job, instance = ({"instance": "something", "quantity": 2},
+                         storage.Instance(name="something"))
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=1,
+                                                      retry_delay=30)
+        scalator.get_job = self.fake_get_job([(instance, job)])
+        scalator.scale_instance = mock.Mock(side_effect=ValueError("quota exceeded"))
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            scalator.run()
+        self.assertFalse(strg.finish_scale_job.called)
+        strg.reset_scale_job.assert_called_with(
+            job, retry_after=datetime.datetime(2014, 2, 16, 12, 0, 30))
+        self.assertFalse(strg.fail_scale_job.called)
+        stderr.write.assert_called_with("[ERROR] failed to scale something: quota exceeded\n")
+
+    @mock.patch("sys.stderr")
+    def test_run_failure_backoff(self, stderr):
+        job, instance = ({"instance": "something", "quantity": 2, "attempts": 2},
+                         storage.Instance(name="something"))
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=1,
+                                                      retry_delay=30)
+        scalator.get_job = self.fake_get_job([(instance, job)])
+        scalator.scale_instance = mock.Mock(side_effect=ValueError("quota exceeded"))
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            scalator.run()
+        strg.reset_scale_job.assert_called_with(
+            job, retry_after=datetime.datetime(2014, 2, 16, 12, 2))
+
+    @mock.patch("sys.stderr")
+    def test_run_failure_max_attempts(self, stderr):
+        job, instance = ({"instance": "something", "quantity": 2, "attempts": 2},
+                         storage.Instance(name="something"))
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3, max_workers=1,
+                                                      max_attempts=3)
+        scalator.get_job = self.fake_get_job([(instance, job)])
+        scalator.scale_instance = mock.Mock(side_effect=ValueError("quota exceeded"))
+        scalator.run()
+        self.assertFalse(strg.reset_scale_job.called)
+        strg.fail_scale_job.assert_called_with(job, "quota exceeded")
+        stderr.write.assert_called_with("[ERROR] scale job of something failed 3 times, "
+                                        "moved to error\n")
 
     def test_get_job(self):
         instance = storage.Instance(name="something", state="started")
@@ -79,10 +201,10 @@ class InstanceScalatorTestCase(unittest.TestCase):
         self.assertEqual(instance, got_instance)
         self.assertEqual(job, got_job)
         scalator.locker.lock.assert_called_with(scalator.lock_name)
-        strg.get_scale_job.assert_called_once()
+        self.assertEqual(1, strg.get_scale_job.call_count)
         strg.retrieve_instance.assert_called_with(name="something",
                                                   check_liveness=True)
-        strg.store_instance.assert_called_with(got_instance)
+        strg.store_instance.assert_called_with(got_instance, save_units=False)
         scalator.locker.unlock.assert_called_with(scalator.lock_name)
 
     def test_get_job_instance_not_started(self):
@@ -103,6 +225,25 @@ class InstanceScalatorTestCase(unittest.TestCase):
         strg.reset_scale_job.assert_called_with(job)
         scalator.locker.unlock.assert_called_with(scalator.lock_name)
 
+    def test_get_job_already_scaled(self):
+        instance = storage.Instance(name="something", state="started",
+                                    units=[storage.Unit(id="i-0800"),
+                                           storage.Unit(id="i-0801")])
+        job = {"instance": "something", "quantity": 2}
+        strg = mock.Mock()
+        strg.get_scale_job.return_value = job
+        strg.retrieve_instance.return_value = instance
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3)
+        scalator.locker = mock.Mock()
+        got_instance, got_job = scalator.get_job()
+        self.assertIsNone(got_instance)
+        self.assertIsNone(got_job)
+        self.assertEqual("started", instance.state)
+        strg.finish_scale_job.assert_called_with(job)
+        self.assertFalse(strg.store_instance.called)
+        scalator.locker.unlock.assert_called_with(scalator.lock_name)
+
     def test_get_job_instance_not_found(self):
         job = {"instance": "something", "quantity": 3}
         strg = mock.Mock()
@@ -130,23 +271,47 @@ class InstanceScalatorTestCase(unittest.TestCase):
         scalator.locker.unlock.assert_called_with(scalator.lock_name)
 
     def test_scale_instance(self):
-        instance = storage.Instance(name="something", state="started")
+        instance = storage.Instance(name="something", state="scaling")
+        current = storage.Instance(name="something", state="scaling",
+                                   units=[storage.Unit(id="i-0800")])
         strg = mock.Mock()
         manager = mock.Mock(storage=strg)
         scalator = instance_scalator.InstanceScalator(manager, interval=3)
         scalator.locker = mock.Mock()
+        calls = []
+        scalator.locker.lock.side_effect = lambda name: calls.append("lock")
+
+        def retrieve_instance(**query):
+            calls.append("retrieve_instance")
+            return current
+        strg.retrieve_instance.side_effect = retrieve_instance
         scalator.scale_instance(instance, 2)
-        self.assertEqual("started", instance.state)
+        self.assertEqual(["lock", "retrieve_instance"], calls)
+        self.assertEqual("started", current.state)
         lock_name = "%s/something" % scalator.lock_name
         scalator.locker.init.assert_called_with(lock_name)
         scalator.locker.lock.assert_called_with(lock_name)
-        manager.physical_scale.assert_called_with(instance, 2)
-        strg.store_instance.assert_called_with(instance, save_units=False)
+        strg.retrieve_instance.assert_called_with(name="something", check_liveness=True)
+        manager.physical_scale.assert_called_with(current, 2)
+        strg.store_instance.assert_called_with(current, save_units=False)
         scalator.locker.unlock.assert_called_with(lock_name)
 
+    def test_scale_instance_removed_meanwhile(self):
+        instance = storage.Instance(name="something", state="scaling")
+        strg = mock.Mock()
+        strg.retrieve_instance.side_effect = storage.InstanceNotFoundError()
+        manager = mock.Mock(storage=strg)
+        scalator = instance_scalator.InstanceScalator(manager, interval=3)
+        scalator.locker = mock.Mock()
+        scalator.scale_instance(instance, 2)
+        self.assertFalse(manager.physical_scale.called)
+        self.assertFalse(strg.store_instance.called)
+        scalator.locker.unlock.assert_called_with("%s/something" % scalator.lock_name)
+
     def test_scale_always_unlock_and_change_state(self):
         instance = storage.Instance(name="something", state="started")
         strg = mock.Mock()
+        strg.retrieve_instance.return_value = instance
         manager = mock.Mock(storage=strg)
         manager.physical_scale.side_effect = ValueError("something happened")
         scalator = instance_scalator.InstanceScalator(manager, interval=3)
@@ -34,7 +34,7 @@ class InstanceStarterTestCase(unittest.TestCase):
         time.sleep(1)
         starter.stop()
         t.join()
-        fake_run.assert_called_once()
+        self.assertEqual(1, fake_run.call_count)
         self.assertFalse(starter.running)
 
     def test_run(self):
@@ -46,7 +46,7 @@ class InstanceStarterTestCase(unittest.TestCase):
         starter.get_instance = get_instance
         starter.start_instance = mock.Mock()
         starter.run()
-        starter.get_instance.assert_called_once()
+        self.assertEqual(1, starter.get_instance.call_count)
         starter.start_instance.assert_called_with(instance)
 
     def test_run_instance_not_found(self):
@@ -55,7 +55,7 @@ class InstanceStarterTestCase(unittest.TestCase):
         starter.get_instance = mock.Mock(side_effect=storage.InstanceNotFoundError())
         starter.start_instance = mock.Mock()
         starter.run()
-        starter.start_instance.assert_not_called()
+        self.assertFalse(starter.start_instance.called)
 
     def test_get_instance(self):
         instance = storage.Instance(name="something")
@@ -34,7 +34,7 @@ class InstanceTerminatorTestCase(unittest.TestCase):
         time.sleep(1)
         terminator.stop()
         t.join()
-        fake_run.assert_called_once()
+        self.assertEqual(1, fake_run.call_count)
         self.assertFalse(terminator.running)
 
     def test_run(self):
@@ -46,7 +46,7 @@ class InstanceTerminatorTestCase(unittest.TestCase):
         terminator.get_instance = get_instance
         terminator.terminate_instance = mock.Mock()
         terminator.run()
-        terminator.get_instance.assert_called_once()
+        self.assertEqual(1, terminator.get_instance.call_count)
         terminator.terminate_instance.assert_called_with(instance)
 
     def test_run_instance_not_found(self):
@@ -55,7 +55,7 @@ class InstanceTerminatorTestCase(unittest.TestCase):
         terminator.get_instance = mock.Mock(side_effect=storage.InstanceNotFoundError())
         terminator.terminate_instance = mock.Mock()
         terminator.run()
-        terminator.terminate_instance.assert_not_called()
+        self.assertFalse(terminator.terminate_instance.called)
 
     def test_get_instance(self):
         instance = storage.Instance(name="something")
@@ -2,10 +2,12 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import threading
 import time
 import unittest
 
+import freezegun
 import pymongo
 
 from feaas import storage
@@ -95,3 +97,36 @@ class MultiLockerTestCase(unittest.TestCase):
         self.locker.unlock("test_unlock")
         with self.assertRaises(storage.DoubleUnlockError):
             self.locker.unlock("test_unlock")
+
+    def test_unlock_after_takeover(self):
+        self.locker.init("test_takeover")
+        self.addCleanup(self.client.feaas_test.multi_locker.remove, {"_id": "test_takeover"})
+        other = storage.MultiLocker(storage.MongoDBStorage(dbname="feaas_test"))
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            self.locker.lock("test_takeover")
+        released = other.release_expired(datetime.datetime(2014, 2, 16, 13, 0))
+        self.assertEqual(["test_takeover"], released)
+        other.lock("test_takeover")
+        with self.assertRaises(storage.DoubleUnlockError):
+            self.locker.unlock("test_takeover")
+        lock = self.client.feaas_test.multi_locker.find_one({"_id": "test_takeover"})
+        self.assertEqual(1, lock["state"])
+        self.assertEqual(other.tokens["test_takeover"], lock["owner"])
+        other.unlock("test_takeover")
+        lock = self.client.feaas_test.multi_locker.find_one({"_id": "test_takeover"})
+        self.assertEqual(0, lock["state"])
+
+    def test_release_expired(self):
+        self.locker.init("test_old")
+        self.locker.init("test_new")
+        self.locker.init("test_free")
+        self.addCleanup(self.client.feaas_test.multi_locker.remove, {})
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            self.locker.lock("test_old")
+        with freezegun.freeze_time("2014-02-16 13:00:00"):
+            self.locker.lock("test_new")
+        released = self.locker.release_expired(datetime.datetime(2014, 2, 16, 12, 30))
+        self.assertEqual(["test_old"], released)
+        states = dict([(lock["_id"], lock["state"])
+                       for lock in self.client.feaas_test.multi_locker.find()])
+        self.assertEqual({"test_old": 0, "test_new": 1, "test_free": 0}, states)
@@ -0,0 +1,85 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+from feaas import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_new_point(self):
+        point = metrics.new_point(timestamp="now")
+        self.assertEqual({"timestamp": "now", "requests": 0, "hits": 0, "misses": 0,
+                          "backend_fetches": 0, "objects": 0, "units": 0}, point)
+
+    def test_add_sample(self):
+        point = metrics.new_point()
+        counters = {"client_req": 150, "cache_hit": 120, "cache_miss": 30,
+                    "backend_req": 31, "n_object": 500}
+        previous = {"client_req": 100, "cache_hit": 80, "cache_miss": 20,
+                    "backend_req": 21, "n_object": 450}
+        metrics.add_sample(point, counters, previous)
+        self.assertEqual({"requests": 50, "hits": 40, "misses": 10, "backend_fetches": 10,
+                          "objects": 500, "units": 1}, point)
+
+    def test_add_sample_without_previous(self):
+        point = metrics.new_point()
+        metrics.add_sample(point, {"client_req": 150, "n_object": 500})
+        self.assertEqual({"requests": 0, "hits": 0, "misses": 0, "backend_fetches": 0,
+                          "objects": 500, "units": 1}, point)
+
+    def test_add_sample_restarted(self):
+        point = metrics.new_point()
+        metrics.add_sample(point, {"client_req": 15, "cache_hit": 10},
+                           {"client_req": 100, "cache_hit": 80})
+        self.assertEqual(15, point["requests"])
+        self.assertEqual(10, point["hits"])
+
+    def test_hit_ratio(self):
+        self.assertEqual(0.75, metrics.hit_ratio({"hits": 3, "misses": 1}))
+        self.assertIsNone(metrics.hit_ratio({"hits": 0, "misses": 0}))
+
+    def test_downsample(self):
+        def point(minute, requests, hits, misses, objects):
+            return {"timestamp": datetime.datetime(2014, 2, 16, 12, minute),
+                    "requests": requests, "hits": hits, "misses": misses,
+                    "backend_fetches": misses, "objects": objects, "units": 2,
+                    "hit_ratio": None}
+        points = [point(1, 10, 5, 5, 100), point(3, 20, 15, 5, 200), point(6, 4, 4, 0, 300)]
+        expected = [{"timestamp": datetime.datetime(2014, 2, 16, 12, 0), "requests": 30,
+                     "hits": 20, "misses": 10, "backend_fetches": 10, "objects": 150,
+                     "units": 2, "hit_ratio": 20 / 30.0},
+                    {"timestamp": datetime.datetime(2014, 2, 16, 12, 5), "requests": 4,
+                     "hits": 4, "misses": 0, "backend_fetches": 0, "objects": 300,
+                     "units": 2, "hit_ratio": 1.0}]
+        self.assertEqual(expected, metrics.downsample(points, 300))
+
+    def test_rollup(self):
+        point = {"timestamp": datetime.datetime(2014, 2, 16, 12, 42, 10), "requests": 10,
+                 "hits": 8, "misses": 2, "backend_fetches": 3, "objects": 100, "units": 2,
+                 "hit_ratio": 0.8, "instance_name": "years"}
+        start, increments = metrics.rollup(point)
+        self.assertEqual(datetime.datetime(2014, 2, 16, 12), start)
+        self.assertEqual({"requests": 10, "hits": 8, "misses": 2, "backend_fetches": 3,
+                          "objects": 100, "units": 2, "samples": 1}, increments)
+
+    def test_from_rollup(self):
+        bucket = {"timestamp": datetime.datetime(2014, 2, 16, 12), "requests": 30,
+                  "hits": 20, "misses": 10, "backend_fetches": 10, "objects": 300,
+                  "units": 4, "samples": 2}
+        expected = {"timestamp": datetime.datetime(2014, 2, 16, 12), "requests": 30,
+                    "hits": 20, "misses": 10, "backend_fetches": 10, "objects": 150,
+                    "units": 2, "hit_ratio": 20 / 30.0}
+        self.assertEqual(expected, metrics.from_rollup(bucket))
+        self.assertEqual(2, bucket["samples"])
+
+    def test_from_rollup_averages_gauges_as_floats(self):
+        bucket = {"timestamp": datetime.datetime(2014, 2, 16, 12), "requests": 0,
+                  "hits": 0, "misses": 0, "backend_fetches": 0, "objects": 3,
+                  "units": 3, "samples": 2}
+        point = metrics.from_rollup(bucket)
+        self.assertEqual(1.5, point["objects"])
+        self.assertEqual(1.5, point["units"])
@@ -0,0 +1,95 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import runners, storage
+from feaas.runners import metrics_collector
+
+
+class MetricsCollectorTestCase(unittest.TestCase):
+
+    def build_collector(self, **kwargs):
+        manager = mock.Mock(storage=mock.Mock())
+        return metrics_collector.MetricsCollector(manager, **kwargs)
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        collector = metrics_collector.MetricsCollector(manager, interval=30)
+        self.assertEqual(30, collector.interval)
+        collector.locker.lock(collector.lock_name)
+        collector.locker.unlock(collector.lock_name)
+
+    def test_inherits_from_base_runner(self):
+        self.assertIsInstance(self.build_collector(), runners.Base)
+
+    def test_run(self):
+        collector = self.build_collector()
+        collector.locker = mock.Mock()
+        collector.collect = mock.Mock()
+        units = [storage.Unit(id="i-0800")]
+        collector.storage.retrieve_units.return_value = units
+        collector.run()
+        collector.locker.lock.assert_called_with(collector.lock_name)
+        collector.storage.retrieve_units.assert_called_with(state="started")
+        collector.collect.assert_called_with(units)
+        collector.locker.unlock.assert_called_with(collector.lock_name)
+
+    def test_run_unlocks_on_failure(self):
+        collector = self.build_collector()
+        collector.locker = mock.Mock()
+        collector.collect = mock.Mock(side_effect=ValueError("wat"))
+        with self.assertRaises(ValueError):
+            collector.run()
+        collector.locker.unlock.assert_called_with(collector.lock_name)
+
+    @mock.patch("sys.stderr")
+    def test_collect(self, stderr):
+        instance1 = storage.Instance(name="myinstance")
+        instance2 = storage.Instance(name="yourinstance")
+        units = [storage.Unit(id="i-0800", dns_name="instance1-1.cloud.tsuru.io",
+                              instance=instance1),
+                 storage.Unit(id="i-0801", dns_name="instance1-2.cloud.tsuru.io",
+                              instance=instance1),
+                 storage.Unit(id="i-0802", dns_name="instance2-1.cloud.tsuru.io",
+                              instance=instance2)]
+        stats = {"i-0800": {"client_req": 110, "cache_hit": 90, "cache_miss": 20,
+                            "backend_req": 20, "n_object": 40},
+                 "i-0801": {"client_req": 30, "cache_hit": 10, "cache_miss": 20,
+                            "backend_req": 20, "n_object": 30}}
+
+        def unit_stats(unit):
+            if unit.id not in stats:
+                raise ValueError("timed out")
+            return stats[unit.id]
+        collector = self.build_collector()
+        collector.manager.unit_stats.side_effect = unit_stats
+        collector.storage.retrieve_unit_counters.return_value = [
+            {"unit_id": "i-0800", "counters": {"client_req": 100, "cache_hit": 82,
+                                               "cache_miss": 18, "backend_req": 18,
+                                               "n_object": 38}}]
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            collector.collect(units)
+        query = collector.storage.retrieve_unit_counters.call_args[1]
+        self.assertEqual({"unit_id": {"$in": ["i-0800", "i-0801", "i-0802"]}}, query)
+        expected = {"timestamp": datetime.datetime(2014, 2, 16, 12, 0, 1), "requests": 10,
+                    "hits": 8, "misses": 2, "backend_fetches": 2, "objects": 70,
+                    "units": 2, "hit_ratio": 0.8}
+        collector.storage.store_metrics.assert_called_once_with("myinstance", expected)
+        self.assertEqual([mock.call(units[0], stats["i-0800"]),
+                          mock.call(units[1], stats["i-0801"])],
+                         collector.storage.store_unit_counters.call_args_list)
+        stderr.write.assert_called_once_with("[ERROR] failed to collect metrics from "
+                                             "instance2-1.cloud.tsuru.io: timed out\n")
+
+    def test_collect_no_units(self):
+        collector = self.build_collector()
+        collector.collect([])
+        self.assertFalse(collector.manager.unit_stats.called)
+        self.assertFalse(collector.storage.store_metrics.called)
@@ -0,0 +1,98 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import runners, storage
+from feaas.runners import param_writer
+
+
+class ParamWriterTestCase(unittest.TestCase):
+
+    def build_writer(self, **kwargs):
+        manager = mock.Mock(storage=mock.Mock())
+        return param_writer.ParamWriter(manager, **kwargs)
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        writer = param_writer.ParamWriter(manager, interval=30)
+        self.assertEqual(30, writer.interval)
+        writer.locker.lock(writer.lock_name)
+        writer.locker.unlock(writer.lock_name)
+
+    def test_inherits_from_base_runner(self):
+        self.assertIsInstance(self.build_writer(), runners.Base)
+
+    def test_run(self):
+        writer = self.build_writer()
+        writer.locker = mock.Mock()
+        writer.write_params = mock.Mock()
+        stored = [{"instance_name": "wat", "params": {"thread_pools": 4}}]
+        writer.storage.retrieve_varnish_params.return_value = stored
+        writer.run()
+        writer.locker.lock.assert_called_with(writer.lock_name)
+        writer.write_params.assert_called_with(stored)
+        writer.locker.unlock.assert_called_with(writer.lock_name)
+
+    def test_run_always_unlock(self):
+        writer = self.build_writer()
+        writer.locker = mock.Mock()
+        writer.storage.retrieve_varnish_params.side_effect = ValueError("database is down")
+        with self.assertRaises(ValueError):
+            writer.run()
+        writer.locker.unlock.assert_called_with(writer.lock_name)
+
+    def test_write_params_empty(self):
+        writer = self.build_writer()
+        writer.write_params([])
+        self.assertFalse(writer.storage.retrieve_units.called)
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    @mock.patch("sys.stderr")
+    def test_write_params(self, stderr):
+        instance1 = storage.Instance(name="wat")
+        instance2 = storage.Instance(name="wet")
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io", instance=instance1),
+                 storage.Unit(id="i-0801", dns_name="unit2.cloud.tsuru.io", instance=instance1),
+                 storage.Unit(id="i-0802", dns_name="unit3.cloud.tsuru.io", instance=instance1),
+                 storage.Unit(id="i-0803", dns_name="unit4.cloud.tsuru.io", instance=instance2)]
+        stored = [{"instance_name": "wat", "params": {"thread_pools": 4},
+                   "applied": ["i-0800", "i-0801"]},
+                  {"instance_name": "wet", "params": {"thread_pool_min": 10}, "applied": []}]
+        changed = {"i-0800": ["thread_pools"], "i-0801": ValueError("unit is down"),
+                   "i-0802": ["thread_pools"], "i-0803": []}
+
+        def apply_params(unit, params):
+            if isinstance(changed[unit.id], Exception):
+                raise changed[unit.id]
+            return changed[unit.id]
+
+        writer = self.build_writer()
+        writer.storage.retrieve_units.return_value = units
+        writer.manager.apply_params.side_effect = apply_params
+        writer.write_params(stored)
+        query = writer.storage.retrieve_units.call_args[1]
+        self.assertEqual("started", query["state"])
+        self.assertItemsEqual(["wat", "wet"], query["instance_name"]["$in"])
+        self.assertItemsEqual([mock.call(units[0], {"thread_pools": 4}),
+                               mock.call(units[1], {"thread_pools": 4}),
+                               mock.call(units[2], {"thread_pools": 4}),
+                               mock.call(units[3], {"thread_pool_min": 10})],
+                              writer.manager.apply_params.call_args_list)
+        now = datetime.datetime(2014, 2, 16, 12, 0, 0)
+        self.assertItemsEqual([mock.call(stored[0], applied=["i-0800", "i-0801", "i-0802"],
+                                         drift={"i-0800": ["thread_pools"]}, checked_at=now),
+                               mock.call(stored[1], applied=["i-0803"], drift={},
+                                         checked_at=now)],
+                              writer.storage.update_varnish_params.call_args_list)
+        self.assertItemsEqual([mock.call("[ERROR] parameters drifted in unit1.cloud.tsuru.io: "
+                                         "thread_pools\n"),
+                               mock.call("[ERROR] failed to set parameters in "
+                                         "unit2.cloud.tsuru.io: unit is down\n")],
+                              stderr.write.call_args_list)
@@ -0,0 +1,68 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import unittest
+
+from feaas import plans
+
+
+class PlansTestCase(unittest.TestCase):
+
+    def set_plans(self, value):
+        os.environ["API_PLANS"] = json.dumps(value)
+        self.addCleanup(os.environ.pop, "API_PLANS")
+
+    def test_load(self):
+        value = [{"name": "small", "memory": 1740, "instance_type": "m1.small"},
+                 {"name": "large", "memory": 7680, "instance_type": "m1.large"}]
+        self.set_plans(value)
+        self.assertEqual(value, plans.load())
+
+    def test_load_no_plans(self):
+        self.assertEqual([], plans.load())
+
+    def test_load_invalid_storage(self):
+        self.set_plans([{"name": "small", "storage": "malloc,1G -p cc_command=x"}])
+        with self.assertRaises(ValueError) as cm:
+            plans.load()
+        exc = cm.exception
+        self.assertEqual(("invalid storage for plan small: malloc,1G -p cc_command=x",),
+                         exc.args)
+
+    def test_get(self):
+        self.set_plans([{"name": "small", "memory": 1740}, {"name": "large", "memory": 7680}])
+        self.assertEqual({"name": "large", "memory": 7680}, plans.get("large"))
+
+    def test_get_not_found(self):
+        self.set_plans([{"name": "small", "memory": 1740}])
+        with self.assertRaises(ValueError) as cm:
+            plans.get("huge")
+        exc = cm.exception
+        self.assertEqual(("invalid plan: huge",), exc.args)
+
+    def test_default_name(self):
+        self.assertIsNone(plans.default_name())
+        self.set_plans([{"name": "small"}, {"name": "large"}])
+        self.assertEqual("small", plans.default_name())
+        os.environ["DEFAULT_PLAN"] = "large"
+        self.addCleanup(os.environ.pop, "DEFAULT_PLAN")
+        self.assertEqual("large", plans.default_name())
+
+    def test_storage(self):
+        self.assertEqual("malloc,1305M", plans.storage({"name": "small", "memory": 1740}))
+        self.assertEqual("malloc,5760M", plans.storage({"name": "large", "memory": 7680}))
+
+    def test_storage_memory_ratio(self):
+        os.environ["STORAGE_MEMORY_RATIO"] = "0.5"
+        self.addCleanup(os.environ.pop, "STORAGE_MEMORY_RATIO")
+        self.assertEqual("malloc,870M", plans.storage({"name": "small", "memory": 1740}))
+
+    def test_storage_explicit(self):
+        plan = {"name": "disk", "memory": 1740, "storage": "file,/var/lib/varnish/s.bin,50G"}
+        self.assertEqual("file,/var/lib/varnish/s.bin,50G", plans.storage(plan))
+
+    def test_storage_without_memory(self):
+        self.assertIsNone(plans.storage({"name": "small"}))
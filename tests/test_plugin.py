@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import json
 import os
 import unittest
 
@@ -149,10 +150,89 @@ class TsuruPluginTestCase(unittest.TestCase):
         expected_msg = "quantity must be a positive integer\n"
         stderr.write.assert_called_with(expected_msg)
 
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_purge(self, stdout, Request, urlopen):
+        request = mock.Mock()
+        Request.return_value = request
+        self.set_envs()
+        self.addCleanup(self.delete_envs)
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        result.read.return_value = json.dumps({
+            "expression": 'req.url ~ "^/static/"', "latency": 0.0204,
+            "units": [{"unit": "10.1.1.1", "ok": True, "latency": 0.012}]})
+        urlopen.return_value = result
+        plugin.purge(["-i", "myinstance", "-p", "^/static/"])
+        Request.assert_called_with(self.target +
+                                   "services/proxy/myinstance?" +
+                                   "callback=/resources/myinstance/purge")
+        request.add_header.assert_called_with("Authorization",
+                                              "bearer " + self.token)
+        request.add_data.assert_called_with("pattern=%5E%2Fstatic%2F")
+        urlopen.assert_called_with(request)
+        self.assertEqual([mock.call("10.1.1.1: purged in 12ms\n"),
+                          mock.call('Purged req.url ~ "^/static/" in 20ms\n')],
+                         stdout.write.call_args_list)
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_purge_unit_failure(self, stdout, Request, urlopen):
+        Request.return_value = mock.Mock()
+        self.set_envs()
+        self.addCleanup(self.delete_envs)
+        result = mock.Mock()
+        result.getcode.return_value = 500
+        result.read.return_value = json.dumps({
+            "expression": "obj.http.X ~ y", "latency": 0.5,
+            "units": [{"unit": "10.1.1.1", "ok": False, "error": "timed out"}]})
+        urlopen.return_value = result
+        with self.assertRaises(SystemExit) as cm:
+            plugin.purge(["-i", "myinstance", "-e", "obj.http.X ~ y"])
+        exc = cm.exception
+        self.assertEqual(1, exc.code)
+        Request.return_value.add_data.assert_called_with("expression=obj.http.X+%7E+y")
+        self.assertEqual([mock.call("10.1.1.1: failed: timed out\n"),
+                          mock.call("Purged obj.http.X ~ y in 500ms\n")],
+                         stdout.write.call_args_list)
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stderr")
+    def test_purge_failure(self, stderr, Request, urlopen):
+        Request.return_value = mock.Mock()
+        self.set_envs()
+        self.addCleanup(self.delete_envs)
+        result = mock.Mock()
+        result.getcode.return_value = 404
+        result.read.return_value = "Instance not found\n"
+        urlopen.return_value = result
+        with self.assertRaises(SystemExit) as cm:
+            plugin.purge(["-i", "myinstance", "-p", "/"])
+        exc = cm.exception
+        self.assertEqual(1, exc.code)
+        stderr.write.assert_called_with("ERROR: Instance not found\n")
+
+    @mock.patch("sys.stderr")
+    def test_purge_missing_pattern(self, stderr):
+        with self.assertRaises(SystemExit) as cm:
+            plugin.purge(["-i", "myinstance"])
+        exc = cm.exception
+        self.assertEqual(2, exc.code)
+        expected_msg = ("usage: purge [-h] [-i INSTANCE] "
+                        "[-p PATTERN | -e EXPRESSION]\n")
+        stderr.write.assert_called_with(expected_msg)
+
     def test_get_command(self):
         cmd = plugin.get_command("scale")
         self.assertEqual(plugin.scale, cmd)
 
+    def test_get_command_purge(self):
+        cmd = plugin.get_command("purge")
+        self.assertEqual(plugin.purge, cmd)
+
     def test_get_command_not_found(self):
         with self.assertRaises(plugin.CommandNotFoundError) as cm:
             plugin.get_command("something i don't know")
@@ -0,0 +1,168 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+from feaas import policy
+
+
+class ValidateTestCase(unittest.TestCase):
+
+    def assert_invalid(self, value, msg):
+        with self.assertRaises(ValueError) as cm:
+            policy.validate(value)
+        exc = cm.exception
+        self.assertEqual((msg,), exc.args)
+
+    def test_validate(self):
+        value = {"ttls": [{"url": "^/static/", "ttl": 86400}, {"url": "\\.html$", "ttl": 0}],
+                 "strip_cookies": ["^/static/"],
+                 "strip_query_params": ["utm_source", "fb.ref"],
+                 "grace": 30}
+        self.assertEqual(value, policy.validate(value))
+
+    def test_validate_empty(self):
+        self.assertEqual({}, policy.validate({}))
+
+    def test_validate_not_an_object(self):
+        self.assert_invalid([], "cache policy must be an object")
+
+    def test_validate_unknown_field(self):
+        self.assert_invalid({"ttl": 10}, "unknown cache policy field: ttl")
+
+    def test_validate_ttls_not_a_list(self):
+        self.assert_invalid({"ttls": {"url": "/", "ttl": 10}}, "ttls must be a list")
+
+    def test_validate_ttls_too_many_rules(self):
+        rules = [{"url": "/", "ttl": 10}] * (policy.MAX_RULES + 1)
+        self.assert_invalid({"ttls": rules}, "ttls must have at most 50 items")
+
+    def test_validate_ttls_invalid_rule(self):
+        self.assert_invalid({"ttls": [{"url": "/"}]}, "each rule in ttls must have url and ttl")
+
+    def test_validate_ttls_invalid_ttl(self):
+        for ttl in (-1, "10", 1.5, True):
+            self.assert_invalid({"ttls": [{"url": "/", "ttl": ttl}]},
+                                "ttl must be a non-negative integer")
+
+    def test_validate_invalid_url_pattern(self):
+        self.assert_invalid({"strip_cookies": ["(static"]},
+                            "invalid URL pattern in strip_cookies: (static")
+        self.assert_invalid({"strip_cookies": ['/"; }']},
+                            'invalid URL pattern in strip_cookies: /"; }')
+        self.assert_invalid({"strip_cookies": [""]}, "invalid URL pattern in strip_cookies")
+
+    def test_validate_invalid_query_param(self):
+        self.assert_invalid({"strip_query_params": ["utm source"]},
+                            "invalid query parameter: utm source")
+
+    def test_validate_invalid_grace(self):
+        self.assert_invalid({"grace": -10}, "grace must be a non-negative integer")
+
+    def test_validate_probe_defaults(self):
+        value = policy.validate({"probe": {"url": "/healthcheck", "window": 5}})
+        expected = {"url": "/healthcheck", "interval": 5, "timeout": 2, "window": 5,
+                    "threshold": 3}
+        self.assertEqual({"probe": expected}, value)
+
+    def test_validate_invalid_probe(self):
+        self.assert_invalid({"probe": "/"}, "probe must be an object")
+        self.assert_invalid({"probe": {"uri": "/"}}, "unknown probe field: uri")
+        self.assert_invalid({"probe": {"url": "healthcheck"}},
+                            "invalid probe url: healthcheck")
+        self.assert_invalid({"probe": {"url": '/" "Host: x'}},
+                            'invalid probe url: /" "Host: x')
+        self.assert_invalid({"probe": {"interval": 0}},
+                            "probe interval must be a positive integer")
+        self.assert_invalid({"probe": {"window": 65}}, "probe window must be at most 64")
+        self.assert_invalid({"probe": {"window": 2}},
+                            "probe threshold must not be greater than probe window")
+
+    def test_validate_healthy_grace(self):
+        value = {"grace": 3600, "healthy_grace": 10, "probe": {"url": "/"}}
+        self.assertEqual(10, policy.validate(value)["healthy_grace"])
+
+    def test_validate_healthy_grace_without_probe(self):
+        self.assert_invalid({"grace": 3600, "healthy_grace": 10},
+                            "healthy_grace requires probe and grace")
+
+    def test_validate_healthy_grace_greater_than_grace(self):
+        self.assert_invalid({"grace": 10, "healthy_grace": 30, "probe": {}},
+                            "healthy_grace must not be greater than grace")
+
+    def test_validate_invalid_saint_mode(self):
+        self.assert_invalid({"saint_mode": 0}, "saint_mode must be a positive integer")
+
+    def test_validate_invalid_max_connections(self):
+        self.assert_invalid({"max_connections": -1},
+                            "max_connections must be a positive integer")
+
+
+class VCLParamsTestCase(unittest.TestCase):
+
+    def test_vcl_params_empty(self):
+        self.assertEqual({"recv_policy": "", "fetch_policy": ""}, policy.vcl_params(None))
+        self.assertEqual({"recv_policy": "", "fetch_policy": ""}, policy.vcl_params({}))
+
+    def test_vcl_params(self):
+        params = policy.vcl_params({"ttls": [{"url": "^/static/", "ttl": 86400},
+                                             {"url": "\\.html$", "ttl": 60}],
+                                    "strip_cookies": ["^/static/", "\\.png$"],
+                                    "strip_query_params": ["utm_source", "fb.ref"],
+                                    "grace": 30})
+        expected_recv = """\tif (req.url ~ "^/static/" || req.url ~ "\\.png$") {
+\t\tunset req.http.Cookie;
+\t}
+\tset req.url = regsuball(req.url, "(?<=[?&])(utm_source|fb\\.ref)=[^&]*(&|$)", "");
+\tset req.url = regsub(req.url, "[?&]+$", "");
+\tset req.grace = 30s;"""
+        expected_fetch = """\tif (req.url ~ "^/static/" || req.url ~ "\\.png$") {
+\t\tunset beresp.http.Set-Cookie;
+\t}
+\tif (req.url ~ "^/static/") {
+\t\tset beresp.ttl = 86400s;
+\t} elsif (req.url ~ "\\.html$") {
+\t\tset beresp.ttl = 60s;
+\t}
+\tset beresp.grace = 30s;"""
+        self.assertEqual(expected_recv, params["recv_policy"])
+        self.assertEqual(expected_fetch, params["fetch_policy"])
+
+    def test_vcl_params_grace_and_saint_modes(self):
+        params = policy.vcl_params(policy.validate({"grace": 3600, "healthy_grace": 10,
+                                                    "saint_mode": 20, "probe": {}}))
+        expected_recv = """\tif (req.backend.healthy) {
+\t\tset req.grace = 10s;
+\t} else {
+\t\tset req.grace = 3600s;
+\t}"""
+        expected_fetch = """\tif (beresp.status >= 500 && req.restarts < 2 &&
+\t\t\t(req.request == "GET" || req.request == "HEAD")) {
+\t\tset beresp.saintmode = 20s;
+\t\treturn (restart);
+\t}
+\tset beresp.grace = 3600s;"""
+        self.assertEqual(expected_recv, params["recv_policy"])
+        self.assertEqual(expected_fetch, params["fetch_policy"])
+
+
+class BackendOptionsTestCase(unittest.TestCase):
+
+    def test_backend_options_empty(self):
+        self.assertEqual("", policy.backend_options(None, "myapp.cloud.tsuru.io"))
+        self.assertEqual("", policy.backend_options({"grace": 10}, "myapp.cloud.tsuru.io"))
+
+    def test_backend_options(self):
+        value = policy.validate({"probe": {"url": "/healthcheck"}, "max_connections": 100})
+        options = policy.backend_options(value, "myapp.cloud.tsuru.io")
+        expected = """
+\t.probe = {
+\t\t.request = "GET /healthcheck HTTP/1.1" "Host: myapp.cloud.tsuru.io" "Connection: close";
+\t\t.interval = 5s;
+\t\t.timeout = 2s;
+\t\t.window = 8;
+\t\t.threshold = 3;
+\t}
+\t.max_connections = 100;"""
+        self.assertEqual(expected, options)
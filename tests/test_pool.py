@@ -0,0 +1,86 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+import unittest
+
+from feaas import pool
+
+
+class BoundedPoolTestCase(unittest.TestCase):
+
+    def test_init_invalid_max_workers(self):
+        with self.assertRaises(ValueError) as cm:
+            pool.BoundedPool(max_workers=0)
+        exc = cm.exception
+        self.assertEqual(("max_workers must be a positive integer",), exc.args)
+
+    def test_map(self):
+        p = pool.BoundedPool(max_workers=3)
+        results = p.map(lambda x: x * 2, [1, 2, 3, 4])
+        self.assertEqual([pool.Result(1, 2, None), pool.Result(2, 4, None),
+                          pool.Result(3, 6, None), pool.Result(4, 8, None)],
+                         results)
+
+    def test_map_empty(self):
+        p = pool.BoundedPool(max_workers=3)
+        self.assertEqual([], p.map(lambda x: x, []))
+
+    def test_map_captures_errors(self):
+        def fn(x):
+            if x == 2:
+                raise ValueError("bad item")
+            return x
+
+        p = pool.BoundedPool(max_workers=2)
+        results = p.map(fn, [1, 2, 3])
+        self.assertEqual(1, results[0].value)
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, ValueError)
+        self.assertEqual(("bad item",), results[1].error.args)
+        self.assertEqual(3, results[2].value)
+
+    def test_map_callback(self):
+        got = []
+        p = pool.BoundedPool(max_workers=2)
+        p.map(lambda x: x + 1, [1, 2, 3], callback=got.append)
+        self.assertItemsEqual([pool.Result(1, 2, None), pool.Result(2, 3, None),
+                               pool.Result(3, 4, None)], got)
+
+    def test_map_bounded_concurrency(self):
+        running = [0]
+        peak = [0]
+        lock = threading.Lock()
+
+        def fn(item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        p = pool.BoundedPool(max_workers=3)
+        p.map(fn, range(12))
+        self.assertEqual(3, peak[0])
+
+    def test_map_bounded_concurrency_per_key(self):
+        running = {}
+        peak = {}
+        lock = threading.Lock()
+
+        def fn(item):
+            host = item[0]
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+
+        items = [("host1", i) for i in xrange(6)] + [("host2", i) for i in xrange(6)]
+        p = pool.BoundedPool(max_workers=8, max_per_key=2)
+        p.map(fn, items, key=lambda item: item[0])
+        self.assertEqual({"host1": 2, "host2": 2}, peak)
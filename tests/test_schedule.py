@@ -0,0 +1,66 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+from feaas import schedule
+
+
+class ScheduleTestCase(unittest.TestCase):
+
+    def test_validate(self):
+        scaling_schedule = {"default_units": 2,
+                            "rules": [{"start": "08:00", "end": "23:00", "units": 6},
+                                      {"start": "23:00", "end": "02:00", "units": 4,
+                                       "days": ["fri", "sat"]}]}
+        expected = {"default_units": 2,
+                    "rules": [{"start": "08:00", "end": "23:00", "units": 6,
+                               "days": ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]},
+                              {"start": "23:00", "end": "02:00", "units": 4,
+                               "days": ["fri", "sat"]}]}
+        self.assertEqual(expected, schedule.validate(scaling_schedule))
+
+    def test_validate_invalid(self):
+        rule = {"start": "08:00", "end": "23:00", "units": 6}
+        cases = [([], "schedule must be an object"),
+                 ({"rules": [rule], "default_units": 2, "timezone": "UTC"},
+                  "unknown schedule field: timezone"),
+                 ({"rules": [rule]}, "default_units and rules are required"),
+                 ({"rules": [rule], "default_units": 0},
+                  "default_units must be a positive integer"),
+                 ({"rules": [], "default_units": 2}, "rules must be a non-empty list"),
+                 ({"rules": [{"start": "08:00", "units": 6}], "default_units": 2},
+                  "each rule must have start, end and units, and may have days"),
+                 ({"rules": [dict(rule, start="8:00")], "default_units": 2},
+                  "invalid time: 8:00"),
+                 ({"rules": [dict(rule, end="24:00")], "default_units": 2},
+                  "invalid time: 24:00"),
+                 ({"rules": [dict(rule, end="08:00")], "default_units": 2},
+                  "start and end of a rule must be different"),
+                 ({"rules": [dict(rule, units="6")], "default_units": 2},
+                  "units must be a positive integer"),
+                 ({"rules": [dict(rule, days=["monday"])], "default_units": 2},
+                  "days must be a list of mon, tue, wed, thu, fri, sat, sun")]
+        for scaling_schedule, msg in cases:
+            with self.assertRaises(ValueError) as cm:
+                schedule.validate(scaling_schedule)
+            exc = cm.exception
+            self.assertEqual((msg,), exc.args)
+
+    def test_desired_units(self):
+        scaling_schedule = schedule.validate(
+            {"default_units": 2,
+             "rules": [{"start": "22:00", "end": "02:00", "units": 10, "days": ["fri"]},
+                       {"start": "08:00", "end": "23:00", "units": 6}]})
+        cases = [(datetime.datetime(2014, 2, 17, 7, 59), 2),
+                 (datetime.datetime(2014, 2, 17, 8, 0), 6),
+                 (datetime.datetime(2014, 2, 17, 22, 59), 6),
+                 (datetime.datetime(2014, 2, 17, 23, 0), 2),
+                 (datetime.datetime(2014, 2, 21, 22, 30), 10),
+                 (datetime.datetime(2014, 2, 22, 1, 59), 10),
+                 (datetime.datetime(2014, 2, 22, 2, 0), 2),
+                 (datetime.datetime(2014, 2, 23, 1, 0), 2)]
+        for at, units in cases:
+            self.assertEqual(units, schedule.desired_units(scaling_schedule, at), at)
@@ -0,0 +1,131 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import runners, schedule, storage
+from feaas.runners import scheduled_scaler
+
+
+class ScheduledScalerTestCase(unittest.TestCase):
+
+    def build_scaler(self, units=2, state="started", jobs=None, **kwargs):
+        strg = mock.Mock()
+        instance = storage.Instance(name="myinstance", state=state,
+                                    units=[storage.Unit(id="i-08%02d" % i)
+                                           for i in xrange(units)])
+        strg.retrieve_instance.return_value = instance
+        strg.retrieve_scale_jobs.return_value = jobs or []
+        manager = mock.Mock(storage=strg)
+        return scheduled_scaler.ScheduledScaler(manager, **kwargs)
+
+    def schedule(self, **kwargs):
+        item = schedule.validate({"default_units": 2,
+                                  "rules": [{"start": "08:00", "end": "23:00", "units": 6}]})
+        item["instance_name"] = "myinstance"
+        item.update(kwargs)
+        return item
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        scaler = scheduled_scaler.ScheduledScaler(manager, interval=30)
+        self.assertEqual(30, scaler.interval)
+        scaler.locker.lock(scaler.lock_name)
+        scaler.locker.unlock(scaler.lock_name)
+
+    def test_inherits_from_base_runner(self):
+        self.assertIsInstance(self.build_scaler(), runners.Base)
+
+    def test_run(self):
+        scaler = self.build_scaler()
+        scaler.locker = mock.Mock()
+        scaler.evaluate = mock.Mock()
+        scaler.lead_time = mock.Mock(return_value=180)
+        schedules = [self.schedule(), self.schedule(instance_name="other")]
+        scaler.storage.retrieve_schedules.return_value = schedules
+        scaler.run()
+        scaler.locker.lock.assert_called_with(scaler.lock_name)
+        self.assertEqual([mock.call(schedules[0], 180), mock.call(schedules[1], 180)],
+                         scaler.evaluate.call_args_list)
+        scaler.locker.unlock.assert_called_with(scaler.lock_name)
+
+    def test_lead_time(self):
+        scaler = self.build_scaler(interval=60)
+        scaler.storage.retrieve_boot_latencies.return_value = range(100, 300, 10)
+        self.assertEqual(330, scaler.lead_time())
+        scaler.storage.retrieve_boot_latencies.assert_called_with(
+            limit=scheduled_scaler.BOOT_SAMPLES)
+
+    def test_lead_time_not_measured(self):
+        scaler = self.build_scaler(default_lead_time=600)
+        scaler.storage.retrieve_boot_latencies.return_value = []
+        self.assertEqual(600, scaler.lead_time())
+
+    def test_evaluate_scale_up_ahead_of_time(self):
+        scaler = self.build_scaler()
+        with freezegun.freeze_time("2014-02-17 07:56:00"):
+            scaler.evaluate(self.schedule(last_target=2), 300)
+        scaler.manager.scale_instance.assert_called_with("myinstance", 6)
+        scaler.storage.update_schedule.assert_called_with(
+            "myinstance", last_target=6, last_scaled_at=datetime.datetime(2014, 2, 17, 7, 56))
+
+    def test_evaluate_too_early(self):
+        scaler = self.build_scaler()
+        with freezegun.freeze_time("2014-02-17 07:50:00"):
+            scaler.evaluate(self.schedule(last_target=2), 300)
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    def test_evaluate_scale_down_on_time(self):
+        scaler = self.build_scaler(units=6)
+        with freezegun.freeze_time("2014-02-17 22:58:00"):
+            scaler.evaluate(self.schedule(last_target=6), 300)
+        self.assertFalse(scaler.manager.scale_instance.called)
+        with freezegun.freeze_time("2014-02-17 23:00:00"):
+            scaler.evaluate(self.schedule(last_target=6), 300)
+        scaler.manager.scale_instance.assert_called_with("myinstance", 2)
+
+    def test_evaluate_keeps_manual_scales(self):
+        scaler = self.build_scaler(units=8)
+        with freezegun.freeze_time("2014-02-17 12:00:00"):
+            scaler.evaluate(self.schedule(last_target=6), 300)
+        self.assertFalse(scaler.storage.retrieve_instance.called)
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    def test_evaluate_already_scaled(self):
+        scaler = self.build_scaler(units=6)
+        with freezegun.freeze_time("2014-02-17 12:00:00"):
+            scaler.evaluate(self.schedule(), 300)
+        self.assertFalse(scaler.manager.scale_instance.called)
+        scaler.storage.update_schedule.assert_called_with(
+            "myinstance", last_target=6, last_scaled_at=datetime.datetime(2014, 2, 17, 12))
+
+    def test_evaluate_instance_not_started(self):
+        scaler = self.build_scaler(state="scaling")
+        with freezegun.freeze_time("2014-02-17 12:00:00"):
+            scaler.evaluate(self.schedule(), 300)
+        self.assertFalse(scaler.manager.scale_instance.called)
+        self.assertFalse(scaler.storage.update_schedule.called)
+
+    def test_evaluate_pending_job(self):
+        scaler = self.build_scaler(jobs=[{"instance": "myinstance", "state": "pending"}])
+        with freezegun.freeze_time("2014-02-17 12:00:00"):
+            scaler.evaluate(self.schedule(), 300)
+        scaler.storage.retrieve_scale_jobs.assert_called_with(
+            instance="myinstance", state={"$in": ["pending", "processing"]})
+        self.assertFalse(scaler.manager.scale_instance.called)
+
+    @mock.patch("sys.stderr")
+    def test_evaluate_scale_failure(self, stderr):
+        scaler = self.build_scaler()
+        scaler.manager.scale_instance.side_effect = ValueError("instance is already scaling")
+        with freezegun.freeze_time("2014-02-17 12:00:00"):
+            scaler.evaluate(self.schedule(), 300)
+        self.assertFalse(scaler.storage.update_schedule.called)
+        stderr.write.assert_called_with("[ERROR] failed to scale myinstance: "
+                                        "instance is already scaling\n")
@@ -0,0 +1,51 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+from feaas import sharding
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ["instance%d" % i for i in xrange(1000)]
+
+    def test_owner_no_members(self):
+        self.assertIsNone(sharding.owner("instance1", []))
+
+    def test_owner_single_member(self):
+        self.assertEqual("writer1", sharding.owner("instance1", ["writer1"]))
+
+    def test_owner_doesnt_depend_on_members_order(self):
+        members = ["writer1", "writer2", "writer3"]
+        for key in self.keys[:50]:
+            self.assertEqual(sharding.owner(key, members),
+                             sharding.owner(key, list(reversed(members))))
+
+    def test_owner_balance(self):
+        members = ["writer1", "writer2", "writer3", "writer4"]
+        counts = dict([(member, 0) for member in members])
+        for key in self.keys:
+            counts[sharding.owner(key, members)] += 1
+        for count in counts.values():
+            self.assertTrue(200 < count < 300, counts)
+
+    def test_owner_member_leaves(self):
+        members = ["writer1", "writer2", "writer3"]
+        before = dict([(key, sharding.owner(key, members)) for key in self.keys])
+        after = dict([(key, sharding.owner(key, members[:2])) for key in self.keys])
+        for key in self.keys:
+            if before[key] != "writer3":
+                self.assertEqual(before[key], after[key])
+            else:
+                self.assertIn(after[key], members[:2])
+
+    def test_owner_member_joins(self):
+        members = ["writer1", "writer2"]
+        before = dict([(key, sharding.owner(key, members)) for key in self.keys])
+        after = dict([(key, sharding.owner(key, members + ["writer3"])) for key in self.keys])
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all([after[key] == "writer3" for key in moved]))
+        self.assertTrue(250 < len(moved) < 420, len(moved))
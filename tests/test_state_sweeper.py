@@ -0,0 +1,106 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import mock
+
+from feaas import runners, storage
+from feaas.runners import state_sweeper
+
+
+class StateSweeperTestCase(unittest.TestCase):
+
+    def build_sweeper(self, **kwargs):
+        manager = mock.Mock(storage=mock.Mock())
+        sweeper = state_sweeper.StateSweeper(manager, **kwargs)
+        sweeper.locker = mock.Mock()
+        sweeper.locker.release_expired.return_value = []
+        return sweeper
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        sweeper = state_sweeper.StateSweeper(manager, interval=60,
+                                             deadlines={"starting": 300})
+        self.assertEqual(60, sweeper.interval)
+        self.assertEqual(300, sweeper.deadlines["starting"])
+        self.assertEqual(1800, sweeper.deadlines["scaling"])
+        self.assertEqual([], sweeper.locker.release_expired(datetime.datetime(1970, 1, 1)))
+
+    def test_inherits_from_base_runner(self):
+        self.assertIsInstance(self.build_sweeper(), runners.Base)
+
+    def test_run(self):
+        sweeper = self.build_sweeper()
+        sweeper.release_locks = mock.Mock()
+        sweeper.sweep_instances = mock.Mock()
+        sweeper.sweep_scale_jobs = mock.Mock()
+        sweeper.run()
+        now = sweeper.release_locks.call_args[0][0]
+        sweeper.sweep_instances.assert_called_with(now)
+        sweeper.sweep_scale_jobs.assert_called_with(now)
+
+    @mock.patch("sys.stderr")
+    def test_release_locks(self, stderr):
+        sweeper = self.build_sweeper(deadlines={"lock": 600})
+        sweeper.locker.release_expired.return_value = ["instance_scalator/myapp"]
+        sweeper.release_locks(datetime.datetime(2014, 2, 16, 12, 10))
+        sweeper.locker.release_expired.assert_called_with(datetime.datetime(2014, 2, 16, 12))
+        stderr.write.assert_called_with("[ERROR] lock instance_scalator/myapp held for more "
+                                        "than 600 seconds, released\n")
+
+    @mock.patch("sys.stderr")
+    def test_sweep_instances(self, stderr):
+        sweeper = self.build_sweeper(deadlines={"starting": 600}, max_attempts=2)
+        expired = {"starting": [{"name": "first", "state": "starting"},
+                                {"name": "second", "state": "starting", "sweeps": 2}],
+                   "scaling": [{"name": "third", "state": "scaling", "sweeps": 1}],
+                   "terminating": []}
+        sweeper.storage.retrieve_expired_instances.side_effect = lambda s, b: expired[s]
+        sweeper.storage.sweep_instance.return_value = True
+        now = datetime.datetime(2014, 2, 16, 12, 10)
+        sweeper.sweep_instances(now)
+        sweeper.storage.retrieve_expired_instances.assert_any_call(
+            "starting", datetime.datetime(2014, 2, 16, 12))
+        sweeper.storage.retrieve_expired_instances.assert_any_call(
+            "scaling", now - datetime.timedelta(seconds=1800))
+        starting = "stuck in starting for more than 600 seconds"
+        scaling = "stuck in scaling for more than 1800 seconds"
+        self.assertEqual([mock.call(expired["scaling"][0], "started", scaling),
+                          mock.call(expired["starting"][0], "creating", starting),
+                          mock.call(expired["starting"][1], "error", starting)],
+                         sweeper.storage.sweep_instance.call_args_list)
+        stderr.write.assert_any_call("[ERROR] instance second {0}, moved to error\n".format(
+            starting))
+
+    @mock.patch("sys.stderr")
+    def test_sweep_instances_changed_meanwhile(self, stderr):
+        sweeper = self.build_sweeper()
+        instance = {"name": "first", "state": "terminating"}
+        sweeper.storage.retrieve_expired_instances.side_effect = \
+            lambda s, b: [instance] if s == "terminating" else []
+        sweeper.storage.sweep_instance.return_value = False
+        sweeper.sweep_instances(datetime.datetime(2014, 2, 16, 12, 10))
+        sweeper.storage.sweep_instance.assert_called_with(
+            instance, "removed", "stuck in terminating for more than 900 seconds")
+        self.assertFalse(stderr.write.called)
+
+    @mock.patch("sys.stderr")
+    def test_sweep_scale_jobs(self, stderr):
+        sweeper = self.build_sweeper(max_attempts=3)
+        jobs = [{"instance": "myapp", "state": "processing", "attempts": 1},
+                {"instance": "other", "state": "processing", "attempts": 3}]
+        sweeper.storage.retrieve_expired_scale_jobs.return_value = jobs
+        sweeper.storage.sweep_scale_job.return_value = True
+        sweeper.sweep_scale_jobs(datetime.datetime(2014, 2, 16, 12, 30))
+        sweeper.storage.retrieve_expired_scale_jobs.assert_called_with(
+            datetime.datetime(2014, 2, 16, 12))
+        reason = "stuck in processing for more than 1800 seconds"
+        self.assertEqual([mock.call(jobs[0], "pending", reason),
+                          mock.call(jobs[1], "error", reason)],
+                         sweeper.storage.sweep_scale_job.call_args_list)
+        stderr.write.assert_called_with("[ERROR] scale job of other {0}, moved to error\n".format(
+            reason))
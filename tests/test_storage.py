@@ -2,10 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import unittest
 
 import freezegun
+import mock
 import pymongo
+import pymongo.errors
 
 from feaas import storage
 
@@ -19,8 +22,8 @@ class InstanceTestCase(unittest.TestCase):
             self.assertEqual(instance, unit.instance)
 
     def test_to_dict(self):
-        instance = storage.Instance(name="myinstance", state="created")
-        expected = {"name": "myinstance", "state": "created"}
+        instance = storage.Instance(name="myinstance", state="created", plan="small")
+        expected = {"name": "myinstance", "state": "created", "plan": "small"}
         self.assertEqual(expected, instance.to_dict())
 
     def test_add_unit(self):
@@ -48,13 +51,21 @@ class UnitTestCase(unittest.TestCase):
 
     def test_to_dict(self):
         instance = storage.Instance(name="myinstance")
+        created_at = datetime.datetime(2014, 2, 16, 12, 0, 1)
         unit = storage.Unit(id="i-0800", dns_name="instance.cloud.tsuru.io",
-                            secret="abc123", state="started", instance=instance)
+                            secret="abc123", state="started", instance=instance,
+                            created_at=created_at)
         expected = {"id": "i-0800", "dns_name": "instance.cloud.tsuru.io",
                     "secret": "abc123", "state": "started",
-                    "instance_name": "myinstance"}
+                    "instance_name": "myinstance", "vcl_hash": None,
+                    "created_at": created_at}
         self.assertEqual(expected, unit.to_dict())
 
+    @freezegun.freeze_time("2014-02-16 12:00:01")
+    def test_created_at(self):
+        unit = storage.Unit(id="i-0800")
+        self.assertEqual(datetime.datetime(2014, 2, 16, 12, 0, 1), unit.created_at)
+
 
 class BindTestCase(unittest.TestCase):
 
@@ -81,14 +92,29 @@ class MongoDBStorageTestCase(unittest.TestCase):
     def setUp(self):
         self.storage = storage.MongoDBStorage(dbname="feaas_test")
 
+    @freezegun.freeze_time("2014-02-16 12:00:01")
     def test_store_instance(self):
         instance = storage.Instance(name="secret")
         self.storage.store_instance(instance)
         self.addCleanup(self.client.feaas_test.instances.remove, {"name": "secret"})
         instance = self.client.feaas_test.instances.find_one({"name": "secret"})
-        expected = {"name": "secret", "_id": instance["_id"], "state": "creating"}
+        expected = {"name": "secret", "_id": instance["_id"], "state": "creating",
+                    "plan": None, "updated_at": datetime.datetime(2014, 2, 16, 12, 0, 1)}
         self.assertEqual(expected, instance)
 
+    def test_store_instance_started_resets_sweeps(self):
+        self.addCleanup(self.client.feaas_test.instances.remove, {"name": "secret"})
+        self.client.feaas_test.instances.insert({"name": "secret", "state": "creating",
+                                                 "sweeps": 2, "sweep_reason": "stuck"})
+        instance = storage.Instance(name="secret", state="started")
+        self.storage.store_instance(instance)
+        instance = self.client.feaas_test.instances.find_one({"name": "secret"})
+        self.assertNotIn("sweeps", instance)
+        self.assertEqual("stuck", instance["sweep_reason"])
+        got_instance = self.storage.retrieve_instance(name="secret")
+        self.assertEqual("started", got_instance.state)
+
+    @freezegun.freeze_time("2014-02-16 12:00:01")
     def test_store_instance_with_units(self):
         units = [storage.Unit(dns_name="instance.cloud.tsuru.io", id="i-0800")]
         instance = storage.Instance(name="secret", units=units)
@@ -96,7 +122,8 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.addCleanup(self.client.feaas_test.instances.remove, {"name": "secret"})
         self.addCleanup(self.client.feaas_test.units.remove, {"instance_name": "secret"})
         instance = self.client.feaas_test.instances.find_one({"name": "secret"})
-        expected = {"name": "secret", "_id": instance["_id"], "state": "creating"}
+        expected = {"name": "secret", "_id": instance["_id"], "state": "creating",
+                    "plan": None, "updated_at": datetime.datetime(2014, 2, 16, 12, 0, 1)}
         self.assertEqual(expected, instance)
         unit = self.client.feaas_test.units.find_one({"id": "i-0800",
                                                       "instance_name": "secret"})
@@ -223,6 +250,124 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.assertEqual(expected_job, got_job)
         self.assertEqual("processing", got_job["state"])
 
+    def test_store_scale_job_coalesces_pending_jobs(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        processing = {"instance": "myapp", "quantity": 2, "state": "processing"}
+        self.storage.store_scale_job(processing)
+        for quantity in (3, 5, 4):
+            job = {"instance": "myapp", "quantity": quantity}
+            self.storage.store_scale_job(job)
+        jobs = self.storage.retrieve_scale_jobs(instance="myapp", state="pending")
+        self.assertEqual([job], jobs)
+        self.assertEqual(4, jobs[0]["quantity"])
+        self.assertEqual(2, self.client.feaas_test.scale_jobs.find().count())
+
+    def test_store_scale_job_single_pending_job_per_instance(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 2})
+        with self.assertRaises(pymongo.errors.DuplicateKeyError):
+            self.client.feaas_test.scale_jobs.insert({"instance": "myapp", "quantity": 3,
+                                                      "state": "pending",
+                                                      "pending_instance": "myapp"})
+        job = self.storage.get_scale_job()
+        self.assertNotIn("pending_instance", job)
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 3})
+        self.assertEqual(2, self.client.feaas_test.scale_jobs.find().count())
+
+    def test_store_scale_job_concurrent_insert(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 2})
+        stored = self.client.feaas_test.scale_jobs.find_one()
+        scale_jobs = mock.Mock()
+        scale_jobs.find_and_modify.side_effect = [pymongo.errors.DuplicateKeyError("dup"),
+                                                  stored]
+        db = mock.Mock(scale_jobs=scale_jobs)
+        self.storage.db = db
+        self.storage.scale_jobs_ready = True
+        job = {"instance": "myapp", "quantity": 3}
+        self.storage.store_scale_job(job)
+        self.assertEqual(stored["_id"], job["_id"])
+        query = {"instance": "myapp", "state": "pending"}
+        self.assertEqual([mock.call(query, {"$set": job}, upsert=True, new=True),
+                          mock.call(query, {"$set": job}, new=True)],
+                         scale_jobs.find_and_modify.call_args_list)
+
+    def test_store_scale_job_concurrent_insert_claimed(self):
+        scale_jobs = mock.Mock()
+        scale_jobs.find_and_modify.side_effect = [pymongo.errors.DuplicateKeyError("dup"),
+                                                  None, {"_id": "abc123"}]
+        self.storage.db = mock.Mock(scale_jobs=scale_jobs)
+        self.storage.scale_jobs_ready = True
+        job = {"instance": "myapp", "quantity": 3}
+        self.storage.store_scale_job(job)
+        self.assertEqual("abc123", job["_id"])
+        query = {"instance": "myapp", "state": "pending"}
+        self.assertEqual([mock.call(query, {"$set": job}, upsert=True, new=True),
+                          mock.call(query, {"$set": job}, new=True),
+                          mock.call(query, {"$set": job}, upsert=True, new=True)],
+                         scale_jobs.find_and_modify.call_args_list)
+
+    def test_reset_scale_job_superseded(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        processing = {"instance": "myapp", "quantity": 2, "state": "processing"}
+        self.storage.store_scale_job(processing)
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 3})
+        self.storage.reset_scale_job(processing)
+        self.assertEqual("done", processing["state"])
+        jobs = self.storage.retrieve_scale_jobs(instance="myapp", state="pending")
+        self.assertEqual([3], [job["quantity"] for job in jobs])
+
+    def test_retrieve_expired_instances(self):
+        self.addCleanup(self.client.feaas_test.instances.remove, {})
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            self.storage.store_instance(storage.Instance(name="old", state="starting"))
+            self.storage.store_instance(storage.Instance(name="other", state="scaling"))
+        with freezegun.freeze_time("2014-02-16 12:20:00"):
+            self.storage.store_instance(storage.Instance(name="new", state="starting"))
+        before = datetime.datetime(2014, 2, 16, 12, 10)
+        instances = self.storage.retrieve_expired_instances("starting", before)
+        self.assertEqual(["old"], [i["name"] for i in instances])
+
+    def test_sweep_instance(self):
+        self.addCleanup(self.client.feaas_test.instances.remove, {"name": "old"})
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            self.storage.store_instance(storage.Instance(name="old", state="starting"))
+        instance = self.storage.retrieve_expired_instances(
+            "starting", datetime.datetime(2014, 2, 16, 12, 10))[0]
+        with freezegun.freeze_time("2014-02-16 12:20:00"):
+            swept = self.storage.sweep_instance(instance, "creating", "stuck in starting")
+        self.assertTrue(swept)
+        got = self.client.feaas_test.instances.find_one({"name": "old"})
+        self.assertEqual("creating", got["state"])
+        self.assertEqual(1, got["sweeps"])
+        self.assertEqual("stuck in starting", got["sweep_reason"])
+        self.assertEqual(datetime.datetime(2014, 2, 16, 12, 20), got["updated_at"])
+        self.assertFalse(self.storage.sweep_instance(instance, "creating", "stuck"))
+        self.assertEqual(1, self.client.feaas_test.instances.find_one()["sweeps"])
+
+    def test_sweep_scale_job(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 2})
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            self.storage.get_scale_job()
+        jobs = self.storage.retrieve_expired_scale_jobs(datetime.datetime(2014, 2, 16, 12, 30))
+        self.assertEqual(1, len(jobs))
+        self.assertTrue(self.storage.sweep_scale_job(jobs[0], "pending", "stuck"))
+        self.assertFalse(self.storage.sweep_scale_job(jobs[0], "pending", "stuck"))
+        got = self.client.feaas_test.scale_jobs.find_one()
+        self.assertEqual("pending", got["state"])
+        self.assertEqual(1, got["attempts"])
+        self.assertEqual("stuck", got["sweep_reason"])
+
+    def test_sweep_scale_job_superseded(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 2})
+        job = self.storage.get_scale_job()
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 3})
+        self.assertTrue(self.storage.sweep_scale_job(job, "pending", "stuck"))
+        got = self.client.feaas_test.scale_jobs.find_one({"_id": job["_id"]})
+        self.assertEqual("done", got["state"])
+
     def test_get_scale_job_not_found(self):
         job = self.storage.get_scale_job()
         self.assertIsNone(job)
@@ -245,6 +390,32 @@ class MongoDBStorageTestCase(unittest.TestCase):
         persisted_job = self.client.feaas_test.scale_jobs.find_one()
         self.assertEqual(job, persisted_job)
 
+    def test_reset_scale_job_retry_after(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 2})
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            job = self.storage.get_scale_job()
+            self.storage.reset_scale_job(job, retry_after=datetime.datetime(2014, 2, 16, 12, 1))
+            self.assertIsNone(self.storage.get_scale_job())
+        self.assertEqual(1, job["attempts"])
+        persisted_job = self.client.feaas_test.scale_jobs.find_one()
+        self.assertEqual(job, persisted_job)
+        with freezegun.freeze_time("2014-02-16 12:01:00"):
+            job = self.storage.get_scale_job()
+        self.assertEqual("processing", job["state"])
+
+    def test_fail_scale_job(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "myapp"})
+        self.storage.store_scale_job({"instance": "myapp", "quantity": 2})
+        job = self.storage.get_scale_job()
+        self.storage.fail_scale_job(job, "quota exceeded")
+        self.assertEqual("error", job["state"])
+        persisted_job = self.client.feaas_test.scale_jobs.find_one()
+        self.assertEqual(job, persisted_job)
+        self.assertEqual(1, persisted_job["attempts"])
+        self.assertEqual("quota exceeded", persisted_job["error"])
+        self.assertIsNone(self.storage.get_scale_job())
+
     def test_reset_scale_job_no_id(self):
         job = {"instance": "myapp", "quantity": 2, "state": "processing"}
         with self.assertRaises(ValueError) as cm:
@@ -322,13 +493,292 @@ class MongoDBStorageTestCase(unittest.TestCase):
 
     def test_remove_bind(self):
         instance = storage.Instance(name="years")
-        bind = storage.Bind(app_host="something.where.com", instance=instance)
+        bind = storage.Bind(app_host="something.where.com", instance=instance,
+                            state="removing")
         self.storage.store_bind(bind)
         self.addCleanup(self.client.feaas_test.binds.remove,
                         {"instance_name": "years"})
         self.storage.remove_bind(bind)
         self.assertEqual([], self.storage.retrieve_binds(instance_name="years"))
 
+    @freezegun.freeze_time("2014-02-16 12:00:01")
+    def test_remove_bind_keeps_rebind(self):
+        instance = storage.Instance(name="years")
+        bind = storage.Bind(app_host="something.where.com", instance=instance)
+        self.storage.store_bind(bind)
+        self.addCleanup(self.client.feaas_test.binds.remove,
+                        {"instance_name": "years"})
+        self.storage.update_bind(bind, state="removing")
+        rebind = storage.Bind(app_host="something.where.com", instance=instance)
+        self.storage.store_bind(rebind)
+        bind.state = "removing"
+        self.storage.remove_bind(bind)
+        binds = self.storage.retrieve_binds(instance_name="years")
+        self.assertEqual([rebind.to_dict()], [b.to_dict() for b in binds])
+
+    def test_store_vcl_retry(self):
+        instance = storage.Instance(name="years")
+        unit1 = storage.Unit(id="i-0800", instance=instance)
+        unit2 = storage.Unit(id="i-0801", instance=instance)
+        self.addCleanup(self.client.feaas_test.vcl_retries.remove,
+                        {"instance_name": "years"})
+        self.storage.store_vcl_retry(unit1, attempts=1, error="timeout")
+        self.storage.store_vcl_retry(unit1, attempts=2)
+        self.storage.store_vcl_retry(unit2, attempts=1)
+        expected = [{"instance_name": "years", "unit_id": "i-0800", "attempts": 2,
+                     "error": "timeout"},
+                    {"instance_name": "years", "unit_id": "i-0801", "attempts": 1}]
+        self.assertEqual(expected, self.storage.retrieve_vcl_retries(instance_name="years"))
+
+    def test_remove_vcl_retry(self):
+        instance = storage.Instance(name="years")
+        unit1 = storage.Unit(id="i-0800", instance=instance)
+        unit2 = storage.Unit(id="i-0801", instance=instance)
+        self.addCleanup(self.client.feaas_test.vcl_retries.remove,
+                        {"instance_name": "years"})
+        self.storage.store_vcl_retry(unit1, attempts=1)
+        self.storage.store_vcl_retry(unit2, attempts=1)
+        self.storage.remove_vcl_retry(unit1)
+        got = self.storage.retrieve_vcl_retries(instance_name="years")
+        self.assertEqual(["i-0801"], [item["unit_id"] for item in got])
+
+    def test_requeue_vcl_retries(self):
+        instance = storage.Instance(name="years")
+        units = [storage.Unit(id="i-0800", instance=instance),
+                 storage.Unit(id="i-0801", instance=instance),
+                 storage.Unit(id="i-0802", instance=instance)]
+        self.addCleanup(self.client.feaas_test.vcl_retries.remove,
+                        {"instance_name": "years"})
+        dead_at = datetime.datetime(2014, 2, 16, 12, 0)
+        self.storage.store_vcl_retry(units[0], attempts=10, state="dead", dead_at=dead_at)
+        self.storage.store_vcl_retry(units[1], attempts=10, state="dead", dead_at=dead_at)
+        self.storage.store_vcl_retry(units[2], attempts=1)
+        self.assertEqual(1, self.storage.requeue_vcl_retries("years", "i-0801"))
+        self.assertEqual(1, self.storage.requeue_vcl_retries("years"))
+        self.assertEqual(0, self.storage.requeue_vcl_retries("years"))
+        got = self.storage.retrieve_vcl_retries(state="requeued")
+        self.assertEqual([{"instance_name": "years", "unit_id": "i-0800", "attempts": 0,
+                           "state": "requeued", "retry_at": None},
+                          {"instance_name": "years", "unit_id": "i-0801", "attempts": 0,
+                           "state": "requeued", "retry_at": None}],
+                         sorted(got, key=lambda item: item["unit_id"]))
+
+    def test_instance_leases(self):
+        self.addCleanup(self.client.feaas_test.vcl_leases.remove, {})
+        now = datetime.datetime(2014, 2, 16, 12, 0)
+        later = datetime.datetime(2014, 2, 16, 12, 1)
+        self.assertTrue(self.storage.claim_instance_lease("years", "writer1", later, now))
+        self.assertTrue(self.storage.claim_instance_lease("years", "writer1", later, now))
+        self.assertFalse(self.storage.claim_instance_lease("years", "writer2", later, now))
+        self.storage.renew_instance_leases("writer1", ["years"],
+                                           datetime.datetime(2014, 2, 16, 12, 2))
+        self.assertFalse(self.storage.claim_instance_lease("years", "writer2", later, later))
+        self.assertTrue(self.storage.claim_instance_lease(
+            "years", "writer2", datetime.datetime(2014, 2, 16, 12, 4),
+            datetime.datetime(2014, 2, 16, 12, 3)))
+        self.storage.remove_instance_leases("writer1", ["years"])
+        self.assertFalse(self.storage.claim_instance_lease("years", "writer1", later, later))
+        self.storage.remove_instance_leases("writer2", ["years"])
+        self.assertTrue(self.storage.claim_instance_lease("years", "writer1", later, later))
+
+    def test_writers(self):
+        self.addCleanup(self.client.feaas_test.vcl_writers.remove, {})
+        self.storage.store_writer_heartbeat("writer1", datetime.datetime(2014, 2, 16, 12, 0))
+        self.storage.store_writer_heartbeat("writer2", datetime.datetime(2014, 2, 16, 12, 0))
+        self.storage.store_writer_heartbeat("writer1", datetime.datetime(2014, 2, 16, 12, 1))
+        self.assertEqual(["writer1", "writer2"], sorted(self.storage.retrieve_writers()))
+        self.storage.remove_writers(heartbeat_at={"$lt": datetime.datetime(2014, 2, 16, 12, 1)})
+        self.assertEqual(["writer1"], self.storage.retrieve_writers())
+        self.storage.remove_writer("writer1")
+        self.assertEqual([], self.storage.retrieve_writers())
+
+    def test_store_cache_policy(self):
+        self.addCleanup(self.client.feaas_test.cache_policies.remove,
+                        {"instance_name": "years"})
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_cache_policy("years", {"grace": 30})
+        with freezegun.freeze_time("2014-02-16 12:00:02"):
+            self.storage.store_cache_policy("years", {"grace": 60})
+        expected = {"instance_name": "years", "policy": {"grace": 60},
+                    "state": "pending", "updated_at": datetime.datetime(2014, 2, 16, 12, 0, 2)}
+        self.assertEqual(expected, self.storage.retrieve_cache_policy("years"))
+        self.assertEqual([expected],
+                         self.storage.retrieve_cache_policies(state="pending",
+                                                              instance_name="years"))
+
+    def test_retrieve_cache_policy_not_found(self):
+        self.assertIsNone(self.storage.retrieve_cache_policy("years"))
+
+    def test_update_cache_policy(self):
+        self.addCleanup(self.client.feaas_test.cache_policies.remove,
+                        {"instance_name": "years"})
+        self.storage.store_cache_policy("years", {"grace": 30})
+        stored = self.storage.retrieve_cache_policy("years")
+        self.storage.update_cache_policy(stored, state="applied")
+        self.assertEqual("applied", self.storage.retrieve_cache_policy("years")["state"])
+
+    def test_update_cache_policy_changed_meanwhile(self):
+        self.addCleanup(self.client.feaas_test.cache_policies.remove,
+                        {"instance_name": "years"})
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_cache_policy("years", {"grace": 30})
+        stored = self.storage.retrieve_cache_policy("years")
+        with freezegun.freeze_time("2014-02-16 12:00:02"):
+            self.storage.store_cache_policy("years", {"grace": 60})
+        self.storage.update_cache_policy(stored, state="applied")
+        self.assertEqual("pending", self.storage.retrieve_cache_policy("years")["state"])
+
+    def test_store_varnish_params(self):
+        self.addCleanup(self.client.feaas_test.varnish_params.remove,
+                        {"instance_name": "years"})
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_varnish_params("years", {"thread_pools": 2,
+                                                        "thread_pool_min": 10})
+        stored = self.storage.retrieve_varnish_params(instance_name="years")[0]
+        self.storage.update_varnish_params(stored, applied=["i-0800"])
+        with freezegun.freeze_time("2014-02-16 12:00:02"):
+            self.storage.store_varnish_params("years", {"thread_pools": 4})
+        expected = [{"instance_name": "years",
+                     "params": {"thread_pools": 4, "thread_pool_min": 10},
+                     "applied": [], "updated_at": datetime.datetime(2014, 2, 16, 12, 0, 2)}]
+        self.assertEqual(expected, self.storage.retrieve_varnish_params(instance_name="years"))
+
+    def test_store_warm_urls(self):
+        self.addCleanup(self.client.feaas_test.warm_urls.remove,
+                        {"instance_name": "years"})
+        self.storage.store_warm_urls("years", ["http://years.com/"])
+        self.storage.store_warm_urls("years", ["http://years.com/", "http://years.com/a"])
+        expected = [{"instance_name": "years",
+                     "urls": ["http://years.com/", "http://years.com/a"]}]
+        self.assertEqual(expected, self.storage.retrieve_warm_urls(instance_name="years"))
+
+    def test_store_warmup(self):
+        self.addCleanup(self.client.feaas_test.warmups.remove,
+                        {"instance_name": "years"})
+        unit = storage.Unit(id="i-0800", instance=storage.Instance(name="years"))
+        self.storage.store_warmup(unit, urls=2, warmed=1, coverage=0.5, duration=1.5)
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_warmup(unit, urls=2, warmed=2, coverage=1.0, duration=1.2)
+        expected = [{"instance_name": "years", "unit_id": "i-0800", "urls": 2,
+                     "warmed": 2, "coverage": 1.0, "duration": 1.2,
+                     "finished_at": datetime.datetime(2014, 2, 16, 12, 0, 1)}]
+        self.assertEqual(expected, self.storage.retrieve_warmups(instance_name="years"))
+
+    def test_store_autoscale(self):
+        self.addCleanup(self.client.feaas_test.autoscale.remove,
+                        {"instance_name": "years"})
+        self.storage.store_autoscale("years", {"signal": "requests", "min_units": 1})
+        self.storage.update_autoscale("years", last_scaled_at=datetime.datetime(2014, 2, 16))
+        self.storage.store_autoscale("years", {"signal": "requests", "min_units": 2})
+        expected = [{"instance_name": "years", "signal": "requests", "min_units": 2,
+                     "last_scaled_at": datetime.datetime(2014, 2, 16)}]
+        self.assertEqual(expected, self.storage.retrieve_autoscale(instance_name="years"))
+        self.storage.remove_autoscale("years")
+        self.assertEqual([], self.storage.retrieve_autoscale(instance_name="years"))
+
+    def test_retrieve_scale_jobs(self):
+        self.addCleanup(self.client.feaas_test.scale_jobs.remove, {"instance": "years"})
+        self.storage.store_scale_job({"instance": "years", "quantity": 2})
+        self.storage.store_scale_job({"instance": "years", "quantity": 3, "state": "done"})
+        jobs = self.storage.retrieve_scale_jobs(instance="years", state="pending")
+        self.assertEqual([2], [job["quantity"] for job in jobs])
+
+    def test_store_schedule(self):
+        self.addCleanup(self.client.feaas_test.schedules.remove,
+                        {"instance_name": "years"})
+        rules = [{"start": "08:00", "end": "23:00", "units": 6, "days": ["mon"]}]
+        self.storage.store_schedule("years", {"default_units": 2, "rules": rules})
+        self.storage.update_schedule("years", last_target=6)
+        self.assertEqual(6, self.storage.retrieve_schedules()[0]["last_target"])
+        self.storage.store_schedule("years", {"default_units": 3, "rules": rules})
+        expected = [{"instance_name": "years", "default_units": 3, "rules": rules}]
+        self.assertEqual(expected, self.storage.retrieve_schedules(instance_name="years"))
+        self.storage.remove_schedule("years")
+        self.assertEqual([], self.storage.retrieve_schedules(instance_name="years"))
+
+    def test_store_boot_latency(self):
+        self.addCleanup(self.client.feaas_test.boot_latencies.remove,
+                        {"instance_name": "years"})
+        unit = storage.Unit(id="i-0800", instance=storage.Instance(name="years"))
+        for second, latency in enumerate([120.5, 90, 180]):
+            with freezegun.freeze_time("2014-02-16 12:00:%02d" % second):
+                self.storage.store_boot_latency(unit, latency)
+        self.assertEqual([180, 90], self.storage.retrieve_boot_latencies(limit=2))
+
+    def test_record_probe(self):
+        self.addCleanup(self.client.feaas_test.unit_health.remove,
+                        {"instance_name": "years"})
+        unit = storage.Unit(id="i-0800", instance=storage.Instance(name="years"))
+        self.assertEqual(1, self.storage.record_probe(unit, False))
+        self.assertEqual(2, self.storage.record_probe(unit, False))
+        self.assertEqual(0, self.storage.record_probe(unit, True))
+        self.assertEqual(1, self.storage.record_probe(unit, False))
+
+    def test_store_unit_replacement(self):
+        self.addCleanup(self.client.feaas_test.unit_replacements.remove,
+                        {"instance_name": "years"})
+        replacement = {"instance_name": "years", "dead_unit_id": "i-0800",
+                       "replacement_id": "i-0801"}
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_unit_replacement(replacement)
+        self.storage.update_unit_replacement(replacement, state="done")
+        stored = self.storage.retrieve_unit_replacements(instance_name="years")
+        self.assertEqual([replacement], stored)
+        self.assertEqual("done", stored[0]["state"])
+        self.assertEqual(datetime.datetime(2014, 2, 16, 12, 0, 1), stored[0]["created_at"])
+
+    def test_store_unit_counters(self):
+        self.addCleanup(self.client.feaas_test.unit_counters.remove,
+                        {"instance_name": "years"})
+        unit = storage.Unit(id="i-0800", instance=storage.Instance(name="years"))
+        self.storage.store_unit_counters(unit, {"client_req": 10})
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_unit_counters(unit, {"client_req": 20})
+        expected = [{"unit_id": "i-0800", "instance_name": "years",
+                     "counters": {"client_req": 20},
+                     "collected_at": datetime.datetime(2014, 2, 16, 12, 0, 1)}]
+        self.assertEqual(expected, self.storage.retrieve_unit_counters(unit_id="i-0800"))
+
+    def test_store_metrics(self):
+        self.addCleanup(self.client.feaas_test.drop_collection, "metrics")
+        points = [{"timestamp": datetime.datetime(2014, 2, 16, 12, minute), "requests": minute}
+                  for minute in (1, 2, 3)]
+        for point in reversed(points):
+            self.storage.store_metrics("years", point)
+        self.storage.store_metrics("months", {"requests": 4})
+        self.assertTrue(self.client.feaas_test.metrics.options()["capped"])
+        stored = self.storage.retrieve_metrics("years",
+                                               since=datetime.datetime(2014, 2, 16, 12, 2))
+        expected = [dict(point, instance_name="years") for point in points[1:]]
+        self.assertEqual(expected, stored)
+
+    def test_store_metrics_rollups(self):
+        self.addCleanup(self.client.feaas_test.drop_collection, "metrics")
+        self.addCleanup(self.client.feaas_test.drop_collection, "metric_rollups")
+        for hour, minute, requests in [(11, 59, 1), (12, 1, 2), (12, 30, 3)]:
+            point = {"timestamp": datetime.datetime(2014, 2, 16, hour, minute),
+                     "requests": requests, "objects": 10 * requests, "units": 1}
+            self.storage.store_metrics("years", point)
+        self.storage.store_metrics("months", {"timestamp": datetime.datetime(2014, 2, 16, 12),
+                                              "requests": 4})
+        rollups = self.storage.retrieve_metric_rollups(
+            "years", since=datetime.datetime(2014, 2, 16, 12))
+        self.assertEqual([{"timestamp": datetime.datetime(2014, 2, 16, 12), "requests": 5,
+                           "hits": 0, "misses": 0, "backend_fetches": 0, "objects": 50,
+                           "units": 2, "samples": 2}], rollups)
+
+    def test_update_varnish_params_changed_meanwhile(self):
+        self.addCleanup(self.client.feaas_test.varnish_params.remove,
+                        {"instance_name": "years"})
+        with freezegun.freeze_time("2014-02-16 12:00:01"):
+            self.storage.store_varnish_params("years", {"thread_pools": 2})
+        stored = self.storage.retrieve_varnish_params(instance_name="years")[0]
+        with freezegun.freeze_time("2014-02-16 12:00:02"):
+            self.storage.store_varnish_params("years", {"thread_pools": 4})
+        self.storage.update_varnish_params(stored, applied=["i-0800"])
+        got = self.storage.retrieve_varnish_params(instance_name="years")[0]
+        self.assertEqual([], got["applied"])
+
     def test_retrieve_units(self):
         units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800"),
                  storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801"),
@@ -341,6 +791,15 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.assertEqual([u.to_dict() for u in units[:2]],
                          [u.to_dict() for u in got_units])
 
+    def test_retrieve_units_without_created_at(self):
+        self.client.feaas_test.units.insert({"id": "i-0800", "dns_name": "instance1",
+                                             "secret": None, "state": "creating",
+                                             "instance_name": "great", "vcl_hash": None})
+        self.addCleanup(self.client.feaas_test.units.remove, {"instance_name": "great"})
+        got_units = self.storage.retrieve_units(instance_name="great")
+        self.assertEqual(1, len(got_units))
+        self.assertIsNone(got_units[0].created_at)
+
     def test_retrieve_units_limited(self):
         units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800"),
                  storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801"),
@@ -368,11 +827,29 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.assertEqual([u.to_dict() for u in units],
                          [u.to_dict() for u in got_units])
 
+    def test_store_and_remove_unit(self):
+        units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800"),
+                 storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801")]
+        instance = storage.Instance(name="great", units=units[:1])
+        self.storage.store_instance(instance)
+        self.addCleanup(self.storage.remove_instance, instance.name)
+        instance.add_unit(units[1])
+        self.storage.store_unit(units[1])
+        units[0].state = "started"
+        self.storage.store_unit(units[0])
+        got_units = self.storage.retrieve_units(instance_name="great")
+        self.assertEqual([u.to_dict() for u in units],
+                         sorted([u.to_dict() for u in got_units], key=lambda u: u["id"]))
+        self.storage.remove_unit(units[0])
+        got_units = self.storage.retrieve_units(instance_name="great")
+        self.assertEqual(["i-0801"], [u.id for u in got_units])
+
     def test_update_bind(self):
         instance = storage.Instance(name="great")
         bind = storage.Bind("wat.g1.cloud.tsuru.io", instance)
         self.storage.store_bind(bind)
-        self.addCleanup(self.storage.remove_bind, bind)
+        self.addCleanup(self.client.feaas_test.binds.remove,
+                        {"instance_name": "great"})
         self.storage.update_bind(bind, state="created")
         bind = self.storage.retrieve_binds(instance_name="great")[0]
         self.assertEqual("created", bind.state)
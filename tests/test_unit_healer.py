@@ -0,0 +1,235 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import freezegun
+import mock
+
+from feaas import runners, storage
+from feaas.runners import unit_healer
+
+
+class UnitHealerTestCase(unittest.TestCase):
+
+    def build_healer(self, **kwargs):
+        manager = mock.Mock(storage=mock.Mock())
+        healer = unit_healer.UnitHealer(manager, **kwargs)
+        healer.locker = mock.Mock()
+        return healer
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        healer = unit_healer.UnitHealer(manager, interval=30)
+        self.assertEqual(30, healer.interval)
+        healer.locker.lock(healer.lock_name)
+        healer.locker.unlock(healer.lock_name)
+
+    def test_inherits_from_base_runner(self):
+        self.assertIsInstance(self.build_healer(), runners.Base)
+
+    def test_run(self):
+        healer = self.build_healer()
+        units = [storage.Unit(id="i-0800"), storage.Unit(id="i-0801")]
+        healer.finish_replacements = mock.Mock()
+        healer.find_dead_units = mock.Mock(return_value=units)
+        healer.replace = mock.Mock()
+        healer.run()
+        healer.locker.lock.assert_called_with(healer.lock_name)
+        self.assertEqual(1, healer.finish_replacements.call_count)
+        self.assertEqual([mock.call(units[0]), mock.call(units[1])],
+                         healer.replace.call_args_list)
+        healer.locker.unlock.assert_called_with(healer.lock_name)
+
+    def test_find_dead_units(self):
+        healer = self.build_healer(failure_threshold=3, boot_deadline=600)
+        started = [storage.Unit(id="i-0800"), storage.Unit(id="i-0801"),
+                   storage.Unit(id="i-0802")]
+        stuck = [storage.Unit(id="i-0803", state="creating")]
+        healer.storage.retrieve_units.side_effect = [started, stuck]
+        healer.manager.is_unit_up.side_effect = lambda unit: unit.id == "i-0800"
+        failures = {"i-0800": 0, "i-0801": 3, "i-0802": 2}
+        healer.storage.record_probe.side_effect = lambda unit, ok: failures[unit.id]
+        with freezegun.freeze_time("2014-02-16 12:10:00"):
+            dead = healer.find_dead_units()
+        self.assertEqual([started[1], stuck[0]], dead)
+        self.assertEqual([mock.call(started[0], True), mock.call(started[1], False),
+                          mock.call(started[2], False)],
+                         healer.storage.record_probe.call_args_list)
+        healer.storage.retrieve_units.assert_called_with(
+            state="creating", created_at={"$lt": datetime.datetime(2014, 2, 16, 12, 0)})
+
+    def test_replace(self):
+        healer = self.build_healer()
+        dead = storage.Unit(id="i-0800", dns_name="dead.cloud.tsuru.io", state="started")
+        instance = storage.Instance(name="myinstance", state="started", units=[dead])
+        dead_copy = storage.Unit(id="i-0800", instance=storage.Instance(name="myinstance"))
+        healer.storage.retrieve_instance.return_value = instance
+        healer.storage.retrieve_unit_replacements.return_value = [{"state": "done"}]
+        healer.manager.replace_unit.return_value = storage.Unit(id="i-0801")
+        with freezegun.freeze_time("2014-02-16 12:00:00"):
+            healer.replace(dead_copy)
+        healer.storage.retrieve_unit_replacements.assert_called_with(
+            instance_name="myinstance",
+            created_at={"$gte": datetime.datetime(2014, 2, 16, 11, 0)})
+        self.assertEqual("dead", dead.state)
+        healer.storage.update_units.assert_called_with([dead_copy], state="dead")
+        healer.manager.replace_unit.assert_called_with(instance)
+        healer.storage.store_unit_replacement.assert_called_with(
+            {"instance_name": "myinstance", "dead_unit_id": "i-0800",
+             "replacement_id": "i-0801"})
+        healer.locker.init.assert_called_with("instance_scalator/myinstance")
+        healer.locker.lock.assert_called_with("instance_scalator/myinstance")
+        healer.locker.unlock.assert_called_with("instance_scalator/myinstance")
+
+    def test_replace_reads_instance_under_lock(self):
+        healer = self.build_healer()
+        calls = []
+        healer.locker.lock.side_effect = lambda name: calls.append("lock")
+        healer.locker.unlock.side_effect = lambda name: calls.append("unlock")
+
+        def retrieve_instance(**query):
+            calls.append("retrieve_instance")
+            raise storage.InstanceNotFoundError()
+
+        healer.storage.retrieve_instance.side_effect = retrieve_instance
+        healer.replace(storage.Unit(id="i-0800", instance=storage.Instance(name="myinstance")))
+        self.assertEqual(["lock", "retrieve_instance", "unlock"], calls)
+
+    def test_replace_unit_removed_meanwhile(self):
+        healer = self.build_healer()
+        unit = storage.Unit(id="i-0800", instance=storage.Instance(name="myinstance"))
+        healer.storage.retrieve_instance.return_value = storage.Instance(
+            name="myinstance", state="started", units=[storage.Unit(id="i-0801")])
+        healer.replace(unit)
+        self.assertFalse(healer.storage.update_units.called)
+        self.assertFalse(healer.manager.replace_unit.called)
+        healer.locker.unlock.assert_called_with("instance_scalator/myinstance")
+
+    @mock.patch("sys.stderr")
+    def test_replace_rate_limited(self, stderr):
+        healer = self.build_healer(max_replacements=2)
+        unit = storage.Unit(id="i-0800", dns_name="dead.cloud.tsuru.io",
+                            instance=storage.Instance(name="myinstance"))
+        healer.storage.retrieve_instance.return_value = storage.Instance(
+            name="myinstance", state="started", units=[storage.Unit(id="i-0800")])
+        healer.storage.retrieve_unit_replacements.return_value = [{}, {}]
+        healer.replace(unit)
+        self.assertFalse(healer.manager.replace_unit.called)
+        stderr.write.assert_called_with("[ERROR] replacement limit reached for myinstance, "
+                                        "not replacing dead.cloud.tsuru.io\n")
+
+    def test_replace_instance_not_started(self):
+        healer = self.build_healer()
+        unit = storage.Unit(id="i-0800", instance=storage.Instance(name="myinstance"))
+        healer.storage.retrieve_instance.return_value = storage.Instance(name="myinstance",
+                                                                         state="scaling")
+        healer.replace(unit)
+        self.assertFalse(healer.manager.replace_unit.called)
+
+    @mock.patch("sys.stderr")
+    def test_replace_failure(self, stderr):
+        healer = self.build_healer()
+        unit = storage.Unit(id="i-0800", dns_name="dead.cloud.tsuru.io",
+                            instance=storage.Instance(name="myinstance"))
+        healer.storage.retrieve_instance.return_value = storage.Instance(
+            name="myinstance", state="started", units=[storage.Unit(id="i-0800")])
+        healer.storage.retrieve_unit_replacements.return_value = []
+        healer.manager.replace_unit.side_effect = ValueError("quota exceeded")
+        healer.replace(unit)
+        self.assertFalse(healer.storage.store_unit_replacement.called)
+        stderr.write.assert_called_with("[ERROR] failed to replace dead.cloud.tsuru.io: "
+                                        "quota exceeded\n")
+        healer.locker.unlock.assert_called_with("instance_scalator/myinstance")
+
+    @mock.patch("sys.stderr")
+    @freezegun.freeze_time("2014-02-16 12:10:00")
+    def test_finish_replacements(self, stderr):
+        healer = self.build_healer(boot_deadline=900)
+        created_at = datetime.datetime(2014, 2, 16, 12, 0)
+        replacements = [{"instance_name": "myinstance", "dead_unit_id": "i-0800",
+                         "replacement_id": "i-0801", "created_at": created_at},
+                        {"instance_name": "myinstance", "dead_unit_id": "i-0802",
+                         "replacement_id": "i-0803", "created_at": created_at},
+                        {"instance_name": "myinstance", "dead_unit_id": "i-0804",
+                         "replacement_id": "i-0805", "created_at": created_at}]
+        units = {"i-0801": [storage.Unit(id="i-0801", state="started")],
+                 "i-0803": [storage.Unit(id="i-0803", state="creating")],
+                 "i-0805": []}
+        healer.storage.retrieve_unit_replacements.return_value = replacements
+        healer.storage.retrieve_units.side_effect = lambda id: units[id]
+        dead = storage.Unit(id="i-0800", state="dead")
+        instance = storage.Instance(name="myinstance", units=[dead, units["i-0801"][0]])
+        healer.storage.retrieve_instance.return_value = instance
+        healer.finish_replacements()
+        healer.storage.retrieve_unit_replacements.assert_called_with(state="provisioning")
+        healer.manager.remove_unit.assert_called_once_with(instance, dead)
+        self.assertEqual([mock.call("instance_scalator/myinstance")] * 2,
+                         healer.locker.lock.call_args_list)
+        self.assertEqual(2, healer.locker.unlock.call_count)
+        self.assertEqual([mock.call(replacements[0], state="done"),
+                          mock.call(replacements[2], state="failed")],
+                         healer.storage.update_unit_replacement.call_args_list)
+
+    @mock.patch("sys.stderr")
+    @freezegun.freeze_time("2014-02-16 12:30:00")
+    def test_finish_replacements_failed(self, stderr):
+        healer = self.build_healer(boot_deadline=900)
+        replacements = [{"instance_name": "myinstance", "dead_unit_id": "i-0800",
+                         "replacement_id": "i-0801",
+                         "created_at": datetime.datetime(2014, 2, 16, 12, 0)},
+                        {"instance_name": "myinstance", "dead_unit_id": "i-0802",
+                         "replacement_id": "i-0803",
+                         "created_at": datetime.datetime(2014, 2, 16, 12, 25)}]
+        units = {"i-0801": [storage.Unit(id="i-0801", state="creating")],
+                 "i-0803": [storage.Unit(id="i-0803", state="dead")]}
+        healer.storage.retrieve_unit_replacements.return_value = replacements
+        healer.storage.retrieve_units.side_effect = lambda id: units[id]
+        dead = [storage.Unit(id="i-0800", state="dead"), storage.Unit(id="i-0802", state="dead")]
+        instance = storage.Instance(name="myinstance", units=dead)
+        healer.storage.retrieve_instance.return_value = instance
+        healer.replace = mock.Mock()
+        healer.finish_replacements()
+        self.assertEqual([mock.call(instance, dead[0]), mock.call(instance, dead[1])],
+                         healer.manager.remove_unit.call_args_list)
+        self.assertEqual([mock.call(replacements[0], state="failed"),
+                          mock.call(replacements[1], state="failed")],
+                         healer.storage.update_unit_replacement.call_args_list)
+        self.assertFalse(healer.replace.called)
+        stderr.write.assert_any_call("[ERROR] replacement i-0801 of i-0800 in myinstance "
+                                     "failed\n")
+
+    @mock.patch("sys.stderr")
+    def test_finish_replacements_gone(self, stderr):
+        healer = self.build_healer()
+        replacement = {"instance_name": "myinstance", "dead_unit_id": "i-0800",
+                       "replacement_id": "i-0801", "created_at": datetime.datetime.utcnow()}
+        healer.storage.retrieve_unit_replacements.return_value = [replacement]
+        healer.storage.retrieve_units.return_value = []
+        dead = storage.Unit(id="i-0800", state="dead")
+        healer.storage.retrieve_instance.return_value = storage.Instance(name="myinstance",
+                                                                         units=[dead])
+        calls = []
+        healer.locker.unlock.side_effect = lambda name: calls.append("unlock")
+        healer.replace = mock.Mock(side_effect=lambda unit: calls.append("replace"))
+        healer.finish_replacements()
+        healer.storage.update_unit_replacement.assert_called_once_with(replacement,
+                                                                       state="failed")
+        healer.replace.assert_called_once_with(dead)
+        self.assertEqual(["unlock", "replace"], calls)
+        self.assertFalse(healer.manager.remove_unit.called)
+
+    def test_finish_replacements_instance_removed(self):
+        healer = self.build_healer()
+        replacement = {"instance_name": "myinstance", "dead_unit_id": "i-0800",
+                       "replacement_id": "i-0801", "created_at": datetime.datetime.utcnow()}
+        healer.storage.retrieve_unit_replacements.return_value = [replacement]
+        healer.storage.retrieve_units.return_value = [storage.Unit(id="i-0801",
+                                                                   state="started")]
+        healer.storage.retrieve_instance.side_effect = storage.InstanceNotFoundError()
+        healer.finish_replacements()
+        healer.storage.update_unit_replacement.assert_called_once_with(replacement,
+                                                                       state="failed")
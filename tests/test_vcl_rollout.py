@@ -0,0 +1,211 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import hashlib
+import unittest
+
+import freezegun
+import mock
+
+from feaas import runners, storage
+from feaas.runners import vcl_rollout
+
+
+class VCLRolloutTestCase(unittest.TestCase):
+
+    def build_units(self, n):
+        instance = storage.Instance(name="wat")
+        return [storage.Unit(id="i-%04d" % i, dns_name="unit%d.cloud.tsuru.io" % i,
+                             state="started", instance=instance)
+                for i in xrange(n)]
+
+    def build_rollout(self, **kwargs):
+        strg = mock.Mock()
+        strg.retrieve_binds.return_value = [storage.Bind("cool", storage.Instance("wat"))]
+        strg.retrieve_cache_policy.return_value = None
+        manager = mock.Mock(storage=strg)
+        manager.vcl_template.return_value = u'"template"'
+        # mock doesn't record calls made from many threads reliably
+        kwargs.setdefault("max_workers", 1)
+        return vcl_rollout.VCLRollout(manager, **kwargs)
+
+    def test_init(self):
+        strg = storage.MongoDBStorage()
+        manager = mock.Mock(storage=strg)
+        rollout = vcl_rollout.VCLRollout(manager, interval=30, canary_percent=10,
+                                         wave_percent=25, max_error_rate=0.2)
+        self.assertEqual(30, rollout.interval)
+        self.assertEqual(10, rollout.canary_percent)
+        self.assertEqual(25, rollout.wave_percent)
+        self.assertEqual(0.2, rollout.max_error_rate)
+        rollout.locker.lock(rollout.lock_name)
+        rollout.locker.unlock(rollout.lock_name)
+
+    def test_inherits_from_base_runner(self):
+        rollout = self.build_rollout()
+        self.assertIsInstance(rollout, runners.Base)
+
+    def test_run(self):
+        rollout = self.build_rollout()
+        rollout.locker = mock.Mock()
+        rollout.get_rollout = mock.Mock(return_value={"state": "running"})
+        rollout.run_wave = mock.Mock()
+        rollout.run()
+        rollout.locker.lock.assert_called_with(rollout.lock_name)
+        rollout.run_wave.assert_called_with({"state": "running"})
+        rollout.locker.unlock.assert_called_with(rollout.lock_name)
+
+    def test_run_paused(self):
+        rollout = self.build_rollout()
+        rollout.locker = mock.Mock()
+        rollout.get_rollout = mock.Mock(return_value={"state": "paused"})
+        rollout.run_wave = mock.Mock()
+        rollout.run()
+        self.assertFalse(rollout.run_wave.called)
+        rollout.locker.unlock.assert_called_with(rollout.lock_name)
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_get_rollout_new(self):
+        rollout = self.build_rollout()
+        rollout.storage.retrieve_rollout.return_value = None
+        rollout.storage.retrieve_units.return_value = self.build_units(3)
+        got = rollout.get_rollout()
+        template_hash = hashlib.sha1('"template"').hexdigest()
+        rollout.storage.retrieve_rollout.assert_called_with(template_hash=template_hash)
+        self.assertEqual(template_hash, got["template_hash"])
+        self.assertEqual("running", got["state"])
+        self.assertEqual(0, got["wave"])
+        self.assertEqual(3, got["total"])
+        self.assertEqual([], got["done"])
+        rollout.storage.store_rollout.assert_called_with(got)
+
+    def test_get_rollout_existing(self):
+        rollout = self.build_rollout()
+        existing = {"template_hash": "abc", "state": "paused"}
+        rollout.storage.retrieve_rollout.return_value = existing
+        self.assertEqual(existing, rollout.get_rollout())
+        self.assertFalse(rollout.storage.store_rollout.called)
+
+    def test_resume(self):
+        rollout = self.build_rollout()
+        existing = {"template_hash": "abc", "state": "paused", "failed": ["i-0001"],
+                    "reason": "1 of 1 units failed in wave 1"}
+        rollout.storage.retrieve_rollout.return_value = existing
+        got = rollout.resume()
+        self.assertEqual({"template_hash": "abc", "state": "running", "failed": []}, got)
+        rollout.storage.store_rollout.assert_called_with(got)
+
+    def test_resume_done_with_failures(self):
+        rollout = self.build_rollout()
+        existing = {"template_hash": "abc", "state": "done_with_failures",
+                    "failed": ["i-0001"], "reason": "1 units failed"}
+        rollout.storage.retrieve_rollout.return_value = existing
+        got = rollout.resume()
+        self.assertEqual({"template_hash": "abc", "state": "running", "failed": []}, got)
+        rollout.storage.store_rollout.assert_called_with(got)
+
+    def test_resume_done(self):
+        rollout = self.build_rollout()
+        existing = {"template_hash": "abc", "state": "done", "failed": []}
+        rollout.storage.retrieve_rollout.return_value = existing
+        self.assertEqual("done", rollout.resume()["state"])
+        self.assertFalse(rollout.storage.store_rollout.called)
+
+    def test_run_wave_retries_failed_units_after_resume(self):
+        units = self.build_units(2)
+        rollout = self.build_rollout(wave_percent=100)
+        rollout.storage.retrieve_units.return_value = units
+        rollout.storage.retrieve_rollout.return_value = {
+            "template_hash": "abc", "state": "done_with_failures", "wave": 2, "total": 2,
+            "done": ["i-0000"], "failed": ["i-0001"], "reason": "1 units failed"}
+        state = rollout.resume()
+        rollout.run_wave(state)
+        rollout.manager.write_vcl.assert_called_once_with(units[1], ["cool"], policy=None)
+        self.assertEqual(["i-0000", "i-0001"], state["done"])
+        self.assertEqual("done", state["state"])
+
+    def test_wave_size(self):
+        rollout = self.build_rollout(canary_percent=5, wave_percent=20)
+        self.assertEqual(1, rollout.wave_size({"wave": 0, "total": 10}))
+        self.assertEqual(2, rollout.wave_size({"wave": 0, "total": 21}))
+        self.assertEqual(2, rollout.wave_size({"wave": 1, "total": 10}))
+        self.assertEqual(1, rollout.wave_size({"wave": 3, "total": 0}))
+
+    def test_run_wave_canary(self):
+        units = self.build_units(10)
+        rollout = self.build_rollout(canary_percent=10)
+        rollout.storage.retrieve_units.return_value = list(reversed(units))
+        rollout.storage.retrieve_cache_policy.return_value = {"instance_name": "wat",
+                                                              "policy": {"grace": 30},
+                                                              "state": "applied"}
+        state = {"template_hash": "abc", "state": "running", "wave": 0, "total": 10,
+                 "done": [], "failed": []}
+        rollout.run_wave(state)
+        rollout.manager.write_vcl.assert_called_once_with(units[0], ["cool"],
+                                                          policy={"grace": 30})
+        rollout.storage.retrieve_cache_policy.assert_called_once_with("wat")
+        self.assertEqual(["i-0000"], state["done"])
+        self.assertEqual(1, state["wave"])
+        self.assertEqual("running", state["state"])
+        rollout.storage.store_rollout.assert_called_with(state)
+
+    def test_run_wave_skips_processed_units(self):
+        units = self.build_units(4)
+        rollout = self.build_rollout(wave_percent=50)
+        rollout.storage.retrieve_units.return_value = units
+        state = {"template_hash": "abc", "state": "running", "wave": 1, "total": 4,
+                 "done": ["i-0000"], "failed": ["i-0001"]}
+        rollout.run_wave(state)
+        self.assertItemsEqual([mock.call(units[2], ["cool"], policy=None),
+                               mock.call(units[3], ["cool"], policy=None)],
+                              rollout.manager.write_vcl.call_args_list)
+        self.assertItemsEqual(["i-0000", "i-0002", "i-0003"], state["done"])
+        self.assertEqual("done_with_failures", state["state"])
+
+    def test_run_wave_units_without_binds(self):
+        units = self.build_units(1)
+        rollout = self.build_rollout()
+        rollout.storage.retrieve_binds.return_value = []
+        rollout.storage.retrieve_units.return_value = units
+        state = {"template_hash": "abc", "state": "running", "wave": 0, "total": 1,
+                 "done": [], "failed": []}
+        rollout.run_wave(state)
+        self.assertFalse(rollout.manager.write_vcl.called)
+        self.assertEqual(["i-0000"], state["done"])
+        self.assertEqual("done", state["state"])
+
+    @mock.patch("sys.stderr")
+    def test_run_wave_pauses_on_errors(self, stderr):
+        units = self.build_units(10)
+        rollout = self.build_rollout(wave_percent=40, max_error_rate=0.25)
+
+        def write_vcl(unit, hosts, policy):
+            if unit.id in ("i-0001", "i-0002"):
+                raise ValueError("timeout")
+
+        rollout.manager.write_vcl.side_effect = write_vcl
+        rollout.storage.retrieve_units.return_value = units
+        state = {"template_hash": "abc", "state": "running", "wave": 1, "total": 10,
+                 "done": [], "failed": []}
+        rollout.run_wave(state)
+        self.assertEqual("paused", state["state"])
+        self.assertEqual("2 of 4 units failed in wave 2", state["reason"])
+        self.assertItemsEqual(["i-0001", "i-0002"], state["failed"])
+        self.assertItemsEqual(["i-0000", "i-0003"], state["done"])
+        stderr.write.assert_any_call("[ERROR] failed to roll VCL out to "
+                                     "unit1.cloud.tsuru.io: timeout\n")
+
+    @mock.patch("sys.stderr")
+    def test_run_wave_tolerates_errors_below_threshold(self, stderr):
+        units = self.build_units(10)
+        rollout = self.build_rollout(wave_percent=100, max_error_rate=0.25)
+        rollout.manager.write_vcl.side_effect = [None] * 9 + [ValueError("timeout")]
+        rollout.pool.max_workers = 1
+        rollout.storage.retrieve_units.return_value = units
+        state = {"template_hash": "abc", "state": "running", "wave": 1, "total": 10,
+                 "done": [], "failed": []}
+        rollout.run_wave(state)
+        self.assertEqual("done_with_failures", state["state"])
+        self.assertEqual("1 units failed", state["reason"])
+        self.assertEqual(["i-0009"], state["failed"])
@@ -2,16 +2,29 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import os
+import signal
+import socket
 import threading
 import time
 import unittest
 
+import freezegun
 import mock
 
-from feaas import storage
+from feaas import sharding, storage
 from feaas.runners import vcl_writer
 
 
+def unit_calls(method):
+    """
+    Returns the calls of the given mock with the unit (the first argument)
+    replaced by its id, as VCLWriter passes copies of units to the manager.
+    """
+    return [((args[0].id,) + args[1:], kwargs) for args, kwargs in method.call_args_list]
+
+
 class VCLWriterTestCase(unittest.TestCase):
 
     def test_init(self):
@@ -22,132 +35,839 @@ class VCLWriterTestCase(unittest.TestCase):
         self.assertEqual(strg, writer.storage)
         self.assertEqual(10, writer.interval)
         self.assertEqual(3, writer.max_items)
-        writer.locker.lock(vcl_writer.UNITS_LOCKER)
-        writer.locker.unlock(vcl_writer.UNITS_LOCKER)
-        writer.locker.lock(vcl_writer.BINDS_LOCKER)
-        writer.locker.unlock(vcl_writer.BINDS_LOCKER)
+        self.assertFalse(writer.force)
+        self.assertEqual(10, writer.pool.max_workers)
+        self.assertEqual(120, writer.warm_timeout)
+        self.assertEqual(2, writer.pool.max_per_key)
+        self.assertEqual("{0}:{1}".format(socket.gethostname(), os.getpid()), writer.writer_id)
+        self.assertEqual(30, writer.heartbeat_timeout)
+        self.assertEqual([writer.writer_id], writer.members)
+        writer.heartbeat()
+        self.addCleanup(strg.remove_writer, writer.writer_id)
+        self.assertIn(writer.writer_id, strg.retrieve_writers())
 
     def test_loop(self):
         strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_writers.return_value = []
         manager = mock.Mock(storage=strg)
         fake_run = mock.Mock()
         writer = vcl_writer.VCLWriter(manager, interval=3, max_items=3)
         writer.run = fake_run
-        writer.locker = mock.Mock()
         t = threading.Thread(target=writer.loop)
         t.start()
         time.sleep(1)
         writer.stop()
         t.join()
-        fake_run.assert_called_once()
+        self.assertEqual(1, fake_run.call_count)
+        strg.store_writer_heartbeat.assert_called_with(writer.writer_id, mock.ANY)
+
+    def test_loop_releases_all_leases(self):
+        strg = mock.Mock()
+        strg.retrieve_writers.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, interval=0, writer_id="writer1")
+
+        def fake_run():
+            writer.leases.add("wat")
+            writer.members = ["writer0", "writer1"]
+            writer.stop()
+
+        writer.run = fake_run
+        writer.loop()
+        strg.remove_instance_leases.assert_called_with("writer1", ["wat"])
+        strg.remove_writer.assert_called_once_with("writer1")
+
+    def test_loop_leaves_after_the_heartbeat_thread(self):
+        strg = mock.Mock()
+        strg.retrieve_writers.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, interval=0, heartbeat_timeout=0.3,
+                                      writer_id="writer1")
+        calls = []
+        in_heartbeat = threading.Event()
+
+        def store_writer_heartbeat(writer_id, heartbeat_at):
+            if threading.current_thread().name != "MainThread":
+                in_heartbeat.set()
+                time.sleep(0.2)
+            calls.append("heartbeat")
+
+        def fake_run():
+            if in_heartbeat.wait(2):
+                writer.stop()
+
+        strg.store_writer_heartbeat.side_effect = store_writer_heartbeat
+        strg.remove_writer.side_effect = lambda writer_id: calls.append("remove")
+        writer.run = fake_run
+        writer.loop()
+        self.assertEqual(["heartbeat", "heartbeat", "remove"], calls)
+
+    @mock.patch("sys.stderr")
+    def test_beat(self, stderr):
+        manager = mock.Mock(storage=mock.Mock())
+        writer = vcl_writer.VCLWriter(manager, heartbeat_timeout=0.03, writer_id="writer1")
+
+        def fake_heartbeat():
+            if writer.heartbeat.call_count == 2:
+                writer.stop()
+            raise ValueError("connection refused")
+
+        writer.heartbeat = mock.Mock(side_effect=fake_heartbeat)
+        writer.beat()
+        self.assertEqual(2, writer.heartbeat.call_count)
+        stderr.write.assert_called_with("[ERROR] failed to send the heartbeat of writer1: "
+                                        "connection refused\n")
 
     def test_stop(self):
         manager = mock.Mock(storage=mock.Mock())
-        writer = vcl_writer.VCLWriter(manager)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
         writer.running = True
         writer.stop()
         self.assertFalse(writer.running)
+        self.assertTrue(writer.stopped.is_set())
+        self.assertFalse(manager.storage.remove_writer.called)
+
+    @mock.patch("signal.signal")
+    def test_handle_signals(self, signal_mock):
+        manager = mock.Mock(storage=mock.Mock())
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        writer.running = True
+        writer.handle_signals()
+        signals = [c[0][0] for c in signal_mock.call_args_list]
+        self.assertEqual([signal.SIGTERM, signal.SIGINT], signals)
+        handler = signal_mock.call_args[0][1]
+        handler(signal.SIGTERM, None)
+        self.assertFalse(writer.running)
+        self.assertTrue(writer.stopped.is_set())
+        self.assertFalse(manager.storage.remove_writer.called)
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_heartbeat(self):
+        strg = mock.Mock()
+        strg.retrieve_writers.return_value = ["writer3", "writer1"]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, interval=20, writer_id="writer2")
+        self.assertEqual(60, writer.heartbeat_timeout)
+        writer.heartbeat()
+        now = datetime.datetime(2014, 2, 16, 12, 0, 0)
+        strg.store_writer_heartbeat.assert_called_with("writer2", now)
+        strg.remove_writers.assert_called_with(
+            heartbeat_at={"$lt": datetime.datetime(2014, 2, 16, 11, 59, 0)})
+        self.assertEqual(["writer1", "writer2", "writer3"], writer.members)
+        self.assertFalse(strg.renew_instance_leases.called)
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_heartbeat_renews_leases(self):
+        strg = mock.Mock()
+        strg.retrieve_writers.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        writer.leases = set(["wat"])
+        writer.heartbeat()
+        strg.renew_instance_leases.assert_called_with(
+            "writer1", ["wat"], datetime.datetime(2014, 2, 16, 12, 0, 30))
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_owns_claims_lease(self):
+        strg = mock.Mock()
+        strg.claim_instance_lease.return_value = True
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        self.assertTrue(writer.owns("wat"))
+        self.assertTrue(writer.owns("wat"))
+        now = datetime.datetime(2014, 2, 16, 12, 0, 0)
+        strg.claim_instance_lease.assert_called_once_with(
+            "wat", "writer1", datetime.datetime(2014, 2, 16, 12, 0, 30), now)
+        self.assertEqual(set(["wat"]), writer.leases)
+
+    def test_owns_lease_held_by_another_writer(self):
+        strg = mock.Mock()
+        strg.claim_instance_lease.return_value = False
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        self.assertFalse(writer.owns("wat"))
+        self.assertEqual(set(), writer.leases)
+
+    def test_owns_not_assigned(self):
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        writer.members = ["writer0", "writer1"]
+        names = [name for name in ["instance%d" % i for i in xrange(10)]
+                 if sharding.owner(name, writer.members) == "writer0"]
+        self.assertFalse(any([writer.owns(name) for name in names]))
+        self.assertFalse(strg.claim_instance_lease.called)
+
+    def test_release_leases(self):
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        writer.members = ["writer0", "writer1"]
+        names = ["instance%d" % i for i in xrange(10)]
+        writer.leases = set(names)
+        writer.release_leases()
+        moved = [name for name in names if sharding.owner(name, writer.members) == "writer0"]
+        strg.remove_instance_leases.assert_called_once_with("writer1", mock.ANY)
+        self.assertEqual(sorted(moved), sorted(strg.remove_instance_leases.call_args[0][1]))
+        self.assertEqual(set(), writer.leases)
+
+    def test_owns(self):
+        manager = mock.Mock(storage=mock.Mock())
+        writers = [vcl_writer.VCLWriter(manager, writer_id="writer%d" % i) for i in xrange(3)]
+        for writer in writers:
+            writer.members = ["writer0", "writer1", "writer2"]
+        names = ["instance%d" % i for i in xrange(30)]
+        owned = [[name for name in names if writer.owns(name)] for writer in writers]
+        self.assertEqual(sorted(names), sorted(sum(owned, [])))
+        self.assertTrue(all(owned))
 
     def test_run(self):
         manager = mock.Mock(storage=mock.Mock())
         writer = vcl_writer.VCLWriter(manager)
+        writer.release_leases = mock.Mock()
         writer.run_units = mock.Mock()
         writer.run_binds = mock.Mock()
         writer.run()
-        writer.run_units.assert_called_once()
-        writer.run_binds.assert_called_once()
+        writer.release_leases.assert_called_once_with()
+        self.assertEqual(1, writer.run_units.call_count)
+        self.assertEqual(1, writer.run_binds.call_count)
 
     def test_run_units(self):
+        created_at = datetime.datetime(2014, 2, 16, 12, 0, 0)
         units = [storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800"),
-                 storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801"),
+                 storage.Unit(dns_name="instance2.cloud.tsuru.io", id="i-0801",
+                              created_at=created_at),
                  storage.Unit(dns_name="instance3.cloud.tsuru.io", id="i-0802")]
+        storage.Instance(name="wat", units=units)
         strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
         strg.retrieve_units.return_value = units
+        strg.retrieve_vcl_retries.return_value = []
         manager = mock.Mock(storage=strg)
         writer = vcl_writer.VCLWriter(manager, max_items=3)
-        writer._is_unit_up = lambda unit: unit == units[1]
-        writer.bind_units = mock.Mock()
-        writer.locker = mock.Mock()
-        writer.run_units()
-        writer.locker.lock.assert_called_with(vcl_writer.UNITS_LOCKER)
-        strg.retrieve_units.assert_called_with(state="creating", limit=3)
-        writer.locker.unlock.assert_called_with(vcl_writer.UNITS_LOCKER)
-        writer.bind_units.assert_called_with([units[1]])
+        manager.is_unit_up.side_effect = lambda unit: unit == units[1]
+        writer.bind_units = mock.Mock(side_effect=lambda units, retries: units)
+        writer.set_params = mock.Mock()
+        writer.warm_units = mock.Mock()
+        with freezegun.freeze_time("2014-02-16 12:03:30"):
+            writer.run_units()
+        strg.retrieve_units.assert_called_with(state="creating")
+        writer.bind_units.assert_called_with([units[1]], {})
+        writer.set_params.assert_called_with([units[1]])
+        writer.warm_units.assert_called_with([units[1]])
         strg.update_units.assert_called_with([units[1]], state="started")
+        strg.store_boot_latency.assert_called_once_with(units[1], 210)
+
+    def test_run_units_unknown_created_at(self):
+        unit = storage.Unit(dns_name="instance1.cloud.tsuru.io", id="i-0800",
+                            instance=storage.Instance(name="wat"))
+        unit.created_at = None
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_vcl_retries.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager)
+        manager.is_unit_up.return_value = True
+        writer.bind_units = mock.Mock(side_effect=lambda units, retries: units)
+        writer.set_params = mock.Mock()
+        writer.warm_units = mock.Mock()
+        writer.run_units()
+        strg.update_units.assert_called_with([unit], state="started")
+        self.assertFalse(strg.store_boot_latency.called)
+
+    def test_run_units_only_owned_instances(self):
+        units = [storage.Unit(id="i-08%02d" % i, instance=storage.Instance(name="inst%d" % i))
+                 for i in xrange(20)]
+        strg = mock.Mock()
+        strg.retrieve_vcl_retries.return_value = []
+        strg.retrieve_units.return_value = units
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_items=3, writer_id="writer1")
+        writer.members = ["writer1", "writer2"]
+        manager.is_unit_up.return_value = True
+        writer.bind_units = mock.Mock(return_value=[])
+        writer.run_units()
+        owned = [u for u in units if sharding.owner(u.instance.name, writer.members) == "writer1"]
+        writer.bind_units.assert_called_with(owned[:3], {})
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_run_units_skips_units_waiting_for_retry(self):
+        retries = [{"instance_name": "wat", "unit_id": "i-0800", "attempts": 2,
+                    "retry_at": datetime.datetime(2014, 2, 16, 12, 0, 30)},
+                   {"instance_name": "wat", "unit_id": "i-0801", "attempts": 10,
+                    "state": "dead", "retry_at": None},
+                   {"instance_name": "wat", "unit_id": "i-0802", "attempts": 1,
+                    "retry_at": datetime.datetime(2014, 2, 16, 11, 59, 50)}]
+        unit = storage.Unit(id="i-0802", instance=storage.Instance(name="wat"))
+        strg = mock.Mock()
+        strg.retrieve_vcl_retries.return_value = retries
+        strg.retrieve_units.return_value = [unit]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_items=3)
+        manager.is_unit_up.return_value = True
+        writer.bind_units = mock.Mock(return_value=[])
+        writer.set_params = mock.Mock()
+        writer.run_units()
+        strg.retrieve_units.assert_called_with(state="creating",
+                                               id={"$nin": ["i-0800", "i-0801"]})
+        writer.bind_units.assert_called_with([unit], {("wat", "i-0800"): retries[0],
+                                                      ("wat", "i-0801"): retries[1],
+                                                      ("wat", "i-0802"): retries[2]})
+        self.assertFalse(writer.set_params.called)
+        self.assertFalse(strg.update_units.called)
+
+    @mock.patch("sys.stderr")
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_bind_units_failure(self, stderr):
+        instance = storage.Instance(name="wat")
+        units = [storage.Unit(dns_name="unit1.cloud.tsuru.io", id="i-0800", instance=instance),
+                 storage.Unit(dns_name="unit2.cloud.tsuru.io", id="i-0801", instance=instance),
+                 storage.Unit(dns_name="unit3.cloud.tsuru.io", id="i-0802", instance=instance)]
+
+        def write_vcl(unit, app_hosts, force, policy):
+            if unit == units[0]:
+                raise ValueError("unit is down")
+
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_binds.return_value = [storage.Bind("myapp.cloud.tsuru.io", instance)]
+        manager = mock.Mock(storage=strg)
+        manager.write_vcl.side_effect = write_vcl
+        writer = vcl_writer.VCLWriter(manager, retry_delay=10)
+        retries = {("wat", "i-0800"): {"attempts": 1}, ("wat", "i-0801"): {"attempts": 2}}
+        self.assertEqual(units[1:], writer.bind_units(units, retries))
+        self.assertEqual(3, manager.write_vcl.call_count)
+        strg.store_vcl_retry.assert_called_once_with(
+            units[0], attempts=2, error="unit is down",
+            retry_at=datetime.datetime(2014, 2, 16, 12, 0, 20))
+        strg.remove_vcl_retry.assert_called_once_with(units[1])
 
     def test_bind_units(self):
         instance1 = storage.Instance(name="myinstance")
         instance2 = storage.Instance(name="yourinstance")
+        instance3 = storage.Instance(name="ourinstance")
         units = [storage.Unit(dns_name="instance1-1.cloud.tsuru.io", id="i-0800",
                               instance=instance1, secret="abc123"),
                  storage.Unit(dns_name="instance1-2.cloud.tsuru.io", id="i-0801",
                               instance=instance1, secret="abc321"),
                  storage.Unit(dns_name="instance2-1.cloud.tsuru.io", id="i-0802",
-                              instance=instance2, secret="abc456")]
+                              instance=instance2, secret="abc456"),
+                 storage.Unit(dns_name="instance3-1.cloud.tsuru.io", id="i-0803",
+                              instance=instance3, secret="abc654")]
+        binds = {"myinstance": [storage.Bind("myapp.cloud.tsuru.io", instance1),
+                                storage.Bind("arepa.cloud.tsuru.io", instance1)],
+                 "yourinstance": [storage.Bind("yourapp.cloud.tsuru.io", instance2)],
+                 "ourinstance": []}
         strg = mock.Mock()
-        strg.retrieve_units.return_value = units
-        strg.retrieve_binds.return_value = [storage.Bind("myapp.cloud.tsuru.io",
-                                                         instance1)]
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_binds.side_effect = lambda instance_name, state: binds[instance_name]
         manager = mock.Mock(storage=strg)
         writer = vcl_writer.VCLWriter(manager, max_items=3)
         writer.bind_units(units)
-        expected_calls = [mock.call(instance_name="myinstance", state="created"),
-                          mock.call(instance_name="yourinstance", state="created")]
+        live = {"$in": ["creating", "created"]}
+        expected_calls = [mock.call(instance_name="myinstance", state=live),
+                          mock.call(instance_name="yourinstance", state=live),
+                          mock.call(instance_name="ourinstance", state=live)]
         self.assertEqual(expected_calls, strg.retrieve_binds.call_args_list)
-        expected_calls = [mock.call("instance1-1.cloud.tsuru.io", "abc123",
-                                    "myapp.cloud.tsuru.io"),
-                          mock.call("instance1-2.cloud.tsuru.io", "abc321",
-                                    "myapp.cloud.tsuru.io"),
-                          mock.call("instance2-1.cloud.tsuru.io", "abc456",
-                                    "myapp.cloud.tsuru.io")]
+        hosts = ["arepa.cloud.tsuru.io", "myapp.cloud.tsuru.io"]
+        expected_calls = [mock.call(units[0], hosts, force=False, policy=None),
+                          mock.call(units[1], hosts, force=False, policy=None),
+                          mock.call(units[2], ["yourapp.cloud.tsuru.io"], force=False,
+                                    policy=None)]
         self.assertEqual(expected_calls, manager.write_vcl.call_args_list)
 
-    @mock.patch("telnetlib.Telnet")
-    def test_is_unit_up_up(self, Telnet):
-        telnet_client = mock.Mock()
-        Telnet.return_value = telnet_client
-        unit = storage.Unit(dns_name="instance1.cloud.tsuru.io")
-        manager = mock.Mock(storage=mock.Mock())
+    def test_bind_units_force(self):
+        instance = storage.Instance(name="myinstance")
+        unit = storage.Unit(dns_name="instance1-1.cloud.tsuru.io", id="i-0800",
+                            instance=instance, secret="abc123")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_binds.return_value = [storage.Bind("myapp.cloud.tsuru.io",
+                                                         instance)]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_items=3, force=True)
+        writer.bind_units([unit])
+        manager.write_vcl.assert_called_once_with(unit, ["myapp.cloud.tsuru.io"],
+                                                  force=True, policy=None)
+
+    @mock.patch("sys.stderr")
+    def test_set_params(self, stderr):
+        instance1 = storage.Instance(name="myinstance")
+        instance2 = storage.Instance(name="yourinstance")
+        units = [storage.Unit(dns_name="instance1-1.cloud.tsuru.io", id="i-0800",
+                              instance=instance1),
+                 storage.Unit(dns_name="instance1-2.cloud.tsuru.io", id="i-0801",
+                              instance=instance1),
+                 storage.Unit(dns_name="instance2-1.cloud.tsuru.io", id="i-0802",
+                              instance=instance2)]
+        strg = mock.Mock()
+        strg.retrieve_varnish_params.return_value = [{"instance_name": "myinstance",
+                                                      "params": {"thread_pools": 4}}]
+        manager = mock.Mock(storage=strg)
+        manager.apply_params.side_effect = [ValueError("unit is down"), ["thread_pools"]]
+        writer = vcl_writer.VCLWriter(manager)
+        writer.set_params(units)
+        names = strg.retrieve_varnish_params.call_args[1]["instance_name"]["$in"]
+        self.assertItemsEqual(["myinstance", "yourinstance"], names)
+        self.assertEqual([mock.call(units[0], {"thread_pools": 4}),
+                          mock.call(units[1], {"thread_pools": 4})],
+                         manager.apply_params.call_args_list)
+        stderr.write.assert_called_once_with("[ERROR] failed to set parameters in "
+                                             "instance1-1.cloud.tsuru.io: unit is down\n")
+
+    @mock.patch("sys.stderr")
+    def test_warm_units(self, stderr):
+        instance1 = storage.Instance(name="myinstance")
+        instance2 = storage.Instance(name="yourinstance")
+        units = [storage.Unit(dns_name="instance1-1.cloud.tsuru.io", id="i-0800",
+                              instance=instance1),
+                 storage.Unit(dns_name="instance1-2.cloud.tsuru.io", id="i-0801",
+                              instance=instance1),
+                 storage.Unit(dns_name="instance2-1.cloud.tsuru.io", id="i-0802",
+                              instance=instance2)]
+        strg = mock.Mock()
+        strg.retrieve_warm_urls.return_value = [{"instance_name": "myinstance",
+                                                 "urls": ["http://myapp.com/"]}]
+        result = {"urls": 1, "warmed": 1, "coverage": 1.0, "duration": 0.2}
+
+        def warm_unit(unit, urls, max_workers, deadline):
+            if unit == units[0]:
+                raise ValueError("timed out")
+            return result
+
+        manager = mock.Mock(storage=strg)
+        manager.warm_unit.side_effect = warm_unit
+        writer = vcl_writer.VCLWriter(manager, max_workers=1, warm_workers=4, warm_timeout=60)
+        with mock.patch("time.time") as time:
+            time.return_value = 1000
+            writer.warm_units(units)
+        names = strg.retrieve_warm_urls.call_args[1]["instance_name"]["$in"]
+        self.assertItemsEqual(["myinstance", "yourinstance"], names)
+        self.assertItemsEqual([mock.call(units[0], ["http://myapp.com/"], 4, deadline=1060),
+                               mock.call(units[1], ["http://myapp.com/"], 4, deadline=1060)],
+                              manager.warm_unit.call_args_list)
+        strg.store_warmup.assert_called_once_with(units[1], **result)
+        stderr.write.assert_called_once_with("[ERROR] failed to warm "
+                                             "instance1-1.cloud.tsuru.io up: timed out\n")
+
+    def test_warm_units_in_parallel(self):
+        instance = storage.Instance(name="myinstance")
+        units = [storage.Unit(dns_name="instance1-1.cloud.tsuru.io", id="i-0800",
+                              instance=instance),
+                 storage.Unit(dns_name="instance1-2.cloud.tsuru.io", id="i-0801",
+                              instance=instance)]
+        strg = mock.Mock()
+        strg.retrieve_warm_urls.return_value = [{"instance_name": "myinstance",
+                                                 "urls": ["http://myapp.com/"]}]
+        both = threading.Event()
+        lock = threading.Lock()
+        running = []
+
+        def warm_unit(unit, urls, max_workers, deadline):
+            with lock:
+                running.append(unit)
+                if len(running) == 2:
+                    both.set()
+            both.wait(2)
+            return {"urls": 1, "warmed": 1, "coverage": 1.0, "duration": 0.1}
+
+        manager = mock.Mock(storage=strg)
+        manager.warm_unit.side_effect = warm_unit
+        writer = vcl_writer.VCLWriter(manager, max_workers=2)
+        writer.warm_units(units)
+        self.assertTrue(both.is_set())
+        self.assertEqual(2, strg.store_warmup.call_count)
+
+    def test_run_binds(self):
+        instance1 = storage.Instance(name="wat")
+        instance2 = storage.Instance(name="wet")
+        binds = [storage.Bind(instance=instance1, app_host="cool", state="creating"),
+                 storage.Bind(instance=instance2, app_host="bool", state="removing"),
+                 storage.Bind(instance=instance1, app_host="fool", state="removing")]
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_vcl_retries.return_value = []
+        strg.retrieve_binds.return_value = binds
+        manager = mock.Mock(storage=strg)
         writer = vcl_writer.VCLWriter(manager, max_items=3)
-        self.assertTrue(writer._is_unit_up(unit))
-        Telnet.assert_called_with(unit.dns_name, "6082", timeout=3)
-        telnet_client.close.assert_called_once()
-
-    @mock.patch("telnetlib.Telnet")
-    def test_is_unit_up_down(self, Telnet):
-        Telnet.side_effect = ValueError()
-        unit = storage.Unit(dns_name="instance1.cloud.tsuru.io")
-        manager = mock.Mock(storage=storage.MongoDBStorage())
+        writer.write_instances = mock.Mock()
+        writer.run_binds()
+        strg.retrieve_binds.assert_called_once_with(state={"$in": ["creating", "removing"]})
+        writer.write_instances.assert_called_once_with(["wat", "wet"])
+
+    def test_run_binds_only_owned_instances(self):
+        instances = [storage.Instance(name="instance%d" % i) for i in xrange(10)]
+        binds = [storage.Bind(instance=instance, app_host="cool") for instance in instances]
+        strg = mock.Mock()
+        strg.retrieve_binds.return_value = binds
+        strg.retrieve_cache_policies.return_value = [{"instance_name": "other%d" % i,
+                                                      "policy": {}, "state": "pending"}
+                                                     for i in xrange(10)]
+        strg.retrieve_vcl_retries.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, writer_id="writer1")
+        writer.members = ["writer1", "writer2"]
+        writer.write_instances = mock.Mock()
+        writer.run_binds()
+        names = writer.write_instances.call_args[0][0]
+        expected = [i.name for i in instances] + ["other%d" % i for i in xrange(10)]
+        self.assertEqual([name for name in expected
+                          if sharding.owner(name, writer.members) == "writer1"], names)
+        self.assertTrue(0 < len(names) < 20)
+
+    def test_run_binds_pending_cache_policies(self):
+        instance = storage.Instance(name="wat")
+        strg = mock.Mock()
+        strg.retrieve_binds.return_value = [storage.Bind(instance=instance, app_host="cool")]
+        strg.retrieve_cache_policies.return_value = [{"instance_name": "wet",
+                                                      "policy": {}, "state": "pending"},
+                                                     {"instance_name": "wat",
+                                                      "policy": {}, "state": "pending"}]
+        strg.retrieve_vcl_retries.return_value = []
+        manager = mock.Mock(storage=strg)
         writer = vcl_writer.VCLWriter(manager, max_items=3)
-        self.assertFalse(writer._is_unit_up(unit))
-        Telnet.assert_called_with(unit.dns_name, "6082", timeout=3)
+        writer.write_instances = mock.Mock()
+        writer.run_binds()
+        strg.retrieve_cache_policies.assert_called_once_with(state="pending")
+        writer.write_instances.assert_called_once_with(["wat", "wet"])
 
-    def test_run_binds(self):
+    def test_run_binds_requeued_retries(self):
+        strg = mock.Mock()
+        strg.retrieve_binds.return_value = []
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat", "unit_id": "i-0800",
+                                                   "attempts": 0, "state": "requeued",
+                                                   "retry_at": None}]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager)
+        writer.write_instances = mock.Mock()
+        writer.run_binds()
+        strg.retrieve_vcl_retries.assert_called_once_with(state="requeued")
+        writer.write_instances.assert_called_once_with(["wat"])
+
+    def test_write_instances(self):
         units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io",
                               secret="abc123", state="started"),
                  storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io",
-                              secret="abc321", state="started")]
-        instance1 = storage.Instance(name="wat", units=units)
-        instance2 = storage.Instance(name="wet", units=units)
-        binds = [storage.Bind(instance=instance1, app_host="cool", state="creating"),
-                 storage.Bind(instance=instance2, app_host="bool", state="creating")]
+                              secret="abc321", state="started"),
+                 storage.Unit(id="i-8002", dns_name="unit3.cloud.tsuru.io",
+                              secret="abc456", state="started", vcl_hash="abc")]
+        instance1 = storage.Instance(name="wat", units=units[:2])
+        instance2 = storage.Instance(name="wet", units=units[2:])
+        binds = {"wat": [storage.Bind(instance=instance1, app_host="cool", state="creating"),
+                         storage.Bind(instance=instance1, app_host="fool", state="created"),
+                         storage.Bind(instance=instance1, app_host="pool", state="removing")],
+                 "wet": [storage.Bind(instance=instance2, app_host="bool", state="removing")]}
         strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
         strg.retrieve_units.return_value = units
-        strg.retrieve_binds.return_value = binds
+        strg.retrieve_binds.side_effect = lambda instance_name: binds[instance_name]
+        strg.retrieve_vcl_retries.return_value = []
         manager = mock.Mock(storage=strg)
-        writer = vcl_writer.VCLWriter(manager, max_items=3)
-        writer.locker = mock.Mock()
-        writer.run_binds()
-        writer.locker.lock.assert_called_with(vcl_writer.BINDS_LOCKER)
-        writer.locker.unlock.assert_called_with(vcl_writer.BINDS_LOCKER)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat", "wet"])
         strg.retrieve_units.assert_called_once_with(state="started",
                                                     instance_name={"$in": ["wat", "wet"]})
-        strg.retrieve_binds.assert_called_once_with(state="creating", limit=3)
-        expected_write_vcl_calls = [mock.call("unit1.cloud.tsuru.io", "abc123", "cool"),
-                                    mock.call("unit2.cloud.tsuru.io", "abc321", "cool"),
-                                    mock.call("unit1.cloud.tsuru.io", "abc123", "bool"),
-                                    mock.call("unit2.cloud.tsuru.io", "abc321", "bool")]
-        self.assertEqual(expected_write_vcl_calls, manager.write_vcl.call_args_list)
-        expected_update_bind_calls = [mock.call(binds[0], state="created"),
-                                      mock.call(binds[1], state="created")]
+        strg.retrieve_vcl_retries.assert_called_once_with(instance_name={"$in": ["wat", "wet"]})
+        hosts = ["cool", "fool"]
+        expected_write_vcl_calls = [(("i-0800", hosts), {"force": False, "policy": None}),
+                                    (("i-8001", hosts), {"force": False, "policy": None})]
+        self.assertItemsEqual(expected_write_vcl_calls, unit_calls(manager.write_vcl))
+        self.assertEqual([(("i-8002",), {})], unit_calls(manager.remove_vcl))
+        strg.update_bind.assert_called_once_with(binds["wat"][0], state="created")
+        self.assertItemsEqual([mock.call(binds["wat"][2]), mock.call(binds["wet"][0])],
+                              strg.remove_bind.call_args_list)
+        self.assertFalse(strg.store_vcl_retry.called)
+
+    def test_write_instances_cache_policy(self):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool", state="created")
+        stored_policy = {"instance_name": "wat", "policy": {"grace": 30},
+                         "state": "pending"}
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = []
+        strg.retrieve_cache_policy.return_value = stored_policy
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        strg.retrieve_cache_policy.assert_called_once_with("wat")
+        self.assertEqual([(("i-0800", ["cool"]), {"force": False, "policy": {"grace": 30}})],
+                         unit_calls(manager.write_vcl))
+        strg.update_cache_policy.assert_called_once_with(stored_policy, state="applied")
+        self.assertFalse(strg.update_bind.called)
+
+    @mock.patch("sys.stderr")
+    def test_write_instances_cache_policy_failure(self, stderr):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool", state="created")
+        strg = mock.Mock()
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = []
+        strg.retrieve_cache_policy.return_value = {"instance_name": "wat",
+                                                   "policy": {"grace": 30},
+                                                   "state": "pending"}
+        manager = mock.Mock(storage=strg)
+        manager.write_vcl.side_effect = ValueError("unit is down")
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertFalse(strg.update_cache_policy.called)
+
+    def test_write_instances_empty(self):
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances([])
+        self.assertFalse(strg.retrieve_units.called)
+
+    def test_write_instances_without_units(self):
+        instance = storage.Instance(name="wat")
+        bind = storage.Bind(instance=instance, app_host="cool", state="creating")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = []
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertFalse(manager.write_vcl.called)
+        strg.update_bind.assert_called_once_with(bind, state="created")
+
+    def test_write_instances_skips_removal_from_clean_units(self):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool", state="removing")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = []
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertFalse(manager.remove_vcl.called)
+        strg.remove_bind.assert_called_once_with(bind)
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    @mock.patch("sys.stderr")
+    def test_write_instances_partial_failure(self, stderr):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io"),
+                 storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io"),
+                 storage.Unit(id="i-8002", dns_name="unit3.cloud.tsuru.io")]
+        instance1 = storage.Instance(name="wat", units=units[:2])
+        instance2 = storage.Instance(name="wet", units=units[2:])
+        binds = {"wat": [storage.Bind(instance=instance1, app_host="cool")],
+                 "wet": [storage.Bind(instance=instance2, app_host="bool")]}
+
+        def write_vcl(unit, app_hosts, force, policy):
+            if unit.id == units[1].id:
+                raise ValueError("unit is down")
+
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = units
+        strg.retrieve_binds.side_effect = lambda instance_name: binds[instance_name]
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat",
+                                                   "unit_id": "i-8001", "attempts": 2}]
+        manager = mock.Mock(storage=strg)
+        manager.write_vcl.side_effect = write_vcl
+        writer = vcl_writer.VCLWriter(manager, max_workers=1, retry_delay=10)
+        writer.write_instances(["wat", "wet"])
+        self.assertEqual(3, manager.write_vcl.call_count)
+        strg.update_bind.assert_called_once_with(binds["wet"][0], state="created")
+        strg.store_vcl_retry.assert_called_once_with(
+            units[1], attempts=3, error="unit is down",
+            retry_at=datetime.datetime(2014, 2, 16, 12, 0, 40))
+        stderr.write.assert_called_with("[ERROR] failed to write VCL for wat in "
+                                        "unit2.cloud.tsuru.io: unit is down\n")
+
+    @mock.patch("sys.stderr")
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_fail_unit_dead_letter(self, stderr):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io",
+                            instance=storage.Instance(name="wat"))
+        strg = mock.Mock()
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_attempts=5)
+        writer._fail_unit(unit, 5, ValueError("unit is down"))
+        strg.store_vcl_retry.assert_called_once_with(
+            unit, attempts=5, error="unit is down", retry_at=None, state="dead",
+            dead_at=datetime.datetime(2014, 2, 16, 12, 0, 0))
+        stderr.write.assert_called_with("[ERROR] giving up on unit1.cloud.tsuru.io "
+                                        "after 5 attempts\n")
+
+    def test_write_instances_skips_dead_units(self):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io"),
+                 storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io")]
+        instance = storage.Instance(name="wat", units=units)
+        bind = storage.Bind(instance=instance, app_host="cool")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_units.return_value = units
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat",
+                                                   "unit_id": "i-0800", "attempts": 10,
+                                                   "state": "dead", "retry_at": None}]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertEqual([(("i-8001", ["cool"]), {"force": False, "policy": None})],
+                         unit_calls(manager.write_vcl))
+        strg.update_bind.assert_called_once_with(bind, state="created")
+
+    def test_write_instances_clears_retry_on_success(self):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat",
+                                                   "unit_id": "i-0800", "attempts": 1}]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertEqual([(("i-0800", ["cool"]), {"force": False, "policy": None})],
+                         unit_calls(manager.write_vcl))
+        strg.remove_vcl_retry.assert_called_once_with(unit)
+        strg.update_bind.assert_called_once_with(bind, state="created")
+
+    def test_write_instances_requeued_unit(self):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io", state="started")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool", state="created")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.side_effect = lambda **query: [] if "state" in query else [bind]
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat", "unit_id": "i-0800",
+                                                   "attempts": 0, "state": "requeued",
+                                                   "retry_at": None}]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.run_binds()
+        self.assertEqual([(("i-0800", ["cool"]), {"force": False, "policy": None})],
+                         unit_calls(manager.write_vcl))
+        strg.remove_vcl_retry.assert_called_once_with(unit)
+
+    @mock.patch("sys.stderr")
+    def test_write_instances_requeued_unit_fails(self, stderr):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io", state="started")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool", state="created")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat", "unit_id": "i-0800",
+                                                   "attempts": 0, "state": "requeued",
+                                                   "retry_at": None}]
+        manager = mock.Mock(storage=strg)
+        manager.write_vcl.side_effect = ValueError("unit is down")
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertEqual(1, strg.store_vcl_retry.call_args[1]["attempts"])
+        self.assertFalse(strg.remove_vcl_retry.called)
+
+    @freezegun.freeze_time("2014-02-16 12:00:00")
+    def test_write_instances_waits_for_retry_time(self):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io"),
+                 storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io")]
+        instance = storage.Instance(name="wat", units=units)
+        bind = storage.Bind(instance=instance, app_host="cool")
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = units
+        strg.retrieve_binds.return_value = [bind]
+        retry_at = datetime.datetime(2014, 2, 16, 12, 0, 5)
+        strg.retrieve_vcl_retries.return_value = [{"instance_name": "wat",
+                                                   "unit_id": "i-0800", "attempts": 1,
+                                                   "retry_at": retry_at}]
+        manager = mock.Mock(storage=strg)
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertEqual([(("i-8001", ["cool"]), {"force": False, "policy": None})],
+                         unit_calls(manager.write_vcl))
+        self.assertFalse(strg.update_bind.called)
+
+    def test_write_instances_sets_hash_from_callback(self):
+        unit = storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io")
+        instance = storage.Instance(name="wat", units=[unit])
+        bind = storage.Bind(instance=instance, app_host="cool")
+        sent = []
+
+        def write_vcl(unit, app_hosts, force, policy):
+            sent.append(unit)
+            unit.vcl_hash = "abc123"
+            return True
+
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_units.return_value = [unit]
+        strg.retrieve_binds.return_value = [bind]
+        strg.retrieve_vcl_retries.return_value = []
+        manager = mock.Mock(storage=strg)
+        manager.write_vcl.side_effect = write_vcl
+        writer = vcl_writer.VCLWriter(manager, max_workers=1)
+        writer.write_instances(["wat"])
+        self.assertIsNot(unit, sent[0])
+        self.assertEqual("abc123", unit.vcl_hash)
+
+    def test_retry_backoff(self):
+        manager = mock.Mock(storage=mock.Mock())
+        writer = vcl_writer.VCLWriter(manager, retry_delay=10, max_retry_delay=60)
+        delays = [writer.retry_backoff(n).seconds for n in xrange(1, 6)]
+        self.assertEqual([10, 20, 40, 60, 60], delays)
+
+    def test_write_instances_finishes_instance_as_soon_as_its_units_are_done(self):
+        units = [storage.Unit(id="i-0800", dns_name="unit1.cloud.tsuru.io"),
+                 storage.Unit(id="i-8001", dns_name="unit2.cloud.tsuru.io")]
+        instance1 = storage.Instance(name="wat", units=units[:1])
+        instance2 = storage.Instance(name="wet", units=units[1:])
+        binds = {"wat": [storage.Bind(instance=instance1, app_host="cool")],
+                 "wet": [storage.Bind(instance=instance2, app_host="bool")]}
+        slow_write = threading.Event()
+
+        def write_vcl(unit, app_hosts, force, policy):
+            if unit.id == units[1].id:
+                slow_write.wait(2)
+
+        def update_bind(bind, state):
+            if bind == binds["wat"][0]:
+                slow_write.set()
+
+        strg = mock.Mock()
+        strg.retrieve_cache_policy.return_value = None
+        strg.retrieve_cache_policies.return_value = []
+        strg.retrieve_units.return_value = units
+        strg.retrieve_binds.side_effect = lambda instance_name: binds[instance_name]
+        strg.retrieve_vcl_retries.return_value = []
+        strg.update_bind.side_effect = update_bind
+        manager = mock.Mock(storage=strg)
+        manager.write_vcl.side_effect = write_vcl
+        writer = vcl_writer.VCLWriter(manager, max_workers=2)
+        writer.write_instances(["wat", "wet"])
+        expected_update_bind_calls = [mock.call(binds["wat"][0], state="created"),
+                                      mock.call(binds["wet"][0], state="created")]
         self.assertEqual(expected_update_bind_calls, strg.update_bind.call_args_list)
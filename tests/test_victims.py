@@ -0,0 +1,114 @@
+# Copyright 2014 varnishapi authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import threading
+import unittest
+
+import freezegun
+import mock
+
+from feaas import storage, victims
+
+
+class VictimsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.units = [storage.Unit(id="i-0800", state="started",
+                                   created_at=datetime.datetime(2014, 2, 16, 12, 0, 1)),
+                      storage.Unit(id="i-0801", state="started",
+                                   created_at=datetime.datetime(2014, 2, 16, 12, 0, 3)),
+                      storage.Unit(id="i-0802", state="creating",
+                                   created_at=datetime.datetime(2014, 2, 16, 12, 0, 2))]
+
+    def test_newest(self):
+        got = victims.newest(None, self.units)
+        self.assertEqual([self.units[1], self.units[2], self.units[0]], got)
+
+    def test_newest_unknown_created_at(self):
+        self.units[1].created_at = None
+        got = victims.newest(None, self.units)
+        self.assertEqual([self.units[2], self.units[0], self.units[1]], got)
+
+    def test_unhealthy_first(self):
+        got = victims.unhealthy_first(None, self.units)
+        self.assertEqual([self.units[2], self.units[1], self.units[0]], got)
+
+    def test_least_loaded(self):
+        manager = mock.Mock()
+        collected_at = datetime.datetime(2014, 2, 16, 12, 0, 0)
+        manager.storage.retrieve_unit_counters.return_value = [
+            {"unit_id": "i-0800", "counters": {"client_req": 100}, "collected_at": collected_at},
+            {"unit_id": "i-0801", "counters": {"client_req": 100}, "collected_at": collected_at}]
+        counters = {"i-0800": {"client_req": 700}, "i-0801": {"client_req": 400}}
+
+        def unit_stats(unit):
+            if unit.id not in counters:
+                raise ValueError("timed out")
+            return counters[unit.id]
+        manager.unit_stats.side_effect = unit_stats
+        with freezegun.freeze_time("2014-02-16 12:01:00"):
+            got = victims.least_loaded(manager, self.units)
+        self.assertEqual([self.units[2], self.units[1], self.units[0]], got)
+        manager.storage.retrieve_unit_counters.assert_called_with(
+            unit_id={"$in": ["i-0800", "i-0801", "i-0802"]})
+
+    @mock.patch("sys.stderr")
+    def test_least_loaded_without_stats(self, stderr):
+        manager = mock.Mock()
+        manager.storage.retrieve_unit_counters.return_value = [
+            {"unit_id": "i-0800", "counters": {"client_req": 100},
+             "collected_at": datetime.datetime(2014, 2, 16, 12, 0, 0)}]
+        manager.unit_stats.side_effect = ValueError("connection refused")
+        got = victims.least_loaded(manager, self.units)
+        self.assertEqual([self.units[2], self.units[1], self.units[0]], got)
+        self.assertEqual(3, manager.unit_stats.call_count)
+        stderr.write.assert_called_once_with("[ERROR] no load available for the units, "
+                                             "falling back to unhealthy_first\n")
+
+    @mock.patch("sys.stderr")
+    def test_least_loaded_in_parallel(self, stderr):
+        manager = mock.Mock()
+        manager.storage.retrieve_unit_counters.return_value = []
+        lock = threading.Lock()
+        all_called = threading.Event()
+        called = []
+
+        def unit_stats(unit):
+            with lock:
+                called.append(unit)
+                if len(called) == len(self.units):
+                    all_called.set()
+            all_called.wait(2)
+            return {"client_req": 100}
+        manager.unit_stats.side_effect = unit_stats
+        victims.least_loaded(manager, self.units)
+        self.assertTrue(all_called.is_set())
+
+    def test_select(self):
+        self.assertEqual([self.units[2], self.units[1]],
+                         victims.select(None, self.units, 2))
+
+    def test_select_custom_policy(self):
+        os.environ["SCALE_DOWN_POLICY"] = "newest"
+        self.addCleanup(os.environ.pop, "SCALE_DOWN_POLICY")
+        self.assertEqual([self.units[1]], victims.select(None, self.units, 1))
+
+    def test_select_invalid_policy(self):
+        os.environ["SCALE_DOWN_POLICY"] = "random"
+        self.addCleanup(os.environ.pop, "SCALE_DOWN_POLICY")
+        with self.assertRaises(ValueError) as cm:
+            victims.select(None, self.units, 1)
+        exc = cm.exception
+        self.assertEqual(("random is not a valid scale down policy",), exc.args)
+
+    def test_register_policy(self):
+        self.addCleanup(victims.policies.pop, "oldest")
+        policy = lambda manager, units: units
+        victims.register_policy("oldest", policy)
+        self.assertEqual(policy, victims.policies["oldest"])
+        with self.assertRaises(ValueError):
+            victims.register_policy("oldest", policy)
+        victims.register_policy("oldest", policy, override=True)